@@ -0,0 +1,555 @@
+"""
+benchmark.py
+
+benchmark.py measures the throughput of the evaluation pipeline on synthetic data, so
+performance regressions can be caught without the CLEVR-XAI dataset. For every size it
+synthesizes a CLEVR shaped dataset (scenes with mask colors, sRGB mask images, question
+programs with outputs, predictions and random heatmaps) and runs eval.py end to end:
+ground truth generation and evaluation for every ground truth storage backend, and
+evaluation without precomputed ground truths. Every run is a separate process, so its
+peak resident set size (including its worker processes) can be reported.
+
+python3 benchmark.py --workdir /tmp/benchmark --sizes 1000 10000 100000
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import threading
+import subprocess
+from typing import List, Tuple
+import numpy as np
+import yaml
+from PIL import Image
+from tqdm import tqdm
+import util
+import storage
+import heatmaps
+
+EVAL_DIR = os.path.dirname(os.path.abspath(__file__))
+EVAL_SCRIPT = os.path.join(EVAL_DIR, "eval.py")
+# Mask image shape (Height x Width) and background color of CLEVR
+MASK_SHAPE = (320, 480)
+BACKGROUND_COLOR = [64, 64, 64]
+QUESTIONS_PER_IMAGE = 10
+# Objects are placed in distinct cells of a grid, so none of them is occluded
+GRID_CELL = 80
+# Ground truth storage backend -> ground truth path inside a dataset directory
+GROUND_TRUTH_BACKENDS = {
+    "directory": "gt/",
+    "npy": "gt.npy",
+    "packed": "gt.packed"
+}
+# Ground truths are computed during evaluation and saved to this directory
+ON_THE_FLY = "on_the_fly"
+DATASET_FILE = "dataset.json"
+
+
+def lin2srgb(img_arr: np.ndarray) -> np.ndarray:
+    """
+    Convert from linear RGB in [0,1] to sRGB in [0,255], the inverse of util.srgb2lin.
+    Blender saves the mask colors of the scene files in linear RGB and the mask images
+    in sRGB.
+    """
+    srgb = np.where(img_arr >= 0.0031308, 1.055 * img_arr**(1 / 2.4) - 0.055,
+                    12.92 * img_arr)
+    return np.round(srgb * 255).astype(np.uint8)
+
+
+def make_scene(rng: np.random.Generator, image: str) -> Tuple[dict, np.ndarray]:
+    """
+    Synthesizes a scene with 3 to 10 objects and its mask image. Every object is a
+    square or a disk with a distinct mask color inside its own grid cell.
+
+    Result
+    ---
+    dict
+        Scene dictionary
+    np.ndarray
+        Mask image (HxWxRGB, sRGB)
+    """
+    num_objects = int(rng.integers(3, 11))
+    mask_img = np.empty(MASK_SHAPE + (3,), dtype=np.uint8)
+    mask_img[:] = BACKGROUND_COLOR
+    rows, cols = np.ogrid[:MASK_SHAPE[0], :MASK_SHAPE[1]]
+    objects = []
+    used_colors = {tuple(BACKGROUND_COLOR)}
+    grid_shape = (MASK_SHAPE[0] // GRID_CELL, MASK_SHAPE[1] // GRID_CELL)
+    cells = rng.choice(grid_shape[0] * grid_shape[1], size=num_objects, replace=False)
+    for cell in cells:
+        while True:
+            mask_color = rng.random(3)
+            srgb = lin2srgb(mask_color)
+            if tuple(srgb) not in used_colors:
+                used_colors.add(tuple(srgb))
+                break
+        size = ["small", "large"][int(rng.integers(2))]
+        radius = int(
+            rng.integers(12, 24) if size == "small" else rng.integers(28, 40))
+        cell_y, cell_x = np.unravel_index(cell, grid_shape)
+        center_y = int(cell_y * GRID_CELL + rng.integers(radius, GRID_CELL - radius + 1))
+        center_x = int(cell_x * GRID_CELL + rng.integers(radius, GRID_CELL - radius + 1))
+        shape = ["cube", "sphere", "cylinder"][int(rng.integers(3))]
+        if shape == "sphere":
+            inside = (rows - center_y)**2 + (cols - center_x)**2 <= radius**2
+            mask_img[inside] = srgb
+        else:
+            mask_img[center_y - radius:center_y + radius,
+                     center_x - radius:center_x + radius] = srgb
+        objects.append({
+            "shape": shape,
+            "size": size,
+            "color": ["red", "blue", "green", "gray"][int(rng.integers(4))],
+            "material": ["rubber", "metal"][int(rng.integers(2))],
+            "mask_color": mask_color.tolist()
+        })
+    scene = {"image_filename": image + ".png", "objects": objects}
+    return scene, mask_img
+
+
+def make_program(rng: np.random.Generator, num_objects: int,
+                 template: int) -> Tuple[List[dict], str]:
+    """
+    Synthesizes a question program with the outputs of every function, following one
+    of three templates: a query about a unique object, a count over filtered objects
+    (which may be empty) and a comparison of two unique objects.
+
+    Result
+    ---
+    List[dict]
+        Program
+    str
+        Answer
+    """
+    scene_objects = list(range(num_objects))
+    if template == 0:
+        target = int(rng.integers(num_objects))
+        colored = sorted(
+            set(rng.choice(num_objects, size=int(rng.integers(1, num_objects)),
+                           replace=False).tolist()) | {target})
+        program = [{
+            "type": "scene",
+            "inputs": [],
+            "_output": scene_objects
+        }, {
+            "type": "filter_color",
+            "inputs": [0],
+            "_output": colored
+        }, {
+            "type": "filter_shape",
+            "inputs": [1],
+            "_output": [target]
+        }, {
+            "type": "unique",
+            "inputs": [2],
+            "_output": target
+        }, {
+            "type": "query_shape",
+            "inputs": [3],
+            "_output": "cube"
+        }]
+        return program, "cube"
+    if template == 1:
+        sized = sorted(
+            rng.choice(num_objects, size=int(rng.integers(0, num_objects)),
+                       replace=False).tolist())
+        matching = [obj for obj in sized if rng.random() < 0.5]
+        program = [{
+            "type": "scene",
+            "inputs": [],
+            "_output": scene_objects
+        }, {
+            "type": "filter_size",
+            "inputs": [0],
+            "_output": sized
+        }, {
+            "type": "filter_material",
+            "inputs": [1],
+            "_output": matching
+        }, {
+            "type": "count",
+            "inputs": [2],
+            "_output": len(matching)
+        }]
+        return program, str(len(matching))
+    first, second = rng.choice(num_objects, size=2, replace=False).tolist()
+    program = []
+    for obj in (first, second):
+        start = len(program)
+        program += [{
+            "type": "scene",
+            "inputs": [],
+            "_output": scene_objects
+        }, {
+            "type": "filter_color",
+            "inputs": [start],
+            "_output": [obj]
+        }, {
+            "type": "unique",
+            "inputs": [start + 1],
+            "_output": obj
+        }, {
+            "type": "query_color",
+            "inputs": [start + 2],
+            "_output": "red"
+        }]
+    program.append({"type": "equal_color", "inputs": [3, 7], "_output": True})
+    return program, "yes"
+
+
+def make_dataset(root: str,
+                 num_questions: int,
+                 heatmap_shape: Tuple[int, int] = (128, 128),
+                 heatmap_format: str = "files",
+                 seed: int = 0) -> dict:
+    """
+    Synthesizes a dataset with num_questions questions (QUESTIONS_PER_IMAGE per image)
+    at root. 80 percent of the predictions are correct. A dataset which was already
+    synthesized with the same parameters is reused.
+
+    Parameters
+    ---
+    root (str)
+        Dataset directory
+    num_questions (int)
+        Number of questions and predictions
+    heatmap_shape (Tuple[int, int])
+        Shape of the heatmaps
+    heatmap_format (str)
+        files (one npy file per question) or stack (see heatmaps.HeatmapStack)
+    seed (int)
+        Seed of the random generator
+
+    Result
+    ---
+    dict
+        Config of the dataset for eval.py (without ground_truth_path)
+    """
+    params = {
+        "num_questions": num_questions,
+        "heatmap_shape": list(heatmap_shape),
+        "heatmap_format": heatmap_format,
+        "seed": seed
+    }
+    if heatmap_format == "stack":
+        heatmap_path = os.path.join(root, "heatmaps.stack")
+    else:
+        heatmap_path = os.path.join(root, "heatmaps") + "/"
+    config = {
+        "question_file": os.path.join(root, "questions.json"),
+        "pred_file": os.path.join(root, "predictions.json"),
+        "scenes_path": os.path.join(root, "scenes") + "/",
+        "masks_path": os.path.join(root, "masks") + "/",
+        "heatmap_path": heatmap_path,
+        "heatmap_shape": list(heatmap_shape),
+        "background_color": BACKGROUND_COLOR,
+        "filters": ["unique", "first_nonempty"],
+        "target_all": False
+    }
+    dataset_file = os.path.join(root, DATASET_FILE)
+    if os.path.exists(dataset_file) and util.load_json(dataset_file) == params:
+        return config
+
+    rng = np.random.default_rng(seed)
+    for directory in (config["scenes_path"], config["masks_path"]):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    questions = []
+    predictions = []
+    num_images = (num_questions + QUESTIONS_PER_IMAGE - 1) // QUESTIONS_PER_IMAGE
+    print("Synthesizing %d images..." % num_images)
+    for image_idx in tqdm(range(num_images)):
+        image = "CLEVR_new_%06d" % image_idx
+        scene, mask_img = make_scene(rng, image)
+        util.save_json(scene, config["scenes_path"] + image + ".json")
+        Image.fromarray(mask_img).save(config["masks_path"] + image + ".png")
+        for _ in range(min(QUESTIONS_PER_IMAGE, num_questions - len(questions))):
+            template = int(rng.integers(3))
+            program, answer = make_program(rng, len(scene["objects"]), template)
+            ques_id = len(questions)
+            questions.append({
+                "image": image,
+                "image_index": image_idx,
+                "question_index": ques_id,
+                "question_family_index": template,
+                "template_filename": "synthetic_%d.json" % template,
+                "program": program,
+                "answer": answer
+            })
+            correct = rng.random() < 0.8
+            predictions.append({
+                "question_index": ques_id,
+                "answer": answer if correct else "wrong"
+            })
+    util.save_json({"info": {}, "questions": questions}, config["question_file"])
+    util.save_json(predictions, config["pred_file"])
+
+    print("Synthesizing %d heatmaps..." % num_questions)
+    if heatmap_format == "stack":
+        if not os.path.exists(heatmap_path):
+            os.makedirs(heatmap_path)
+        stack = np.lib.format.open_memmap(
+            os.path.join(heatmap_path, heatmaps.STACK_DATA_FILE),
+            mode="w+",
+            dtype=np.float32,
+            shape=(num_questions,) + tuple(heatmap_shape))
+        for start in tqdm(range(0, num_questions, 1024)):
+            end = min(start + 1024, num_questions)
+            stack[start:end] = rng.standard_normal(
+                (end - start,) + tuple(heatmap_shape), dtype=np.float32)
+        stack.flush()
+        np.save(os.path.join(heatmap_path, heatmaps.STACK_INDEX_FILE),
+                np.arange(num_questions, dtype=np.int64))
+    else:
+        if not os.path.exists(heatmap_path):
+            os.makedirs(heatmap_path)
+        for ques_id in tqdm(range(num_questions)):
+            np.save(heatmap_path + str(ques_id) + ".npy",
+                    rng.standard_normal(tuple(heatmap_shape), dtype=np.float32))
+    util.save_json(params, dataset_file)
+    return config
+
+
+def _tree_rss(pid: int) -> int:
+    """
+    Returns the current resident set size of a process and all its descendants in
+    bytes. Reads /proc, so it only works on Linux.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as file:
+                stat = file.read()
+        except OSError:
+            continue
+        # the command name in parentheses may contain spaces, the state and the
+        # parent pid follow it
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open("/proc/%d/statm" % current) as file:
+                total += int(file.read().split()[1]) * page_size
+        except OSError:
+            # exited in the meantime
+            pass
+    return total
+
+
+def run_eval(config: dict, config_path: str, eval_args: List[str]) -> Tuple[float, float]:
+    """
+    Runs eval.py with a config in a new process.
+
+    Parameters
+    ---
+    config (dict)
+        Config, saved to config_path
+    config_path (str)
+        Config file path
+    eval_args (List[str])
+        Further command line arguments of eval.py
+
+    Result
+    ---
+    float
+        Wall time in seconds
+    float
+        Peak resident set size of the process and its worker processes in MB. The
+        process tree is sampled every 50 ms, so short peaks of the workers may be
+        missed. Pages shared by the forked workers are counted once per process.
+    """
+    with open(config_path, "w") as file:
+        yaml.safe_dump(config, file)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, EVAL_SCRIPT, "--config", config_path] +
+                               eval_args,
+                               cwd=EVAL_DIR,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    # wait4 only reports the peak of eval.py itself, the worker processes are sampled
+    peak = [0]
+    done = threading.Event()
+
+    def sample() -> None:
+        while not done.wait(0.05):
+            peak[0] = max(peak[0], _tree_rss(process.pid))
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    output = process.stdout.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    if process.returncode != 0:
+        print(output.decode(errors="replace"))
+        exit("eval.py failed with exit code %d and config %s. Exiting..." %
+             (process.returncode, config_path))
+    # ru_maxrss is given in kilobytes on Linux
+    return seconds, max(usage.ru_maxrss * 1024, peak[0]) / 2**20
+
+
+def _remove_ground_truth(gt_path: str, filters: List[str]) -> None:
+    """
+    Removes a ground truth file or directory together with its fingerprints and
+    statistics, so it's computed from scratch.
+    """
+    stats_path = os.path.join(storage.get_stats_dir(gt_path),
+                              util.strip_special_chars(str(filters)) + "_stats.json")
+    for path in (gt_path, storage.get_fingerprint_path(gt_path), stats_path):
+        path = path.rstrip("/")
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def benchmark(workdir: str,
+              sizes: List[int],
+              backends: List[str],
+              workers: int = 1,
+              heatmap_shape: Tuple[int, int] = (128, 128),
+              heatmap_format: str = "files",
+              seed: int = 0) -> List[dict]:
+    """
+    Runs the benchmark for every size: ground truth generation (--no-evaluate) and
+    evaluation for every ground truth storage backend, and evaluation without
+    precomputed ground truths. Questions per second are computed over all questions
+    (ground truth generation) or all predictions (evaluation).
+
+    Parameters
+    ---
+    workdir (str)
+        Directory of the synthesized datasets, one subdirectory per size
+    sizes (List[int])
+        Number of questions of every dataset
+    backends (List[str])
+        Ground truth storage backends, see GROUND_TRUTH_BACKENDS
+    workers (int)
+        --workers of eval.py
+    heatmap_shape (Tuple[int, int])
+        Shape of the heatmaps
+    heatmap_format (str)
+        files or stack
+    seed (int)
+        Seed of the random generator
+
+    Result
+    ---
+    List[dict]
+        One record per run with the size, phase, backend, seconds, questions per second
+        and peak RSS in MB
+    """
+    records = []
+    eval_args = ["--workers", str(workers)]
+    for size in sizes:
+        root = os.path.join(workdir, str(size))
+        config = make_dataset(root,
+                              size,
+                              heatmap_shape=heatmap_shape,
+                              heatmap_format=heatmap_format,
+                              seed=seed)
+        runs = []
+        for backend in backends:
+            runs.append(("ground_truth", backend, GROUND_TRUTH_BACKENDS[backend],
+                         ["--no-evaluate"]))
+            runs.append(
+                ("evaluate", backend, GROUND_TRUTH_BACKENDS[backend], []))
+        runs.append(("evaluate", ON_THE_FLY, ON_THE_FLY + "/", []))
+        for phase, backend, gt_path, phase_args in runs:
+            gt_path = os.path.join(root, gt_path)
+            if phase == "ground_truth" or backend == ON_THE_FLY:
+                _remove_ground_truth(gt_path, config["filters"])
+            run_config = dict(config, ground_truth_path=gt_path)
+            config_path = os.path.join(root, "%s_%s.yaml" % (phase, backend))
+            seconds, peak_rss_mb = run_eval(run_config, config_path,
+                                            eval_args + phase_args)
+            record = {
+                "size": size,
+                "phase": phase,
+                "backend": backend,
+                "workers": workers,
+                "seconds": seconds,
+                "questions_per_second": size / seconds,
+                "peak_rss_mb": peak_rss_mb
+            }
+            records.append(record)
+            print("%8d  %-12s  %-10s  %8.2fs  %10.1f q/s  %8.1f MB" %
+                  (size, phase, backend, seconds,
+                   record["questions_per_second"], peak_rss_mb))
+            if backend == ON_THE_FLY:
+                _remove_ground_truth(gt_path, config["filters"])
+    return records
+
+
+def run():
+    """
+    Main function call.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the evaluation pipeline on synthetic data.")
+    parser.add_argument("--workdir",
+                        type=str,
+                        required=True,
+                        help="Directory of the synthesized datasets")
+    parser.add_argument("--sizes",
+                        type=int,
+                        nargs="+",
+                        default=[1000, 10000, 100000],
+                        help="Number of questions of every dataset")
+    parser.add_argument("--backends",
+                        type=str,
+                        nargs="+",
+                        default=list(GROUND_TRUTH_BACKENDS),
+                        choices=list(GROUND_TRUTH_BACKENDS),
+                        help="Ground truth storage backends")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="Number of worker processes of eval.py")
+    parser.add_argument("--heatmap-shape",
+                        type=int,
+                        nargs=2,
+                        default=[128, 128],
+                        help="Heatmap shape (Height Width)")
+    parser.add_argument("--heatmap-format",
+                        type=str,
+                        default="files",
+                        choices=["files", "stack"],
+                        help="One npy file per heatmap or a heatmap stack")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="JSON file for the results, by default <workdir>/benchmark.json")
+    cmd_args = parser.parse_args()
+
+    print("    size  phase         backend      seconds     throughput       peak RSS")
+    records = benchmark(cmd_args.workdir,
+                        cmd_args.sizes,
+                        cmd_args.backends,
+                        workers=cmd_args.workers,
+                        heatmap_shape=tuple(cmd_args.heatmap_shape),
+                        heatmap_format=cmd_args.heatmap_format,
+                        seed=cmd_args.seed)
+    output = cmd_args.output or os.path.join(cmd_args.workdir, "benchmark.json")
+    util.save_json(records, output)
+    print("Saved benchmark results to %s" % output)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,188 @@
+"""
+breakdown.py
+
+breakdown.py contains the grouped accuracy breakdowns. Per-question results are kept in
+columnar arrays and every grouping (template, question family, number of objects, ...)
+is reported with its mean and a bootstrap confidence interval. All resamples of all
+groups are computed at once with NumPy, without a Python loop per resample.
+"""
+
+from typing import Tuple
+import numpy as np
+
+# Question attributes the results are grouped by
+ATTRIBUTES = ("template_filename", "question_family_index", "num_objects",
+              "num_targets", "target_size")
+
+
+def group_codes(values: list) -> Tuple[list, np.ndarray]:
+    """
+    Encodes the group value of every question as an integer code.
+
+    Parameters
+    ---
+    values (list)
+        Group value per question (any JSON value)
+
+    Result
+    ---
+    list
+        Group names (the values as strings), sorted by value
+    np.ndarray
+        Code (index into the group names) per question
+    """
+    if all(
+            isinstance(value, (int, float, np.number))
+            and not isinstance(value, bool) for value in values):
+        # numeric groups are sorted by value, not by name
+        keys, codes = np.unique(np.asarray(values, dtype=np.float64),
+                                return_inverse=True)
+        names = ["%g" % key for key in keys]
+    else:
+        keys, codes = np.unique(np.array([str(value) for value in values]),
+                                return_inverse=True)
+        names = keys.tolist()
+    return names, codes.ravel()
+
+
+def bootstrap_group_means(
+        values: np.ndarray,
+        codes: np.ndarray,
+        num_groups: int,
+        resamples: int = 1000,
+        confidence: float = 0.95,
+        seed: int = 0,
+        max_block: int = 2**24
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Computes the mean of every group and a percentile bootstrap confidence interval,
+    resampling the questions within each group.
+    The questions are sorted by group, so a resample draws for every slot a random
+    question of the slot's group and the group sums are a single np.add.reduceat over
+    the resampled values. Resamples are drawn in blocks of at most max_block values.
+
+    Parameters
+    ---
+    values (np.ndarray)
+        Value per question, shape N
+    codes (np.ndarray)
+        Group code per question, shape N
+    num_groups (int)
+        Number of groups G
+    resamples (int)
+        Number of bootstrap resamples
+    confidence (float)
+        Confidence level of the interval
+    seed (int)
+        Seed of the random generator
+    max_block (int)
+        Maximum number of resampled values held in memory at once
+
+    Result
+    ---
+    np.ndarray
+        Number of questions per group, shape G
+    np.ndarray
+        Mean per group (NaN for empty groups), shape G
+    np.ndarray
+        Lower and upper bound of the confidence interval per group, shape G each
+    """
+    values = np.asarray(values, dtype=np.float64)
+    counts = np.bincount(codes, minlength=num_groups)
+    means = np.full(num_groups, np.nan)
+    nonempty = counts > 0
+    means[nonempty] = np.bincount(codes, weights=values,
+                                  minlength=num_groups)[nonempty] / counts[nonempty]
+    low = np.full(num_groups, np.nan)
+    high = np.full(num_groups, np.nan)
+    if len(values) == 0 or resamples <= 0:
+        return counts, means, low, high
+
+    order = np.argsort(codes, kind="stable")
+    sorted_values = values[order]
+    sorted_codes = codes[order]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    # first slot and size of the group of every slot
+    slot_starts = starts[sorted_codes]
+    slot_counts = counts[sorted_codes]
+    group_starts = starts[nonempty]
+
+    rng = np.random.default_rng(seed)
+    block = max(1, max_block // len(values))
+    boot_means = np.empty((resamples, int(nonempty.sum())))
+    for first in range(0, resamples, block):
+        num = min(block, resamples - first)
+        draws = slot_starts + (rng.random((num, len(values))) *
+                               slot_counts).astype(np.int64)
+        sums = np.add.reduceat(sorted_values[draws], group_starts, axis=1)
+        boot_means[first:first + num] = sums / counts[nonempty]
+
+    alpha = (1 - confidence) / 2
+    low[nonempty], high[nonempty] = np.quantile(boot_means, [alpha, 1 - alpha],
+                                                axis=0)
+    return counts, means, low, high
+
+
+def breakdown_report(values: dict,
+                     attributes: dict,
+                     resamples: int = 1000,
+                     confidence: float = 0.95,
+                     seed: int = 0) -> dict:
+    """
+    Builds the grouped breakdown of every result column.
+
+    Parameters
+    ---
+    values (dict)
+        Column name (e.g. method/metric) -> value per question, shape N. NaN marks
+        questions without a value, which are left out of that column's breakdown.
+    attributes (dict)
+        Attribute name -> group value per question (list of length N)
+    resamples (int)
+        Number of bootstrap resamples
+    confidence (float)
+        Confidence level of the intervals
+    seed (int)
+        Seed of the random generator
+
+    Result
+    ---
+    dict
+        Column name -> attribute -> list of groups, each with the group name, the
+        number of questions, the mean and the confidence interval. The attribute
+        "all" holds the overall mean.
+    """
+    encoded = {"all": (["all"], None)}
+    for attribute, group_values in attributes.items():
+        encoded[attribute] = group_codes(group_values)
+
+    report = {}
+    for column, column_values in values.items():
+        column_values = np.asarray(column_values, dtype=np.float64)
+        valid = ~np.isnan(column_values)
+        report[column] = {}
+        for attribute, (names, codes) in encoded.items():
+            if codes is None:
+                codes = np.zeros(len(column_values), dtype=np.int64)
+            counts, means, low, high = bootstrap_group_means(
+                column_values[valid],
+                codes[valid],
+                len(names),
+                resamples=resamples,
+                confidence=confidence,
+                seed=seed)
+            report[column][attribute] = [{
+                "group": name,
+                "count": int(counts[idx]),
+                "mean": _json_float(means[idx]),
+                "ci_low": _json_float(low[idx]),
+                "ci_high": _json_float(high[idx])
+            } for idx, name in enumerate(names) if counts[idx] > 0]
+    return report
+
+
+def _json_float(value: float) -> float:
+    """
+    Converts NaN to None, which is valid JSON.
+    """
+    return None if np.isnan(value) else float(value)
@@ -0,0 +1,243 @@
+"""
+cache.py
+
+cache.py contains a bounded per-image cache for scenes and mask images, so the
+questions about the same image don't decode the same files again.
+"""
+
+import os
+from collections import OrderedDict
+from typing import Tuple
+import numpy as np
+import util
+from profiling import Profiler
+
+
+class ImageCache():
+    """
+    Least recently used cache keyed by image name. Every entry holds the parsed scene
+    and, once requested, the decoded mask image together with the color mapping
+    returned by util.preprocess_mask_img.
+    The cache is bounded by an (approximate) memory cap: the size of an entry is the
+    size of its scene file plus the size of its arrays.
+    """
+
+    def __init__(self,
+                 scenes_path: str,
+                 masks_path: str,
+                 bg_color: np.ndarray,
+                 max_bytes: int = 512 * 2**20,
+                 profiler: Profiler = None):
+        """
+        Parameters
+        ---
+        scenes_path (str)
+            Scenes directory (prefix of <image>.json)
+        masks_path (str)
+            Masks directory (prefix of <image>.png)
+        bg_color (np.ndarray)
+            Background color RGB value of the mask images
+        max_bytes (int)
+            Memory cap of the cache in bytes. The most recently used entry is always kept.
+        profiler (Profiler)
+            Optional profiler recording the loading stages. The cache hits and misses
+            are counted by the cache itself (see stats) and forwarded to the profiler.
+        """
+        self.scenes_path = scenes_path
+        self.masks_path = masks_path
+        self.bg_color = np.asarray(bg_color)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.hits = {"scene": 0, "mask": 0}
+        self.misses = {"scene": 0, "mask": 0}
+        self.profiler = profiler if profiler is not None else Profiler()
+
+    def _count_hit(self, part: str) -> None:
+        self.hits[part] += 1
+        self.profiler.count(part + "_cache_hits")
+
+    def _count_miss(self, part: str) -> None:
+        self.misses[part] += 1
+        self.profiler.count(part + "_cache_misses")
+
+    def _get_entry(self, image: str, part: str) -> dict:
+        """
+        Returns the entry of an image, creating it with the parsed scene if necessary,
+        and marks it as most recently used. Counts a hit or miss for part.
+        """
+        entry = self.entries.get(image)
+        if entry is not None and entry[part] is not None:
+            self._count_hit(part)
+            self.entries.move_to_end(image)
+            return entry
+        self._count_miss(part)
+        if entry is None:
+            entry = self._add_scene(image, *self.load_scene(image))
+        self.entries.move_to_end(image)
+        return entry
+
+    def _add_scene(self, image: str, scene: dict, nbytes: int) -> dict:
+        """
+        Adds a new entry holding the parsed scene of an image.
+        """
+        entry = {"scene": scene, "mask": None, "nbytes": nbytes}
+        self.entries[image] = entry
+        self.nbytes += nbytes
+        return entry
+
+    def _add_mask(self, entry: dict, mask: tuple) -> None:
+        """
+        Stores the decoded mask image and color mapping in an entry.
+        """
+        entry["mask"] = mask
+        mask_bytes = sum(array.nbytes for array in mask)
+        entry["nbytes"] += mask_bytes
+        self.nbytes += mask_bytes
+
+    def _evict(self) -> None:
+        """
+        Drops least recently used entries until the cache fits its memory cap.
+        """
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.nbytes -= entry["nbytes"]
+
+    def get_scene(self, image: str) -> dict:
+        """
+        Returns the parsed scene of an image.
+
+        Parameters
+        ---
+        image (str)
+            Image name, e.g. CLEVR_new_000000
+
+        Result
+        ---
+        dict
+        """
+        entry = self._get_entry(image, "scene")
+        self._evict()
+        return entry["scene"]
+
+    def get_mask(self, image: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the decoded mask image of an image and its color mapping.
+
+        Parameters
+        ---
+        image (str)
+            Image name, e.g. CLEVR_new_000000
+
+        Result
+        ---
+        Tuple[np.ndarray, np.ndarray, np.ndarray]
+            mask image (HxWxRGB), unique colors and mapping as returned by
+            util.preprocess_mask_img
+        """
+        entry = self._get_entry(image, "mask")
+        if entry["mask"] is None:
+            self._add_mask(entry, self.load_mask(image, entry["scene"]))
+        self._evict()
+        return entry["mask"]
+
+    def peek(self, image: str, part: str):
+        """
+        Returns the cached scene or mask (part) of an image or None if it isn't cached.
+        Doesn't count as a hit or change the order of the entries.
+        """
+        entry = self.entries.get(image)
+        return None if entry is None else entry[part]
+
+    def load_scene(self, image: str) -> Tuple[dict, int]:
+        """
+        Reads the scene of an image without caching it. Safe to call from other threads.
+
+        Result
+        ---
+        dict
+            Parsed scene
+        int
+            Size of the scene file in bytes
+        """
+        scene_path = self.scenes_path + image + ".json"
+        with self.profiler.stage("scene_load") as stage:
+            scene = util.load_json(scene_path)
+            nbytes = _file_size(scene_path)
+            stage.add_bytes(nbytes)
+        return scene, nbytes
+
+    def load_mask(self, image: str,
+                  scene: dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Reads and decodes the mask image of an image without caching it. Safe to call
+        from other threads.
+
+        Result
+        ---
+        Tuple[np.ndarray, np.ndarray, np.ndarray]
+            See get_mask
+        """
+        mask_path = self.masks_path + image + ".png"
+        with self.profiler.stage("mask_decode") as stage:
+            mask_img = util.load_image_as_arr(mask_path)
+            stage.add_bytes(_file_size(mask_path))
+        with self.profiler.stage("mask_preprocess"):
+            unique_colors, mapping = util.preprocess_mask_img(
+                mask_img, util.get_mask_colors(scene), self.bg_color)
+        return mask_img, unique_colors, mapping
+
+    def add(self, image: str, scene: Tuple[dict, int] = None,
+            mask: tuple = None) -> None:
+        """
+        Adds a scene and/or mask which were loaded ahead of time (e.g. by a prefetcher
+        using load_scene and load_mask). They count as misses. Parts which are already
+        cached are kept.
+
+        Parameters
+        ---
+        image (str)
+            Image name, e.g. CLEVR_new_000000
+        scene (Tuple[dict, int])
+            Return value of load_scene
+        mask (tuple)
+            Return value of load_mask
+        """
+        entry = self.entries.get(image)
+        if entry is None:
+            if scene is None:
+                return
+            self._count_miss("scene")
+            entry = self._add_scene(image, *scene)
+        if mask is not None and entry["mask"] is None:
+            self._count_miss("mask")
+            self._add_mask(entry, mask)
+        self._evict()
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters, the hit rates and the current size.
+
+        Result
+        ---
+        dict
+        """
+        stats = {"entries": len(self.entries), "nbytes": self.nbytes}
+        for part in ("scene", "mask"):
+            total = self.hits[part] + self.misses[part]
+            stats[part] = {
+                "hits": self.hits[part],
+                "misses": self.misses[part],
+                "hit_rate": self.hits[part] / total if total else 0.0
+            }
+        return stats
+
+
+def _file_size(filepath: str) -> int:
+    """
+    Returns the size of a file in bytes or 0 if it doesn't exist.
+    """
+    try:
+        return os.path.getsize(filepath)
+    except OSError:
+        return 0
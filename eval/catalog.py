@@ -0,0 +1,264 @@
+"""
+catalog.py
+
+catalog.py contains an indexed question catalog used to join predictions against the
+Unique CLEVR questions without scanning the whole question list for every prediction.
+LazyQuestionCatalog offers the same interface but only keeps the byte offsets of the
+questions in memory and reads a question from the question file when it is accessed.
+"""
+
+import json
+from typing import Iterable, Iterator, List, Tuple
+import numpy as np
+import util
+
+
+class QuestionCatalog():
+    """
+    Indexed view over the questions of a Unique CLEVR question file.
+    The catalog is built once and keeps a primary index by question_index and
+    secondary indexes by image and question_family_index.
+    Iterating over the catalog yields the question dicts in file order.
+    """
+
+    def __init__(self, questions: List[dict]):
+        """
+        Build the catalog indexes.
+
+        Parameters
+        ---
+        questions (List[dict])
+            Question dicts as found in the "questions" list of the question file.
+        """
+        self.questions = []
+        self.by_index = {}
+        self.by_image = {}
+        self.by_family = {}
+        # question indices which occur more than once. Only the first occurrence is kept.
+        self.duplicates = []
+
+        for question in questions:
+            ques_id = question["question_index"]
+            if ques_id in self.by_index:
+                self.duplicates.append(ques_id)
+                continue
+            self.questions.append(question)
+            self.by_index[ques_id] = question
+            self.by_image.setdefault(question.get("image"), []).append(ques_id)
+            self.by_family.setdefault(question.get("question_family_index"),
+                                      []).append(ques_id)
+
+    def __len__(self) -> int:
+        return len(self.questions)
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self.questions)
+
+    def __contains__(self, ques_id: int) -> bool:
+        return ques_id in self.by_index
+
+    def __getitem__(self, ques_id: int) -> dict:
+        return self.by_index[ques_id]
+
+    def get(self, ques_id: int, default: dict = None) -> dict:
+        """
+        Returns the question with the given question_index or default if it doesn't exist.
+        """
+        return self.by_index.get(ques_id, default)
+
+    def image_questions(self, image: str) -> List[dict]:
+        """
+        Returns all questions asked about a single image.
+
+        Parameters
+        ---
+        image (str)
+            Image name as stored in the question file, e.g. CLEVR_new_000000
+
+        Result
+        ---
+        List[dict]
+        """
+        return [self[i] for i in self.by_image.get(image, [])]
+
+    def family_questions(self, family_index: int) -> List[dict]:
+        """
+        Returns all questions generated from a single question family (template).
+
+        Parameters
+        ---
+        family_index (int)
+            question_family_index of the template
+
+        Result
+        ---
+        List[dict]
+        """
+        return [self[i] for i in self.by_family.get(family_index, [])]
+
+    def iter_join(self, predictions: Iterable[dict], missing: List[int],
+                  duplicates: List[int]) -> Iterator[Tuple[dict, dict]]:
+        """
+        Lazily join predictions against the catalog by question_index.
+        Predictions without a matching question and repeated predictions for the same
+        question are appended to missing and duplicates while the pairs are consumed,
+        so they can be reported in bulk.
+
+        Parameters
+        ---
+        predictions (Iterable[dict])
+            Prediction dicts containing at least the question_index
+        missing (List[int])
+            Receives the question indices of predictions without a question in the
+            catalog
+        duplicates (List[int])
+            Receives the question indices which were predicted more than once. Only the
+            first prediction is kept.
+
+        Result
+        ---
+        Iterator[Tuple[dict, dict]]
+            (prediction, question) pairs in prediction order
+        """
+        seen = set()
+        for pred in predictions:
+            ques_id = pred["question_index"]
+            question = self.get(ques_id)
+            if question is None:
+                missing.append(ques_id)
+                continue
+            if ques_id in seen:
+                duplicates.append(ques_id)
+                continue
+            seen.add(ques_id)
+            yield pred, question
+
+    def join(
+        self, predictions: List[dict]
+    ) -> Tuple[List[Tuple[dict, dict]], List[int], List[int]]:
+        """
+        Join predictions against the catalog by question_index.
+        Predictions without a matching question and repeated predictions for the same
+        question are collected instead of raising, so they can be reported in bulk.
+
+        Parameters
+        ---
+        predictions (List[dict])
+            Prediction dicts containing at least the question_index
+
+        Result
+        ---
+        List[Tuple[dict, dict]]
+            (prediction, question) pairs in prediction order
+        List[int]
+            question indices of predictions without a question in the catalog
+        List[int]
+            question indices which were predicted more than once. Only the first
+            prediction is kept.
+        """
+        missing = []
+        duplicates = []
+        pairs = list(self.iter_join(predictions, missing, duplicates))
+        return pairs, missing, duplicates
+
+
+class LazyQuestionCatalog(QuestionCatalog):
+    """
+    Question catalog backed by the question file. Building the catalog streams the file
+    once and keeps the byte offsets of every question (sorted by question_index) and the
+    image and question_family_index indexes. Questions are parsed from the file when
+    they are accessed, so memory doesn't grow with the size of the questions.
+    Question files with the jsonl extension hold one question per line, all other files
+    are Unique CLEVR question files with a "questions" list.
+    """
+
+    def __init__(self, path: str):
+        """
+        Build the catalog indexes.
+
+        Parameters
+        ---
+        path (str)
+            Question file path
+        """
+        self.path = path
+        self.by_image = {}
+        self.by_family = {}
+        self.duplicates = []
+        self._file = None
+
+        ques_ids = []
+        starts = []
+        ends = []
+        seen = set()
+        for start, end, question in util.iter_json_records(path, key="questions"):
+            ques_id = question["question_index"]
+            if ques_id in seen:
+                self.duplicates.append(ques_id)
+                continue
+            seen.add(ques_id)
+            ques_ids.append(ques_id)
+            starts.append(start)
+            ends.append(end)
+            self.by_image.setdefault(question.get("image"), []).append(ques_id)
+            self.by_family.setdefault(question.get("question_family_index"),
+                                      []).append(ques_id)
+
+        # Offsets in file order, plus the permutation sorting them by question_index
+        self.file_index = np.array(ques_ids, dtype=np.int64)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.order = np.argsort(self.file_index, kind="stable")
+        self.sorted_index = self.file_index[self.order]
+
+    def __getstate__(self) -> dict:
+        # File handles can't be pickled, worker processes reopen the question file
+        state = self.__dict__.copy()
+        state["_file"] = None
+        return state
+
+    def _find(self, ques_id: int) -> int:
+        """
+        Returns the position of a question in the file or -1 if it's not in the catalog.
+        """
+        row = np.searchsorted(self.sorted_index, ques_id)
+        if row < len(self.sorted_index) and self.sorted_index[row] == ques_id:
+            return self.order[row]
+        return -1
+
+    def _read(self, position: int) -> dict:
+        """
+        Reads the question at a position in the file.
+        """
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        self._file.seek(self.starts[position])
+        return json.loads(self._file.read(self.ends[position] - self.starts[position]))
+
+    def __len__(self) -> int:
+        return len(self.file_index)
+
+    def __iter__(self) -> Iterator[dict]:
+        seen = set()
+        for _, _, question in util.iter_json_records(self.path, key="questions"):
+            if question["question_index"] not in seen:
+                seen.add(question["question_index"])
+                yield question
+
+    def __contains__(self, ques_id: int) -> bool:
+        return self._find(ques_id) >= 0
+
+    def __getitem__(self, ques_id: int) -> dict:
+        position = self._find(ques_id)
+        if position < 0:
+            raise KeyError(ques_id)
+        return self._read(position)
+
+    def get(self, ques_id: int, default: dict = None) -> dict:
+        """
+        Returns the question with the given question_index or default if it doesn't exist.
+        """
+        position = self._find(ques_id)
+        if position < 0:
+            return default
+        return self._read(position)
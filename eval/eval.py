@@ -6,13 +6,33 @@ eval.py runs the evaluation code for the Unique CLEVR dataset.
 
 import os
 import glob
+import time
+import json
+import hashlib
 import argparse
+import multiprocessing
 import yaml
 from tqdm import tqdm
 import numpy as np
 import util
+import storage
+import labelmaps
+import objectmasks
+import heatmaps
+import metrics
+import breakdown
+import prefetch
+import profiling
+import server
+import shards
+from results import ResultsLog
+from cache import ImageCache
+from catalog import QuestionCatalog, LazyQuestionCatalog
 from typing import Tuple
 
+# Number of heatmaps scored at once by evaluate()
+DEFAULT_BATCH_SIZE = 64
+
 
 class UniqueCLEVREvaluator():
     """
@@ -21,6 +41,9 @@ class UniqueCLEVREvaluator():
         1. Instantiate the class
         2. Call evaluate()
         3. Call get_overall_accuracy()
+
+    heatmap_path can be a single path or a mapping of attribution method name -> path.
+    All methods are evaluated in the same pass and share the ground truths.
     """
 
     def __init__(self, args: dict):
@@ -33,14 +56,95 @@ class UniqueCLEVREvaluator():
             Args with required information to evaluate the relevance performance on Uniqe CLEVR.
         """
         self.args = args
-        self.predictions = util.load_json(self.args["pred_file"])
-        self.questions = util.load_json(self.args["question_file"])["questions"]
+        # Records the time, calls and bytes read per stage if a profile output is given
+        self.profiler = profiling.Profiler(enabled="profile" in self.args)
+        # Predictions are streamed from pred_file by evaluate() unless they are set here
+        self.predictions = None
+        # With streaming, questions are read from the question file on access and the
+        # predictions are scored as they are read, in windows of stream_window questions
+        self.streaming = self.args.get("streaming", False)
+        self.stream_window = self.args.get("stream_window", 4096)
+        with self.profiler.stage("questions_load"):
+            if self.streaming:
+                self.questions = LazyQuestionCatalog(self.args["question_file"])
+            else:
+                self.questions = QuestionCatalog(
+                    util.load_questions(self.args["question_file"]))
+        util.report_ids("duplicate questions in the question file, keeping the first",
+                        self.questions.duplicates)
         self.accuracy = None
+        # set by evaluate(), used by the chunks it scores
+        self.batch_size = DEFAULT_BATCH_SIZE
         self.ground_truth = {}
         self.ground_truth_stats = {}
-        self.ground_truth_precomputed = self._try_load_ground_truth()
+        with self.profiler.stage("ground_truth_open"):
+            self.ground_truth_precomputed = self._try_load_ground_truth()
         self.target_all = self.args["target_all"]
         self.filters = self.args["filters"]
+        # Scenes and masks are shared by all questions about the same image.
+        # cache_max_mb limits the memory used by the cache (per worker process).
+        self.image_cache = ImageCache(
+            self.args["scenes_path"],
+            self.args["masks_path"],
+            self.args["background_color"],
+            max_bytes=int(self.args.get("cache_max_mb", 512) * 2**20),
+            profiler=self.profiler)
+        # Attribution method -> heatmap directory or stack, opened on first use
+        self.methods = util.get_heatmap_paths(self.args.get("heatmap_path"))
+        self.heatmap_sources = {}
+        # Ground truths are resized once per question and shared by all methods, so
+        # every method has to be scored at the same shape
+        if len(self.methods) > 1 and "heatmap_shape" not in self.args:
+            exit("Evaluating several attribution methods needs a heatmap_shape in the "
+                 "config. Exiting...")
+        # Metrics computed for every heatmap, mass_accuracy is always included
+        self.sweep = self.args.get("sweep")
+        if self.sweep is not None and "output" not in self.sweep:
+            exit("The sweep option needs an output path. Exiting...")
+        if "breakdown" in self.args and "output" not in self.args["breakdown"]:
+            exit("The breakdown option needs an output path. Exiting...")
+        self.metric_engine = metrics.MetricEngine(
+            self.args.get("metrics"),
+            sweep_thresholds=metrics.get_sweep_thresholds(self.sweep)
+            if self.sweep is not None else None,
+            profiler=self.profiler)
+        self.metric_values = None
+        # Per-question results as columns: question_index and method/metric values
+        # (NaN if the question has no value), in prediction order
+        self.result_columns = None
+        # Attribution method -> (question indices, curves) of the threshold sweep
+        self.sweep_curves = None
+        # Running means of the heatmaps scored with score() and score_batch()
+        self.running = metrics.RunningMeans()
+        # (shard index, number of shards) if only a shard of the predictions is
+        # evaluated, see shards.py. shard_by is image or question_index.
+        self.shard = None
+        self.shard_by = self.args.get("shard_by", "image")
+        if self.shard_by not in shards.SHARD_KEYS:
+            exit("Unknown shard_by %s, expected one of %s. Exiting..." %
+                 (self.shard_by, ", ".join(shards.SHARD_KEYS)))
+        # Position in the prediction file -> scores and question_index of the last
+        # evaluation (or merge)
+        self.results = None
+        self.ques_ids = None
+        # Optional precomputed object label maps (see --build-label-maps)
+        self.label_maps = labelmaps.open_label_maps(
+            self.args.get("label_maps_path"))
+        # Optional per-object masks (see --build-object-masks). Ground truths of the
+        # archive's shape are computed from them and not remembered or saved.
+        self.object_masks = objectmasks.open_object_masks(
+            self.args.get("object_masks_path"))
+        # Optional prefetching of the heatmaps, scenes and masks of upcoming questions
+        # in a thread pool (see prefetch.py), created on first use in every process
+        self.prefetch = self.args.get("prefetch")
+        if self.prefetch is True:
+            self.prefetch = {}
+        self.prefetcher = None
+        # image -> part (scene or mask) -> position of the prefetched prediction which
+        # reads it, so questions about the same image don't read it again
+        self.prefetch_requests = {}
+        # Counters of all prefetchers of the last evaluation, see Prefetcher.pop_stats
+        self.prefetch_stats = None
 
     def _try_load_ground_truth(self) -> bool:
         """
@@ -51,22 +155,14 @@ class UniqueCLEVREvaluator():
         ---
         bool
         """
-        gt_path = self.args["ground_truth_path"]
-        single = util.is_numpy_file(gt_path)
-
-        if single:
-            try:
-                self.ground_truth = np.load(gt_path, allow_pickle=True)[()]
-            except FileNotFoundError:
-                return False
-        else:
-            files = glob.glob(os.path.join(gt_path, "*.npy"))
-            if not files:
-                return False
-            for file in files:
-                idx = os.path.splitext(os.path.basename(file))[0]
-                self.ground_truth[int(idx)] = np.load(file)
-
+        # ground_truth_cache bounds the number of ground truths kept in memory when
+        # they are loaded lazily from a ground truth directory
+        ground_truth = storage.open_ground_truth(
+            self.args["ground_truth_path"],
+            cache_size=self.args.get("ground_truth_cache", 1024))
+        if ground_truth is None:
+            return False
+        self.ground_truth = ground_truth
         return True
 
     def _calc_ground_truth_stats(self) -> None:
@@ -81,8 +177,7 @@ class UniqueCLEVREvaluator():
         for ques in tqdm(self.questions, total=len(self.questions)):
             ques_id = ques["question_index"]
             program = ques["program"]
-            scene = util.load_json(self.args["scenes_path"] + ques["image"] +
-                               ".json")
+            scene = self.image_cache.get_scene(ques["image"])
             objects = scene["objects"]
 
             # get target object
@@ -117,8 +212,10 @@ class UniqueCLEVREvaluator():
     def save_ground_truth(self, save_stats: bool = True) -> None:
         """
         Saves the ground truths to disk. If the ground truth path has a npy extension,
-        all ground truths are saved in a single file. Otherwise, it's saved in a directory
-        with file corresponding to a single question with name == question_index.npy
+        all ground truths are saved in a single file. If it has a packed extension, they
+        are saved bit-packed in a single memory-mappable file with an offset index.
+        Otherwise, it's saved in a directory with file corresponding to a single question
+        with name == question_index.npy
 
 
         Parameters
@@ -130,26 +227,59 @@ class UniqueCLEVREvaluator():
         ---
         None
         """
-        gt_path = self.args["ground_truth_path"]
-
-        single = util.is_numpy_file(gt_path)
-
-        if single:
-            # save as single file
-            np.save(gt_path, self.ground_truth)
-        else:
-            # save as multiple individual files
-            if not os.path.exists(gt_path):
-                os.makedirs(gt_path)
+        with self.profiler.stage("ground_truth_save"):
+            writer = storage.open_ground_truth_writer(
+                self.args["ground_truth_path"])
             for key in self.ground_truth.keys():
-                file_path = os.path.join(gt_path, str(key) + ".npy")
-                np.save(file_path, self.ground_truth[key])
+                writer.write(key, self.ground_truth[key])
+            writer.close()
 
         if save_stats:
-            stats_file_path = os.path.join(
-                gt_path,
-                util.strip_special_chars(str(self.filters)) + "_stats.json")
-            util.save_json(self.ground_truth_stats, stats_file_path)
+            self._save_ground_truth_stats()
+
+    def save_added_ground_truth(self) -> None:
+        """
+        Appends the ground truths which were computed for questions missing from the
+        precomputed ground truths (e.g. while serving) to the store at
+        ground_truth_path.
+        """
+        # Stores opened from disk keep added ground truths apart, a single ground truth
+        # file is a dict which is rewritten as a whole anyway
+        added = getattr(self.ground_truth, "added", self.ground_truth)
+        if len(added) == 0:
+            return
+        with self.profiler.stage("ground_truth_save"):
+            writer = storage.open_ground_truth_writer(
+                self.args["ground_truth_path"], append=True)
+            for ques_id, ground_truth in added.items():
+                writer.write(ques_id, ground_truth)
+            writer.close()
+        print("Saved the added ground truths to %s" % self.args["ground_truth_path"])
+
+    def _save_ground_truth_stats(self, removed: set = frozenset()) -> None:
+        """
+        Saves the ground truth statistics (JSON) next to the ground truths.
+
+        Parameters
+        ---
+        removed (set)
+            question indices whose ground truths were removed. Their statistics are
+            dropped.
+        """
+        stats_file_path = os.path.join(
+            storage.get_stats_dir(self.args["ground_truth_path"]),
+            util.strip_special_chars(str(self.filters)) + "_stats.json")
+        # Keep the statistics of ground truths computed by previous runs
+        stats = {}
+        if os.path.exists(stats_file_path):
+            stats = util.load_json(stats_file_path)
+        for ques_id in removed:
+            stats.pop(str(ques_id), None)
+        stats.update({
+            str(ques_id): ques_stats
+            for ques_id, ques_stats in self.ground_truth_stats.items()
+        })
+        util.save_json(stats, stats_file_path)
 
     def calculate_ground_truth(self, question: dict) -> Tuple[np.ndarray, dict]:
         """
@@ -168,33 +298,105 @@ class UniqueCLEVREvaluator():
             Ground truth statistics. Currently only return number
             of target objects and total number of objects in the scene.
         """
-        scene = util.load_json(self.args["scenes_path"] + question["image"] +
-                               ".json")
+        scene, target_objects, target_objects_indices = self._get_target_objects(
+            question)
+        # Skip questions where there's no target object, ie for exist and count
+        # questions with answer False or 0
+        if len(target_objects) == 0:
+            print(
+                "No target objects found, skipping this question (qid:%d)..." %
+                (question["question_index"]))
+            return None, None
+
+        if self.label_maps is not None and question["image"] in self.label_maps:
+            # Pixels of the label map hold the object index
+            with self.profiler.stage("ground_truth_labels"):
+                labels = self.label_maps[question["image"]]
+                ground_truth = np.isin(labels, target_objects_indices)
+        else:
+            ground_truth = self._ground_truth_from_mask(question["image"],
+                                                        target_objects_indices)
+
+        ground_truth_stats = {
+            "target_objects": len(target_objects),
+            "total_objects": len(scene["objects"])
+        }
+        return ground_truth, ground_truth_stats
+
+    def _get_target_objects(self, question: dict) -> Tuple[dict, list, list]:
+        """
+        Returns the scene of a question, its target objects and their indices in the
+        scene according to filters (or all objects if target_all is set).
+        """
+        scene = self.image_cache.get_scene(question["image"])
         if self.target_all:
             target_objects, target_objects_indices = scene["objects"], [
                 i for i in range(len(scene["objects"]))
             ]
         else:
-            target_objects, target_objects_indices = util.get_target_objects(
-                scene["objects"], question["program"], filters=self.filters)
-        # Skip questions where there's no target object, ie for exist and count
-        # questions with answer False or 0
+            with self.profiler.stage("target_objects"):
+                target_objects, target_objects_indices = util.get_target_objects(
+                    scene["objects"], question["program"], filters=self.filters)
+        return scene, target_objects, target_objects_indices
+
+    def _uses_object_masks(self, question: dict,
+                           resize_shape: Tuple[int, int]) -> bool:
+        """
+        Returns True if the ground truth of a question with the given shape can be
+        computed from the object mask archive.
+        """
+        return (self.object_masks is not None
+                and question["image"] in self.object_masks
+                and self.object_masks.shape == tuple(resize_shape))
+
+    def _object_mask_ground_truth(self, question: dict) -> Tuple[np.ndarray, dict]:
+        """
+        Computes the ground truth of a question as the union of the object masks of its
+        target objects. The ground truth has the shape of the object mask archive.
+
+        Result
+        ---
+        np.ndarray
+            Boolean ground truth. None if the question has no target objects.
+        dict
+            Ground truth statistics, see calculate_ground_truth
+        """
+        scene, target_objects, target_objects_indices = self._get_target_objects(
+            question)
         if len(target_objects) == 0:
             print(
                 "No target objects found, skipping this question (qid:%d)..." %
                 (question["question_index"]))
             return None, None
+        with self.profiler.stage("ground_truth_object_masks"):
+            ground_truth = self.object_masks.ground_truth(
+                question["image"], target_objects_indices)
+        ground_truth_stats = {
+            "target_objects": len(target_objects),
+            "total_objects": len(scene["objects"])
+        }
+        return ground_truth, ground_truth_stats
 
-        # load ground truth mask
-        mask_img_path = self.args["masks_path"] + question["image"] + ".png"
-        mask_img = util.load_image_as_arr(mask_img_path)
-        # get mask colors
-        mask_colors = util.get_mask_colors(scene)
-        # background color
-        bg_color = np.asarray(self.args["background_color"])
+    def _ground_truth_from_mask(self, image: str,
+                                target_objects_indices: list) -> np.ndarray:
+        """
+        Calculates the ground truth by comparing the mask image against the colors of
+        the target objects.
 
-        unique_colors, mapping = util.preprocess_mask_img(
-            mask_img, mask_colors, bg_color)
+        Parameters
+        ---
+        image (str)
+            Image name
+        target_objects_indices (list)
+            Indices of the target objects in the scene
+
+        Result
+        ---
+        np.ndarray
+            Ground truth boolean array of shape HxW
+        """
+        # load ground truth mask and map the scene's mask colors to the mask image colors
+        mask_img, unique_colors, mapping = self.image_cache.get_mask(image)
 
         target_colors = [
             unique_colors[mapping[i]] for i in target_objects_indices
@@ -202,47 +404,436 @@ class UniqueCLEVREvaluator():
 
         # Calculate ground truth as bool array
         # Ignore alpha channel
-        ground_truth_shape = mask_img.shape[0:2]
-        ground_truth = np.full(ground_truth_shape, False, dtype=bool)
-        for target_color in target_colors:
-            # Compare target color RGB val against mask img RGB vals
-            target_mask = np.all(mask_img == target_color, axis=-1)
-            # Add to current ground truth
-            ground_truth = np.logical_or(ground_truth, target_mask)
+        with self.profiler.stage("ground_truth_mask"):
+            ground_truth_shape = mask_img.shape[0:2]
+            ground_truth = np.full(ground_truth_shape, False, dtype=bool)
+            for target_color in target_colors:
+                # Compare target color RGB val against mask img RGB vals
+                target_mask = np.all(mask_img == target_color, axis=-1)
+                # Add to current ground truth
+                ground_truth = np.logical_or(ground_truth, target_mask)
+        return ground_truth
+
+    def build_label_maps(self) -> None:
+        """
+        Converts the mask images of all images in the question file to object label maps
+        and saves them to label_maps_path. Afterwards ground truths are computed from
+        the label maps instead of the mask images.
 
-        ground_truth_stats = {
-            "target_objects": len(target_objects),
-            "total_objects": len(scene["objects"])
-        }
-        return ground_truth, ground_truth_stats
+        Result
+        ---
+        None
+        """
+        if "label_maps_path" not in self.args:
+            exit("No label_maps_path given in the config, exiting...")
+        labelmaps.build_label_maps(self.args["label_maps_path"],
+                                   list(self.questions.by_image.keys()),
+                                   self.image_cache)
+        self.label_maps = labelmaps.open_label_maps(
+            self.args["label_maps_path"])
+
+    def build_object_masks(self) -> None:
+        """
+        Splits the mask images of all images in the question file into per-object masks
+        of heatmap_shape and saves them to object_masks_path. Afterwards ground truths
+        of that shape, for any filters, are computed from the object masks.
 
-    def calculate_all_ground_truths(self) -> None:
+        Result
+        ---
+        None
+        """
+        if "object_masks_path" not in self.args:
+            exit("No object_masks_path given in the config, exiting...")
+        if "heatmap_shape" not in self.args:
+            exit("Object masks need a heatmap_shape in the config, exiting...")
+        objectmasks.build_object_masks(self.args["object_masks_path"],
+                                       list(self.questions.by_image.keys()),
+                                       self.image_cache,
+                                       self.args["heatmap_shape"],
+                                       label_maps=self.label_maps)
+        self.object_masks = objectmasks.open_object_masks(
+            self.args["object_masks_path"])
+
+    def calculate_all_ground_truths(self,
+                                    workers: int = 1,
+                                    chunk_size: int = 64) -> None:
         """
-        Calculates the ground truths for all questions in the dataset.
+        Calculates the ground truths for all questions in the dataset which don't have
+        an up to date ground truth at ground_truth_path yet.
+        A ground truth is up to date if the fingerprint of its inputs (scene file, mask
+        file, question program, filters, target_all and heatmap_shape) matches the
+        fingerprint saved with it. Ground truths which were saved without fingerprint
+        are assumed to be up to date and get their fingerprint now. Missing and stale
+        ground truths are (re)computed, all others are left untouched. Stale ground
+        truths of questions which no longer have target objects are removed together
+        with their statistics.
+        The questions are split into chunks of questions about the same images, which
+        are processed in a process pool if workers > 1. Finished ground truths are
+        written straight to the ground truth store instead of being collected in
+        self.ground_truth, and the store is flushed every checkpoint_every ground
+        truths. The ground truth statistics are saved at the end.
+
+        Parameters
+        ---
+        workers (int)
+            Number of worker processes. 1 computes in the current process.
+        chunk_size (int)
+            Number of questions per work unit.
 
         Result
         ---
         None
         """
-        if self.ground_truth_precomputed:
-            exit("Existing ground truth found at %s, exiting..." %
-                 self.args["ground_truth_path"])
+        start = time.perf_counter()
+        gt_path = self.args["ground_truth_path"]
+        fingerprints = storage.load_fingerprints(gt_path)
 
-        print("Calculating all ground truths...")
-        for ques in tqdm(self.questions, total=len(self.questions)):
+        def make_item(ques: dict) -> tuple:
+            # (question, expected fingerprint, adopt ground truth without fingerprint)
             ques_id = ques["question_index"]
-            ground_truth, ground_truth_stats = self.calculate_ground_truth(ques)
-            if ground_truth is None:
+            stored = self.ground_truth_precomputed and ques_id in self.ground_truth
+            if ques_id in fingerprints:
+                fingerprint, has_ground_truth = fingerprints[ques_id]
+                if stored or not has_ground_truth:
+                    return ques, fingerprint, False
+                return ques, None, False
+            return ques, None, stored
+
+        print("Calculating all ground truths...")
+        chunks = util.iter_chunks(
+            (make_item(ques) for ques in self.questions),
+            chunk_size,
+            key=lambda item: item[0]["image"],
+            window=self.stream_window if self.streaming else None)
+        writer = storage.open_ground_truth_writer(gt_path, append=True)
+        checkpoint_every = self.args.get("checkpoint_every", 1000)
+        computed = 0
+        pending = 0
+        removed = set()
+        with tqdm(total=len(self.questions)) as progress:
+            for chunk_results in self._map_chunks("_ground_truth_chunk", chunks,
+                                                  workers):
+                for ques_id, fingerprint, is_computed, ground_truth, \
+                        ground_truth_stats in chunk_results:
+                    if not is_computed:
+                        has_ground_truth = fingerprints.get(ques_id, (None, True))[1]
+                        fingerprints[ques_id] = (fingerprint, has_ground_truth)
+                        if not has_ground_truth and ques_id in self.ground_truth:
+                            # left behind by an earlier run
+                            writer.remove(ques_id)
+                            removed.add(ques_id)
+                        continue
+                    computed += 1
+                    pending += 1
+                    fingerprints[ques_id] = (fingerprint, ground_truth is not None)
+                    if ground_truth is None:
+                        # a stale ground truth would still be scored against
+                        writer.remove(ques_id)
+                        self.ground_truth_stats.pop(ques_id, None)
+                        removed.add(ques_id)
+                        continue
+                    writer.write(ques_id, ground_truth)
+                    self.ground_truth_stats[ques_id] = ground_truth_stats
+                if pending >= checkpoint_every:
+                    writer.flush()
+                    storage.save_fingerprints(gt_path, fingerprints)
+                    pending = 0
+                progress.update(len(chunk_results))
+        writer.close()
+        storage.save_fingerprints(gt_path, fingerprints)
+        print("Computed %d ground truths, %d were up to date" %
+              (computed, len(self.questions) - computed))
+
+        self._save_ground_truth_stats(removed=removed)
+        self.ground_truth_precomputed = True
+        self.profiler.record("calculate_all_ground_truths",
+                             time.perf_counter() - start)
+
+    def _ground_truth_fingerprint(self, question: dict, file_digests: dict) -> bytes:
+        """
+        Returns the fingerprint of the inputs of a question's ground truth: the contents
+        of the scene and mask files, the question program, filters, target_all and
+        heatmap_shape.
+
+        Parameters
+        ---
+        question (dict)
+            Question dictionary
+        file_digests (dict)
+            Image -> digest of its scene and mask files. Filled on first use.
+
+        Result
+        ---
+        bytes
+        """
+        image = question["image"]
+        if image not in file_digests:
+            file_digests[image] = util.file_digest(
+                self.args["scenes_path"] + image + ".json") + util.file_digest(
+                    self.args["masks_path"] + image + ".png")
+        config = json.dumps([
+            question["program"], self.filters, self.target_all,
+            self.args.get("heatmap_shape")
+        ],
+                            sort_keys=True)
+        return hashlib.blake2b(file_digests[image] + config.encode(),
+                               digest_size=16).digest()
+
+    def _ground_truth_chunk(self, chunk: list) -> list:
+        """
+        Calculates the (resized) ground truths for a chunk of
+        (question, expected fingerprint, adopt) items. A ground truth is only computed
+        if its fingerprint differs from the expected one and it isn't adopted.
+
+        Result
+        ---
+        list
+            (question_index, fingerprint, computed, ground_truth, ground_truth_stats)
+            tuples. ground_truth is None for questions without target objects and for
+            questions which weren't computed.
+        """
+        results = []
+        file_digests = {}
+        for ques, expected, adopt in chunk:
+            with self.profiler.stage("ground_truth_fingerprint"):
+                fingerprint = self._ground_truth_fingerprint(ques, file_digests)
+            if adopt or fingerprint == expected:
+                results.append(
+                    (ques["question_index"], fingerprint, False, None, None))
                 continue
-            if "heatmap_shape" in self.args:
-                resize_shape = self.args["heatmap_shape"]
-                ground_truth = util.resize_ground_truth(ground_truth,
-                                                        resize_shape)
+            if ("heatmap_shape" in self.args
+                    and self._uses_object_masks(ques, self.args["heatmap_shape"])):
+                ground_truth, ground_truth_stats = self._object_mask_ground_truth(
+                    ques)
+            else:
+                ground_truth, ground_truth_stats = self.calculate_ground_truth(ques)
+                if ground_truth is not None and "heatmap_shape" in self.args:
+                    resize_shape = self.args["heatmap_shape"]
+                    with self.profiler.stage("ground_truth_resize"):
+                        ground_truth = util.resize_ground_truth(
+                            ground_truth, resize_shape)
+            results.append((ques["question_index"], fingerprint, True,
+                            ground_truth, ground_truth_stats))
+        return results
+
+    def _map_chunks(self, method: str, chunks: list, workers: int):
+        """
+        Applies an evaluator method to every chunk and yields the results as they
+        finish. With workers > 1 the chunks are processed in a process pool, where
+        every worker holds its own copy of the evaluator.
+
+        Parameters
+        ---
+        method (str)
+            Name of the evaluator method that processes a single chunk
+        chunks (Iterable[list])
+            Work units
+        workers (int)
+            Number of worker processes
+        """
+        if workers <= 1:
+            for chunk in chunks:
+                yield getattr(self, method)(chunk)
+            return
+        with multiprocessing.Pool(workers,
+                                  initializer=_init_worker,
+                                  initargs=(self,)) as pool:
+            # chunks may be a generator, so tasks are created as the pool consumes them
+            tasks = ((method, chunk) for chunk in chunks)
+            for chunk_results, profile in pool.imap_unordered(
+                    _call_worker, tasks):
+                self.profiler.merge(profile)
+                yield chunk_results
+
+    def _load_heatmap(self, ques_id: int, method: str) -> np.ndarray:
+        """
+        Loads the heatmap of a question from the heatmap path of an attribution method.
+        For heatmap stacks this is a zero-copy slice of the memory-mapped stack.
+        """
+        with self.profiler.stage("heatmap_load") as stage:
+            heatmap = self._heatmap_source(method)[ques_id]
+            stage.add_bytes(heatmap.nbytes)
+        return heatmap
 
-            self.ground_truth[ques_id] = ground_truth
-            self.ground_truth_stats[ques_id] = ground_truth_stats
+    def _heatmap_source(self, method: str):
+        """
+        Returns the heatmap directory or stack of an attribution method.
+        """
+        if method not in self.heatmap_sources:
+            self.heatmap_sources[method] = heatmaps.open_heatmaps(
+                self.methods[method])
+        return self.heatmap_sources[method]
 
-    def eval_single(self, prediction: dict, question: dict) -> float:
+    def _get_prefetcher(self) -> prefetch.Prefetcher:
+        """
+        Returns the prefetcher of this process, None if prefetching is disabled.
+        """
+        if self.prefetch is None:
+            return None
+        if self.prefetcher is None:
+            # the heatmap sources are opened here, the prefetch threads only read them
+            for method in self.methods:
+                self._heatmap_source(method)
+            self.prefetcher = prefetch.Prefetcher(
+                self._read_question_data,
+                depth=self.prefetch.get("depth", 128),
+                threads=self.prefetch.get("threads", 4))
+        return self.prefetcher
+
+    def _prefetch_items(self, items: list) -> None:
+        """
+        Submits (position, prediction, question) items to the prefetcher. The heatmaps
+        are always read. The scene and mask are only read if they're needed for the
+        ground truth, aren't cached and aren't read for an earlier item already.
+        """
+        prefetcher = self._get_prefetcher()
+        resize_shape = self.args.get("heatmap_shape")
+        if resize_shape is None and self.object_masks is not None:
+            # assume the heatmaps have the shape of the object masks
+            resize_shape = self.object_masks.shape
+        for position, _, question in items:
+            if position in prefetcher:
+                continue
+            ques_id = question["question_index"]
+            image = question["image"]
+            uses_object_masks = (resize_shape is not None and
+                                 self._uses_object_masks(question, resize_shape))
+            compute = not uses_object_masks and ques_id not in self.ground_truth
+            parts = []
+            if uses_object_masks or compute:
+                parts.append("scene")
+            if compute and (self.label_maps is None
+                            or image not in self.label_maps):
+                parts.append("mask")
+            requests = self.prefetch_requests.setdefault(image, {})
+            parts = [
+                part for part in parts if part not in requests
+                and self.image_cache.peek(image, part) is None
+            ]
+            for part in parts:
+                requests[part] = position
+            prefetcher.submit(position, ques_id, image,
+                              self.image_cache.peek(image, "scene"), parts)
+
+    def _prefetch_chunks(self, chunks):
+        """
+        Yields the chunks, submitting every chunk to the prefetcher before the previous
+        one is evaluated.
+        """
+        previous = None
+        for chunk in chunks:
+            self._prefetch_items(chunk)
+            if previous is not None:
+                yield previous
+            previous = chunk
+        if previous is not None:
+            yield previous
+
+    def _read_question_data(self, ques_id: int, image: str, scene: dict,
+                            parts: list) -> dict:
+        """
+        Reads the heatmaps of a question and the requested parts (scene, mask) of its
+        image. Runs in a prefetch thread, so the caches aren't touched.
+
+        Parameters
+        ---
+        ques_id (int)
+            question_index
+        image (str)
+            Image name
+        scene (dict)
+            Cached scene of the image, needed to decode the mask. May be None.
+        parts (list)
+            Parts of the image to read
+
+        Result
+        ---
+        dict
+            heatmaps (method -> heatmap), scene (see ImageCache.load_scene) and mask
+            (see ImageCache.load_mask). Parts which weren't read are None.
+        """
+        data = {"heatmaps": {}, "scene": None, "mask": None}
+        for method in self.methods:
+            with self.profiler.stage("heatmap_load") as stage:
+                heatmap = self.heatmap_sources[method][ques_id]
+                if isinstance(heatmap, np.memmap):
+                    # read slices of heatmap stacks here instead of on first access
+                    heatmap = np.array(heatmap)
+                stage.add_bytes(heatmap.nbytes)
+            data["heatmaps"][method] = heatmap
+        if "scene" in parts or ("mask" in parts and scene is None):
+            data["scene"] = self.image_cache.load_scene(image)
+            scene = data["scene"][0]
+        if "mask" in parts:
+            data["mask"] = self.image_cache.load_mask(image, scene)
+        return data
+
+    def _take_prefetched(self, position: int, question: dict) -> dict:
+        """
+        Takes the prefetched data of an item, adds its scene and mask to the image cache
+        and returns its heatmaps (method -> heatmap).
+        """
+        data = self.prefetcher.take(position)
+        image = question["image"]
+        self.image_cache.add(image, scene=data["scene"], mask=data["mask"])
+        requests = self.prefetch_requests.get(image, {})
+        for part in [part for part, requester in requests.items()
+                     if requester == position]:
+            del requests[part]
+        if not requests:
+            self.prefetch_requests.pop(image, None)
+        return data["heatmaps"]
+
+    def _get_ground_truth(self, question: dict,
+                          heatmap_shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Returns the ground truth of a question. If it isn't precomputed it's calculated,
+        resized to heatmap_shape (or the configured heatmap_shape) and remembered.
+        If there are object masks of that shape, the ground truth is always computed
+        from them (for the configured filters) and not remembered.
+
+        Parameters
+        ---
+        question (dict)
+            Question dictionary
+        heatmap_shape (Tuple[int, int])
+            Shape of the heatmap the ground truth is compared to
+
+        Result
+        ---
+        np.ndarray
+            Boolean ground truth. None if the question has no target objects.
+        """
+        ques_id = question["question_index"]
+        if "heatmap_shape" in self.args:
+            resize_shape = self.args["heatmap_shape"]
+        else:
+            resize_shape = heatmap_shape
+        if self._uses_object_masks(question, resize_shape):
+            self.profiler.count("ground_truths_from_object_masks")
+            return self._object_mask_ground_truth(question)[0]
+
+        # Get ground truth if it's already computed.
+        if ques_id in self.ground_truth:
+            self.profiler.count("ground_truths_stored")
+            with self.profiler.stage("ground_truth_load") as stage:
+                ground_truth = self.ground_truth[ques_id]
+                stage.add_bytes(ground_truth.nbytes)
+            return ground_truth
+
+        self.profiler.count("ground_truths_computed")
+        ground_truth, _ = self.calculate_ground_truth(question)
+        if ground_truth is None:
+            return None
+        with self.profiler.stage("ground_truth_resize"):
+            ground_truth = util.resize_ground_truth(ground_truth, resize_shape)
+        self.ground_truth[ques_id] = ground_truth
+        return ground_truth
+
+    def eval_single(self,
+                    prediction: dict,
+                    question: dict,
+                    method: str = None) -> float:
         """
         Evaluates performance on a single heatmap-answer pair.
 
@@ -255,6 +846,8 @@ class UniqueCLEVREvaluator():
         question (dict)
             Question dictionary item from that is generated from the CLEVR generated questions.
             (Ground truth)
+        method (str)
+            Attribution method whose heatmap is evaluated. Defaults to the first method.
 
         Result
         ---
@@ -263,27 +856,190 @@ class UniqueCLEVREvaluator():
             over all relevance.
         """
 
-        heatmap = util.load_heatmap(self.args["heatmap_path"] +
-                                    str(prediction["question_index"]) + ".npy")
-        # Get ground truth if it's already computed.
-        if question["question_index"] in self.ground_truth:
-            ground_truth = self.ground_truth[question["question_index"]]
-        else:
-            ground_truth, _ = self.calculate_ground_truth(question)
-            if not ground_truth:
-                return -1
-            if "heatmap_shape" in self.args:
-                resize_shape = self.args["heatmap_shape"]
-            else:
-                resize_shape = heatmap.shape
-            ground_truth = util.resize_ground_truth(ground_truth, resize_shape)
-            self.ground_truth[question["question_index"]] = ground_truth
+        if method is None:
+            method = next(iter(self.methods))
+        heatmap = self._load_heatmap(prediction["question_index"], method)
+        ground_truth = self._get_ground_truth(question, heatmap.shape)
+        if ground_truth is None:
+            return -1
 
         acc = util.calc_overlap(ground_truth, heatmap)
 
         return acc
 
-    def evaluate(self) -> None:
+    def score(self,
+              question_index: int,
+              answer: str,
+              heatmap: np.ndarray,
+              method: str = None) -> dict:
+        """
+        Scores a single in-memory heatmap, see score_batch.
+
+        Result
+        ---
+        dict
+            Metric label -> value. None if the answer is wrong.
+        """
+        return self.score_batch([question_index], [answer], [heatmap],
+                                method=method)[0]
+
+    def score_batch(self,
+                    question_indices: list,
+                    answers: list,
+                    heatmap_list: list,
+                    method: str = None) -> list:
+        """
+        Scores in-memory heatmaps, e.g. straight from the attribution method during
+        inference, without writing them to heatmap_path. Like in evaluate(), only
+        heatmaps of correctly answered questions are scored. The ground truths are taken
+        from the ground truth store or computed and remembered. The scores are added to
+        the running means (see get_running_means), every call counts, so heatmaps which
+        are scored twice are counted twice.
+
+        Parameters
+        ---
+        question_indices (list)
+            question_index of every heatmap
+        answers (list)
+            Predicted answer of every heatmap
+        heatmap_list (list)
+            Heatmaps (HxW arrays, or a BxHxW array) of the same shape as the ground
+            truths, i.e. heatmap_shape if it's configured
+        method (str)
+            Attribution method the running means are kept for. Defaults to the first
+            configured method.
+
+        Result
+        ---
+        list
+            Metric label -> value per heatmap, -1 if the question has no ground truth and
+            NaN if the metric is undefined for the heatmap. None if the answer is wrong.
+        """
+        if method is None:
+            method = next(iter(self.methods), "default")
+        assert len(question_indices) == len(answers) == len(heatmap_list), \
+            "Need a question index and an answer per heatmap!"
+        results = [None] * len(question_indices)
+        positions = []
+        items = []
+        item_heatmaps = []
+        for position, (ques_id, answer, heatmap) in enumerate(
+                zip(question_indices, answers, heatmap_list)):
+            question = self.questions[int(ques_id)]
+            self.running.predictions += 1
+            if answer != question["answer"]:
+                continue
+            positions.append(position)
+            items.append(({
+                "question_index": int(ques_id),
+                "answer": answer
+            }, question))
+            heatmap = np.asarray(heatmap)
+            if "heatmap_shape" in self.args:
+                assert heatmap.shape == tuple(self.args["heatmap_shape"]), \
+                    "Heatmap of question %d has shape %s, expected heatmap_shape %s" % (
+                        int(ques_id), heatmap.shape, tuple(self.args["heatmap_shape"]))
+            item_heatmaps.append({method: heatmap})
+        self.running.correct += len(items)
+        if not items:
+            return results
+
+        scores = self.eval_batch(items,
+                                 heatmap_list=item_heatmaps,
+                                 methods=[method])[method]
+        for item_idx, position in enumerate(positions):
+            results[position] = {
+                label: values[item_idx]
+                for label, values in scores.items()
+            }
+        self.running.update(method, [results[position] for position in positions])
+        return results
+
+    def get_running_means(self) -> dict:
+        """
+        Returns the running means of all heatmaps scored with score() and score_batch().
+
+        Result
+        ---
+        dict
+            Attribution method -> metric label -> mean (the mean curve for the sweep)
+        """
+        return self.running.means()
+
+    def reset_running_means(self) -> None:
+        """
+        Resets the running means, e.g. before the next epoch.
+        """
+        self.running = metrics.RunningMeans()
+
+    def eval_batch(self,
+                   items: list,
+                   heatmap_list: list = None,
+                   methods: list = None) -> dict:
+        """
+        Evaluates a batch of heatmap-answer pairs for all attribution methods and all
+        configured metrics at once. Every ground truth is fetched once and shared by all
+        methods. Per method, the heatmaps and ground truths are stacked and all metrics
+        are computed from the same arrays by the metric engine.
+
+        Parameters
+        ---
+        items (list)
+            (prediction, question) pairs
+        heatmap_list (list)
+            Optional heatmaps of every pair (method -> heatmap), e.g. prefetched.
+            By default they're loaded from the heatmap paths.
+        methods (list)
+            Attribution methods to evaluate. Defaults to all configured methods.
+
+        Result
+        ---
+        dict
+            Attribution method -> metric -> value per pair. -1 if the question has no
+            ground truth and NaN if the metric is undefined for the heatmap (e.g. it has
+            no relevance). With a sweep, metrics.SWEEP_LABEL holds the curve per pair.
+        """
+        if methods is None:
+            methods = list(self.methods)
+        labels = self.metric_engine.labels
+        if self.sweep is not None:
+            labels = labels + [metrics.SWEEP_LABEL]
+        scores = {
+            method: {label: [-1] * len(items)
+                     for label in labels}
+            for method in methods
+        }
+        # Heatmaps are grouped by method and shape, so they can be stacked
+        groups = {}
+        for item_idx, (pred, question) in enumerate(items):
+            ground_truth = None
+            for method in methods:
+                if heatmap_list is not None:
+                    heatmap = heatmap_list[item_idx][method]
+                else:
+                    heatmap = self._load_heatmap(pred["question_index"], method)
+                if ground_truth is None:
+                    ground_truth = self._get_ground_truth(question, heatmap.shape)
+                    if ground_truth is None:
+                        break
+                group = groups.setdefault((method, heatmap.shape), ([], [], []))
+                group[0].append(item_idx)
+                group[1].append(ground_truth)
+                group[2].append(heatmap)
+
+        for (method, _), (item_indices, ground_truths,
+                          group_heatmaps) in groups.items():
+            values = self.metric_engine.compute(np.stack(ground_truths),
+                                                np.stack(group_heatmaps))
+            for label, metric_values in values.items():
+                for item_idx, value in zip(item_indices, metric_values):
+                    scores[method][label][item_idx] = value
+        return scores
+
+    def evaluate(self,
+                 workers: int = 1,
+                 chunk_size: int = 64,
+                 batch_size: int = DEFAULT_BATCH_SIZE) -> None:
         """
         Evaluate relevance on Unique CLEVR.
 
@@ -297,44 +1053,554 @@ class UniqueCLEVREvaluator():
          7. Sum values at those pixels -> rel_true
          8. Calculate metric -> acc = rel_true/total_rel
 
+        The predictions are split into chunks of questions about the same images, which
+        are evaluated in batches of batch_size questions. With workers > 1 the chunks are
+        evaluated in a process pool, where each worker keeps its own scene and mask
+        caches. The accuracies are merged back in prediction order, so the overall
+        accuracy doesn't depend on the number of workers. All attribution methods and
+        metrics are evaluated in the same pass. self.metric_values holds the values per
+        method and metric, self.accuracy the mass accuracies per method.
+
+        Parameters
+        ---
+        workers (int)
+            Number of worker processes. 1 evaluates in the current process.
+        chunk_size (int)
+            Number of predictions per work unit sent to a worker.
+        batch_size (int)
+            Number of heatmaps scored at once.
 
         Result
         ---
         None
         """
 
-        if not self.predictions:
-            exit("Predictions were not loaded. Can not evaluate. Exiting...")
-        self.accuracy = []
+        start = time.perf_counter()
+        predictions = self.predictions
+        if predictions is None:
+            if not os.path.exists(self.args["pred_file"]):
+                exit("Predictions were not loaded. Can not evaluate. Exiting...")
+            predictions = (
+                pred for _, _, pred in util.iter_json_records(self.args["pred_file"]))
+        missing = []
+        duplicates = []
+        pairs = self.questions.iter_join(predictions, missing, duplicates)
+
+        # With a results log, questions scored by a previous run are skipped
+        results_log = None
+        scored = set()
+        if self.args.get("results_log"):
+            results_log = ResultsLog(self.args["results_log"],
+                                     self._results_header())
+            scored = results_log.scored()
+            if scored:
+                print("Resuming, %d questions already scored in %s" %
+                      (len(scored), results_log.path))
+        items = ((position, pred, question)
+                 for position, (pred, question) in enumerate(pairs)
+                 if pred["answer"] == question["answer"]
+                 and question["question_index"] not in scored
+                 and self._in_shard(question))
+        total = None
+        if not self.streaming:
+            items = list(items)
+            total = len(items)
+        chunks = util.iter_chunks(
+            items,
+            chunk_size,
+            key=lambda item: item[2]["image"],
+            window=self.stream_window if self.streaming else None)
+        if self.prefetch is not None and workers <= 1:
+            # read the next chunk while the current one is evaluated
+            chunks = self._prefetch_chunks(chunks)
+        self.batch_size = batch_size
+
         print("Evaluating...")
-        for pred in tqdm(self.predictions, total=len(self.predictions)):
-            ques_id = pred["question_index"]
-            question = [
-                q for q in self.questions if q["question_index"] == ques_id
-            ][0]
-            if pred["answer"] == question["answer"]:
-                acc = self.eval_single(pred, question)
-                if acc >= 0:
-                    self.accuracy.append(acc)
-
-    def get_overall_accuracy(self) -> np.float64:
+        results = {}
+        ques_ids = {}
+        # Ground truths computed during a checkpointed run are saved at every
+        # checkpoint, so a resumed run doesn't compute them again
+        gt_writer = None
+        checkpoint_every = self.args.get("checkpoint_every", 1000)
+        self.prefetch_stats = None
+        with tqdm(total=total) as progress:
+            for chunk_results, chunk_stats in self._map_chunks(
+                    "_eval_chunk", chunks, workers):
+                if "prefetch" in chunk_stats:
+                    self.prefetch_stats = prefetch.merge_stats(
+                        self.prefetch_stats, chunk_stats["prefetch"])
+                for position, ques_id, scores, ground_truth in chunk_results:
+                    results[position] = scores
+                    ques_ids[position] = ques_id
+                    if ground_truth is not None:
+                        self.ground_truth[ques_id] = ground_truth
+                    if results_log is None:
+                        continue
+                    results_log.append(position, ques_id, scores)
+                    # shards don't write to the shared ground_truth_path, see run()
+                    if ground_truth is not None and self.shard is None:
+                        if gt_writer is None:
+                            gt_writer = storage.open_ground_truth_writer(
+                                self.args["ground_truth_path"], append=True)
+                        with self.profiler.stage("ground_truth_write"):
+                            gt_writer.write(ques_id, ground_truth)
+                if (results_log is not None
+                        and results_log.pending >= checkpoint_every):
+                    with self.profiler.stage("checkpoint"):
+                        if gt_writer is not None:
+                            gt_writer.flush()
+                        results_log.flush()
+                self.profiler.count("questions_scored", len(chunk_results))
+                progress.update(len(chunk_results))
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        if self.prefetch_stats is not None:
+            print("Prefetching (depth %d, %d threads): waited %.2fs for the data of "
+                  "%d of %d questions" %
+                  (self.prefetch.get("depth", 128), self.prefetch.get(
+                      "threads", 4), self.prefetch_stats["stall_seconds"],
+                   self.prefetch_stats["stalls"], self.prefetch_stats["items"]))
+        util.report_ids("predictions without a matching question, skipping",
+                        missing)
+        util.report_ids("duplicate predictions, keeping the first", duplicates)
+
+        if results_log is not None:
+            if gt_writer is not None:
+                # all ground truths computed by the run are on disk
+                gt_writer.close()
+                self.ground_truth_precomputed = True
+            results_log.close()
+            # The aggregate is computed from the log, which includes previous runs
+            results = results_log.results
+            ques_ids = results_log.ques_ids
+
+        self._aggregate_results(results, ques_ids)
+        self.profiler.record("evaluate", time.perf_counter() - start)
+
+    def _in_shard(self, question: dict) -> bool:
+        """
+        Returns True if the question belongs to the evaluated shard (or all questions
+        are evaluated).
+        """
+        if self.shard is None:
+            return True
+        return shards.shard_of(question, self.shard[1],
+                               self.shard_by) == self.shard[0]
+
+    def _aggregate_results(self, results: dict, ques_ids: dict) -> None:
+        """
+        Collects the per-question results of an evaluation (or of merged shards) into
+        self.metric_values, self.accuracy, self.result_columns and the sweep curves.
+
+        Parameters
+        ---
+        results (dict)
+            Position in the prediction file -> attribution method -> metric -> value
+        ques_ids (dict)
+            Position in the prediction file -> question_index
+        """
+        self.results = results
+        self.ques_ids = ques_ids
+        # Questions without ground truth (-1) and undefined values (NaN, e.g. heatmaps
+        # without relevance) are skipped
+        self.metric_values = {}
+        for method in self.methods:
+            self.metric_values[method] = {}
+            for label in self.metric_engine.labels:
+                self.metric_values[method][label] = [
+                    results[position][method][label]
+                    for position in sorted(results)
+                    if results[position][method][label] >= 0
+                ]
+        self.accuracy = {
+            method: self.metric_values[method]["mass_accuracy"]
+            for method in self.methods
+        }
+        positions = sorted(results)
+        self.result_columns = {
+            "question_index":
+            np.array([ques_ids[position] for position in positions],
+                     dtype=np.int64)
+        }
+        for method in self.methods:
+            for label in self.metric_engine.labels:
+                column = np.array([
+                    results[position][method][label] for position in positions
+                ],
+                                  dtype=np.float64)
+                column[column < 0] = np.nan
+                self.result_columns[method + "/" + label] = column
+        if self.sweep is not None:
+            self._collect_sweep_curves(results, ques_ids)
+
+    def _shard_header(self) -> dict:
+        """
+        Returns the description of a sharded run stored in the partial results.
+        """
+        header = self._results_header()
+        header.update({
+            "shard": list(self.shard),
+            "num_shards": self.shard[1],
+            "shard_by": self.shard_by
+        })
+        return header
+
+    def save_partial_results(self) -> None:
+        """
+        Saves the results of the evaluated shard to the partial_results directory, see
+        shards.save_partial.
+        """
+        path = shards.get_partial_path(self.args["partial_results"], self.shard)
+        shards.save_partial(path, self._shard_header(), self.results, self.ques_ids,
+                            self.metric_engine.labels)
+        print("Saved partial results of shard %d/%d to %s" %
+              (self.shard + (path,)))
+
+    def merge_partial_results(self, paths: list) -> None:
+        """
+        Merges the partial results of all shards of a run. Afterwards the accuracies,
+        metrics, sweep curves and breakdown are available as after evaluate(), with
+        exactly the values of an unsharded run.
+
+        Parameters
+        ---
+        paths (list)
+            Partial results files of all shards
+        """
+        header, results, ques_ids = shards.load_partials(paths)
+        expected = json.loads(json.dumps(self._results_header()))
+        if {key: header.get(key) for key in expected} != expected:
+            exit("The partial results were written with a different configuration. "
+                 "Exiting...")
+        print("Merged %d questions from %d shards (by %s)" %
+              (len(results), header["num_shards"], header["shard_by"]))
+        self._aggregate_results(results, ques_ids)
+
+    def _collect_sweep_curves(self, results: dict, ques_ids: dict) -> None:
+        """
+        Stacks the sweep curves of all evaluated questions per attribution method.
+        Like the metrics, questions without ground truth or without relevance are
+        skipped.
+        """
+        self.sweep_curves = {}
+        for method in self.methods:
+            positions = [
+                position for position in sorted(results)
+                if np.ndim(results[position][method][metrics.SWEEP_LABEL]) > 0
+                and results[position][method]["mass_accuracy"] >= 0
+            ]
+            curves = np.zeros((len(positions),
+                               len(self.metric_engine.sweep_thresholds)),
+                              dtype=np.float32)
+            for row, position in enumerate(positions):
+                curves[row] = results[position][method][metrics.SWEEP_LABEL]
+            self.sweep_curves[method] = (np.array(
+                [ques_ids[position] for position in positions],
+                dtype=np.int64), curves)
+
+    def _question_attributes(self, question: dict) -> dict:
+        """
+        Returns the attributes a question's results are grouped by in the breakdown
+        (see breakdown.ATTRIBUTES). The target objects follow filters and target_all.
+        """
+        scene, target_objects, _ = self._get_target_objects(question)
+        target_sizes = sorted(set(obj.get("size") for obj in target_objects))
+        if not target_sizes:
+            target_size = "none"
+        elif len(target_sizes) == 1:
+            target_size = target_sizes[0]
+        else:
+            target_size = "mixed"
+        return {
+            "template_filename": question.get("template_filename"),
+            "question_family_index": question.get("question_family_index"),
+            "num_objects": len(scene["objects"]),
+            "num_targets": len(target_objects),
+            "target_size": target_size
+        }
+
+    def get_breakdown(self,
+                      resamples: int = 1000,
+                      confidence: float = 0.95,
+                      seed: int = 0) -> dict:
+        """
+        Returns the mean of every attribution method and metric grouped by
+        template_filename, question_family_index, number of scene objects, number of
+        target objects and target object size, each with a bootstrap confidence
+        interval.
+
+        Parameters
+        ---
+        resamples (int)
+            Number of bootstrap resamples
+        confidence (float)
+            Confidence level of the intervals
+        seed (int)
+            Seed of the bootstrap's random generator
+
+        Result
+        ---
+        dict
+            See breakdown.breakdown_report. Columns are named method/metric.
+        """
+        if self.result_columns is None:
+            print("Results not computed yet. Call evaluate() to compute them.")
+            return None
+        attributes = {name: [] for name in breakdown.ATTRIBUTES}
+        for ques_id in self.result_columns["question_index"]:
+            question_attributes = self._question_attributes(
+                self.questions[int(ques_id)])
+            for name in breakdown.ATTRIBUTES:
+                attributes[name].append(question_attributes[name])
+        values = {
+            column: column_values
+            for column, column_values in self.result_columns.items()
+            if column != "question_index"
+        }
+        return breakdown.breakdown_report(values,
+                                          attributes,
+                                          resamples=resamples,
+                                          confidence=confidence,
+                                          seed=seed)
+
+    def save_breakdown(self) -> None:
+        """
+        Saves the breakdown configured with the breakdown option (JSON).
+        """
+        options = self.args["breakdown"]
+        report = self.get_breakdown(resamples=options.get("resamples", 1000),
+                                    confidence=options.get("confidence", 0.95),
+                                    seed=options.get("seed", 0))
+        if report is None:
+            return
+        util.ensure_parent_dir(options["output"])
+        util.save_json(report, options["output"])
+        print("Saved accuracy breakdown to %s" % options["output"])
+
+    def save_profile(self, **info) -> None:
+        """
+        Saves the profile of this run to the profile output (JSON): the wall time, calls
+        and bytes read per stage (of all worker processes), the counters, the cache hit
+        rates and the prefetch statistics.
+
+        Parameters
+        ---
+        info
+            Further entries of the profile, e.g. the number of workers
+        """
+        if self.prefetch_stats is not None:
+            info["prefetch"] = self.prefetch_stats
+        profile = self.profiler.report(**info)
+        util.ensure_parent_dir(self.args["profile"])
+        util.save_json(profile, self.args["profile"])
+        print("Saved profile to %s" % self.args["profile"])
+
+    def save_sweep_curves(self) -> None:
+        """
+        Saves the threshold sweep to the sweep output path as a npz file with the
+        thresholds (in percent) and, per attribution method, the question indices,
+        the curve of every question and the mean curve.
+        """
+        if self.sweep_curves is None:
+            print("Sweep curves not computed yet. Call evaluate() to compute them.")
+            return
+        arrays = {"thresholds": self.metric_engine.sweep_thresholds}
+        for method, (method_ques_ids, curves) in self.sweep_curves.items():
+            arrays[method + "_question_index"] = method_ques_ids
+            arrays[method + "_curves"] = curves
+            if len(curves):
+                arrays[method + "_mean"] = curves.mean(axis=0, dtype=np.float64)
+            else:
+                arrays[method + "_mean"] = np.full(curves.shape[1], np.nan)
+        output = self.sweep["output"]
+        util.ensure_parent_dir(output)
+        np.savez(output, **arrays)
+        print("Saved threshold sweep to %s" % output)
+
+    def _results_header(self) -> dict:
+        """
+        Returns the description of the run stored in the results log. A log can only
+        be resumed by a run with the same header.
+        """
+        header = {
+            key: self.args.get(key)
+            for key in ("pred_file", "question_file", "filters", "target_all",
+                        "heatmap_shape")
+        }
+        header["methods"] = self.methods
+        header["metrics"] = self.metric_engine.labels
+        if self.sweep is not None:
+            header["sweep"] = self.metric_engine.sweep_thresholds.tolist()
+        if self.shard is not None:
+            # every shard has its own log
+            header["shard"] = list(self.shard)
+            header["shard_by"] = self.shard_by
+        return header
+
+    def _eval_chunk(self, chunk: list) -> Tuple[list, dict]:
+        """
+        Evaluates a chunk of (position, prediction, question) items in batches.
+
+        Result
+        ---
+        list
+            (position, question_index, scores, ground_truth) tuples. scores maps
+            attribution method -> metric -> value. ground_truth is only set if it had to
+            be computed.
+        dict
+            Statistics of the chunk. With prefetching, prefetch holds the counters of
+            the prefetcher (see Prefetcher.pop_stats).
+        """
+        results = []
+        prefetcher = self._get_prefetcher()
+        if prefetcher is not None:
+            self._prefetch_items(chunk)
+        # Ground truth stores which load lazily can read the next batch in the meantime
+        prefetch = getattr(self.ground_truth, "prefetch", None)
+        for start in range(0, len(chunk), self.batch_size):
+            batch = chunk[start:start + self.batch_size]
+            if prefetch is not None:
+                prefetch(question["question_index"]
+                         for _, _, question in chunk[start:start + 2 * self.batch_size])
+            precomputed = [
+                question["question_index"] in self.ground_truth
+                for _, _, question in batch
+            ]
+            heatmap_list = None
+            if prefetcher is not None:
+                heatmap_list = [
+                    self._take_prefetched(position, question)
+                    for position, _, question in batch
+                ]
+            batch_scores = self.eval_batch([(pred, question)
+                                            for _, pred, question in batch],
+                                           heatmap_list=heatmap_list)
+            for batch_idx, (position, _, question) in enumerate(batch):
+                ques_id = question["question_index"]
+                ground_truth = None
+                if not precomputed[batch_idx]:
+                    ground_truth = self.ground_truth.get(ques_id)
+                scores = {
+                    method: {
+                        label: values[batch_idx]
+                        for label, values in batch_scores[method].items()
+                    } for method in self.methods
+                }
+                results.append((position, ques_id, scores, ground_truth))
+        stats = {}
+        if prefetcher is not None:
+            stats["prefetch"] = prefetcher.pop_stats()
+        return results, stats
+
+    def get_overall_accuracy(self, method: str = None) -> np.float64:
         """
         Returns the mean accuracy over the whole dataset.
 
+        Parameters
+        ---
+        method (str)
+            Attribution method. Defaults to the first method.
+
         Result
         ---
         np.float64
             Mean accuracy.
         """
-        try:
-            mean_acc = np.mean(self.accuracy)
-        except TypeError:
+        if self.accuracy is None:
             print(
                 "Accuracy not computed yet. Call evaluate() to compute accuracy."
             )
             return None
+        if method is None:
+            method = next(iter(self.methods))
+        mean_acc = np.mean(self.accuracy[method])
         return mean_acc
 
+    def get_method_accuracies(self) -> dict:
+        """
+        Returns the mean accuracy of every attribution method.
+
+        Result
+        ---
+        dict
+            Attribution method -> mean accuracy
+        """
+        return {
+            method: self.get_overall_accuracy(method)
+            for method in self.methods
+        }
+
+    def get_metric_means(self) -> dict:
+        """
+        Returns the mean of every metric for every attribution method.
+
+        Result
+        ---
+        dict
+            Attribution method -> metric -> mean
+        """
+        return {
+            method: {
+                label: np.mean(values) if values else np.nan
+                for label, values in self.metric_values[method].items()
+            } for method in self.methods
+        }
+
+    def print_accuracies(self) -> None:
+        """
+        Prints the mean accuracies (and other metrics) of all attribution methods side
+        by side.
+        """
+        labels = self.metric_engine.labels
+        if len(self.methods) == 1 and len(labels) == 1:
+            print("Overall accuracy: ", self.get_overall_accuracy())
+            return
+        width = max(len(method) for method in list(self.methods) + ["method"])
+        columns = [max(len(label), 10) for label in labels]
+        print("%-*s" % (width, "method"),
+              *["%-*s" % (col, label) for col, label in zip(columns, labels)],
+              "questions",
+              sep="  ")
+        for method, means in self.get_metric_means().items():
+            print("%-*s" % (width, method),
+                  *[
+                      "%-*.6f" % (col, means[label])
+                      for col, label in zip(columns, labels)
+                  ],
+                  "%d" % len(self.accuracy[method]),
+                  sep="  ")
+
+
+# Evaluator instance of a worker process, set by _init_worker
+_worker_evaluator = None
+
+
+def _init_worker(evaluator: UniqueCLEVREvaluator) -> None:
+    """
+    Process pool initializer. Every worker gets its own copy of the evaluator and
+    therefore its own scene, mask and ground truth caches.
+    """
+    global _worker_evaluator
+    _worker_evaluator = evaluator
+    # forked workers start with a copy of the parent's profiler records
+    _worker_evaluator.profiler.pop()
+
+
+def _call_worker(task: Tuple[str, list]) -> list:
+    """
+    Runs an evaluator method on a chunk in a worker process. Returns the method's
+    results and the worker's profiler records of the chunk (None if disabled).
+
+    Parameters
+    ---
+    task (Tuple[str, list])
+        Name of the evaluator method and the chunk to process
+    """
+    method, chunk = task
+    chunk_results = getattr(_worker_evaluator, method)(chunk)
+    return chunk_results, _worker_evaluator.profiler.pop()
+
 
 def _debug_draw_ground_truth(filepath: str):
     """
@@ -380,6 +1646,69 @@ def run():
         required=False,
         action="store_true",
         help="Only compute GT statistics")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of worker processes used for evaluation and ground truth generation.")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=64,
+        required=False,
+        help="Number of questions per work unit when using several workers.")
+    parser.add_argument(
+        "--build-label-maps",
+        default=False,
+        required=False,
+        action="store_true",
+        help="Only converts the mask images to object label maps (label_maps_path).")
+    parser.add_argument(
+        "--build-object-masks",
+        default=False,
+        required=False,
+        action="store_true",
+        help="Only splits the mask images into per-object masks of heatmap_shape "
+        "(object_masks_path).")
+    parser.add_argument(
+        "--convert-heatmaps",
+        type=str,
+        default=None,
+        required=False,
+        help="Only converts the heatmap files at heatmap_path to a heatmap stack "
+        "saved at the given path (with the .stack extension). If heatmap_path maps "
+        "several methods, each is saved to <path>/<method>.stack")
+    parser.add_argument(
+        "--serve",
+        type=str,
+        default=None,
+        required=False,
+        help="Keeps the questions and ground truths loaded and serves scoring requests "
+        "on a port, host:port or Unix socket path (see server.py).")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        required=False,
+        help="Number of heatmaps scored at once.")
+    parser.add_argument(
+        "--shard",
+        type=str,
+        default=None,
+        required=False,
+        help="Only evaluates shard i/n of the predictions (see shard_by) and saves "
+        "its partial results to the partial_results directory.")
+    subparsers = parser.add_subparsers(dest="command")
+    merge_parser = subparsers.add_parser(
+        "merge",
+        help="Merges the partial results of all shards into the results of a single "
+        "run.")
+    merge_parser.add_argument(
+        "partials",
+        type=str,
+        nargs="*",
+        help="Partial results files. Defaults to all files in partial_results.")
     cmd_args = parser.parse_args()
 
     config_file = cmd_args.config
@@ -389,20 +1718,93 @@ def run():
     except FileNotFoundError:
         exit("Config file not found! Please provide a valid config file path.")
 
+    if cmd_args.convert_heatmaps:
+        methods = util.get_heatmap_paths(args["heatmap_path"])
+        for method, heatmap_path in methods.items():
+            stack_path = cmd_args.convert_heatmaps
+            if len(methods) > 1:
+                stack_path = os.path.join(stack_path, method + ".stack")
+            heatmaps.convert_heatmaps(heatmap_path, stack_path)
+        return
+
+    if cmd_args.shard is not None and "partial_results" not in args:
+        exit("Evaluating a shard requires a partial_results directory. Exiting...")
+
     unique_clevr_evaluator = UniqueCLEVREvaluator(args)
+    if cmd_args.shard is not None:
+        unique_clevr_evaluator.shard = shards.parse_shard(cmd_args.shard)
+
+    if cmd_args.build_label_maps:
+        unique_clevr_evaluator.build_label_maps()
+        return
+    elif cmd_args.build_object_masks:
+        unique_clevr_evaluator.build_object_masks()
+        return
 
+    mode = "evaluate"
     if cmd_args.no_evaluate:
-        unique_clevr_evaluator.calculate_all_ground_truths()
+        mode = "ground_truth"
+        unique_clevr_evaluator.calculate_all_ground_truths(
+            workers=cmd_args.workers, chunk_size=cmd_args.chunk_size)
     elif cmd_args.gt_stats:
+        mode = "gt_stats"
         unique_clevr_evaluator._calc_ground_truth_stats()
+    elif cmd_args.serve:
+        # Ground truths computed while serving are saved (or added to the precomputed
+        # ones) when the server is stopped
+        mode = "serve"
+        server.serve(unique_clevr_evaluator, cmd_args.serve)
+    elif cmd_args.command == "merge":
+        mode = "merge"
+        partials = cmd_args.partials
+        if not partials and "partial_results" in args:
+            partials = sorted(
+                glob.glob(os.path.join(args["partial_results"], "shard_*.npz")))
+        unique_clevr_evaluator.merge_partial_results(partials)
+        unique_clevr_evaluator.print_accuracies()
+        if unique_clevr_evaluator.sweep is not None:
+            unique_clevr_evaluator.save_sweep_curves()
+        if "breakdown" in args:
+            unique_clevr_evaluator.save_breakdown()
+    elif unique_clevr_evaluator.shard is not None:
+        # The sweep curves and breakdown are saved when the shards are merged
+        mode = "shard"
+        unique_clevr_evaluator.evaluate(workers=cmd_args.workers,
+                                        chunk_size=cmd_args.chunk_size,
+                                        batch_size=cmd_args.batch_size)
+        unique_clevr_evaluator.print_accuracies()
+        unique_clevr_evaluator.save_partial_results()
     else:
-        unique_clevr_evaluator.evaluate()
-        print("Overall accuracy: ",
-              unique_clevr_evaluator.get_overall_accuracy())
-
-    if not unique_clevr_evaluator.ground_truth_precomputed:
+        unique_clevr_evaluator.evaluate(workers=cmd_args.workers,
+                                        chunk_size=cmd_args.chunk_size,
+                                        batch_size=cmd_args.batch_size)
+        unique_clevr_evaluator.print_accuracies()
+        if unique_clevr_evaluator.sweep is not None:
+            unique_clevr_evaluator.save_sweep_curves()
+        if "breakdown" in args:
+            unique_clevr_evaluator.save_breakdown()
+
+    # Ground truths computed from object masks aren't remembered, so there may be
+    # nothing to save. Merging doesn't compute any. Shards share ground_truth_path, so
+    # they don't save the ground truths they computed, which would replace each
+    # other's stores.
+    if mode == "shard":
+        if not unique_clevr_evaluator.ground_truth_precomputed:
+            print("Ground truths computed by a shard aren't saved. Compute them with "
+                  "--no-evaluate before starting the shards.")
+    elif mode == "serve" and unique_clevr_evaluator.ground_truth_precomputed:
+        unique_clevr_evaluator.save_added_ground_truth()
+    elif (mode != "merge" and not unique_clevr_evaluator.ground_truth_precomputed
+          and (unique_clevr_evaluator.object_masks is None
+               or len(unique_clevr_evaluator.ground_truth) > 0)):
         unique_clevr_evaluator.save_ground_truth(save_stats=True)
 
+    if "profile" in args:
+        unique_clevr_evaluator.save_profile(mode=mode,
+                                            workers=cmd_args.workers,
+                                            chunk_size=cmd_args.chunk_size,
+                                            batch_size=cmd_args.batch_size)
+
 
 if __name__ == "__main__":
     run()
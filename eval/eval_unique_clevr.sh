@@ -15,6 +15,7 @@ function print_help() {
     echo "  --config      | -c     Specifies the config file path"
     echo "  --sif         | -s     OPTIONAL: Specifies the singularity sif file. By default, it's assumed to be in the current directory with name eval-unique-clevr.sif"
     echo "  --no-evaluate | -n     OPTIONAL: Only generates the ground truths and saves them to disk"
+    echo "  --workers     | -w     OPTIONAL: Number of worker processes. By default, 1"
 
     exit 0
 }
@@ -38,8 +39,8 @@ DISCARD_OPTS_AFTER_DOUBLEDASH=1 # 1=Discard, 0=Save opts after -- to ${EXTRA_ARG
 # An option followed by a single colon ':' means that it *needs* an argument.
 # An option followed by double colons '::' means that its argument is optional.
 # See `man getopt'.
-SHORT=-hd:c:s:n                     # List all the short options
-LONG=help,datadir:,config:,sif:,no-evaluate # List all the long options
+SHORT=-hd:c:s:nw:                   # List all the short options
+LONG=help,datadir:,config:,sif:,no-evaluate,workers: # List all the long options
 
 # - Temporarily store output to be able to check for errors.
 # - Activate advanced mode getopt quoting e.g. via "--options".
@@ -63,6 +64,7 @@ DATADIR=""
 CONFIG=""
 CONTAINER=$PWD/eval-unique-clevr.sif
 NOEVALUATE=""
+WORKERS=1
 
 dashes=0 #flag to track if we've parsed '--'
 while [[ $# -gt 0 ]]; do
@@ -74,8 +76,10 @@ while [[ $# -gt 0 ]]; do
 		   DATADIR="$1";;
         -c|--config) shift
                    CONFIG="$1";;
-        -n|--no-evaluate) shift
+        -n|--no-evaluate)
                    NOEVALUATE="True";;
+        -w|--workers) shift
+                   WORKERS="$1";;
         --) dashes=1
             if [[ ${DISCARD_OPTS_AFTER_DOUBLEDASH} -eq 1 ]]; then break; fi
             ;;
@@ -102,9 +106,9 @@ if [ -z "$NOEVALUATE" ]
 then
 	log info "Running evaluation code in singularity container..."
 	singularity run -B $DATADIR:/data -B $CONFIG:/config.yaml \
-		$CONTAINER --config /config.yaml
+		$CONTAINER --config /config.yaml --workers $WORKERS
 else 
 	log info "Running evaluation code in singularity container..."
 	singularity run -B $DATADIR:/data -B $CONFIG:/config.yaml \
-		$CONTAINER --config /config.yaml --no-evaluate
+		$CONTAINER --config /config.yaml --no-evaluate --workers $WORKERS
 fi
@@ -0,0 +1,131 @@
+"""
+heatmaps.py
+
+heatmaps.py contains the heatmap sources used for evaluation: a directory with one npy
+file per question, or a stacked container holding all heatmaps in a single
+memory-mapped (N,H,W) array.
+"""
+
+import os
+import glob
+import numpy as np
+from tqdm import tqdm
+import util
+
+STACK_DATA_FILE = "heatmaps.npy"
+STACK_INDEX_FILE = "index.npy"
+
+
+class HeatmapDirectory():
+    """
+    Heatmaps saved as <heatmap_path><question_index>.npy
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ---
+        path (str)
+            Heatmap directory (prefix of <question_index>.npy)
+        """
+        self.path = path
+
+    def __getitem__(self, ques_id: int) -> np.ndarray:
+        return util.load_heatmap(self.path + str(ques_id) + ".npy")
+
+
+class HeatmapStack():
+    """
+    Heatmaps stacked in a single (N,H,W) npy file inside a <name>.stack directory.
+    index.npy holds the (sorted) question_index of every row. The stack is
+    memory-mapped, so a heatmap is a zero-copy slice that is read from disk on access.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ---
+        path (str)
+            Heatmap stack directory
+        """
+        self.path = path
+        self.heatmaps = np.load(os.path.join(path, STACK_DATA_FILE),
+                                mmap_mode="r")
+        self.index = np.load(os.path.join(path, STACK_INDEX_FILE))
+
+    def __getstate__(self) -> dict:
+        # Reopen the memory map in worker processes instead of pickling the heatmaps
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["path"])
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, ques_id: int) -> bool:
+        row = np.searchsorted(self.index, ques_id)
+        return row < len(self.index) and self.index[row] == ques_id
+
+    def __getitem__(self, ques_id: int) -> np.ndarray:
+        row = np.searchsorted(self.index, ques_id)
+        if row >= len(self.index) or self.index[row] != ques_id:
+            raise KeyError(ques_id)
+        return self.heatmaps[row]
+
+
+def open_heatmaps(heatmap_path: str):
+    """
+    Returns the heatmap source matching the heatmap path. Paths with the stack extension
+    are opened as a HeatmapStack, everything else as a HeatmapDirectory.
+
+    Parameters
+    ---
+    heatmap_path (str)
+        heatmap_path from the config
+
+    Result
+    ---
+    HeatmapDirectory or HeatmapStack
+    """
+    if util.is_heatmap_stack(heatmap_path):
+        return HeatmapStack(heatmap_path)
+    return HeatmapDirectory(heatmap_path)
+
+
+def convert_heatmaps(heatmap_path: str, stack_path: str) -> None:
+    """
+    Converts a directory with one heatmap npy file per question into a heatmap stack.
+    All heatmaps need to have the same shape and dtype.
+
+    Parameters
+    ---
+    heatmap_path (str)
+        Heatmap directory with files <question_index>.npy
+    stack_path (str)
+        Heatmap stack directory. Created if it doesn't exist.
+    """
+    files = glob.glob(os.path.join(heatmap_path, "*.npy"))
+    if not files:
+        exit("No heatmaps found at %s, exiting..." % heatmap_path)
+    ques_ids = np.array(
+        sorted(int(os.path.splitext(os.path.basename(file))[0]) for file in files),
+        dtype=np.int64)
+
+    if not os.path.exists(stack_path):
+        os.makedirs(stack_path)
+    source = HeatmapDirectory(heatmap_path)
+    first = source[ques_ids[0]]
+    heatmaps = np.lib.format.open_memmap(os.path.join(stack_path,
+                                                      STACK_DATA_FILE),
+                                         mode="w+",
+                                         dtype=first.dtype,
+                                         shape=(len(ques_ids),) + first.shape)
+    print("Converting heatmaps...")
+    for row, ques_id in enumerate(tqdm(ques_ids, total=len(ques_ids))):
+        heatmap = source[ques_id]
+        assert heatmap.shape == first.shape, \
+            "All heatmaps need to have the same shape!"
+        heatmaps[row] = heatmap
+    heatmaps.flush()
+    np.save(os.path.join(stack_path, STACK_INDEX_FILE), ques_ids)
@@ -0,0 +1,114 @@
+"""
+labelmaps.py
+
+labelmaps.py contains the object label map archive. A label map is a uint8 image where
+each pixel holds the index of the scene object it belongs to (255 == background).
+Label maps are computed once per image from the mask image and the scene's mask colors,
+after which the ground truth for any set of target objects is a single np.isin.
+"""
+
+import os
+from typing import List
+import numpy as np
+from tqdm import tqdm
+import util
+
+# Label of pixels which don't belong to any object
+BACKGROUND_LABEL = 255
+
+LABELS_FILE = "labels.npy"
+INDEX_FILE = "index.json"
+
+
+class LabelMapArchive():
+    """
+    Read-only archive of label maps. All label maps are stored in a single (N,H,W) uint8
+    npy file which is memory-mapped, so only the rows that are accessed are read
+    from disk. index.json holds the image name of every row.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ---
+        path (str)
+            Archive directory
+        """
+        self.path = path
+        self.labels = np.load(os.path.join(path, LABELS_FILE), mmap_mode="r")
+        images = util.load_json(os.path.join(path, INDEX_FILE))
+        self.rows = {image: row for row, image in enumerate(images)}
+
+    def __getstate__(self) -> dict:
+        # Reopen the memory map in worker processes instead of pickling the labels
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["path"])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, image: str) -> bool:
+        return image in self.rows
+
+    def __getitem__(self, image: str) -> np.ndarray:
+        """
+        Returns the label map (HxW uint8) of an image.
+        """
+        return self.labels[self.rows[image]]
+
+
+def open_label_maps(path: str) -> LabelMapArchive:
+    """
+    Opens the label map archive at path.
+
+    Parameters
+    ---
+    path (str)
+        Archive directory. May be None.
+
+    Result
+    ---
+    LabelMapArchive
+        None if path is None or there is no archive at path.
+    """
+    if path is None or not os.path.exists(os.path.join(path, LABELS_FILE)):
+        return None
+    return LabelMapArchive(path)
+
+
+def build_label_maps(path: str, images: List[str], image_cache) -> None:
+    """
+    Converts the mask images of the given images to label maps and saves them as an
+    archive. All mask images need to have the same shape.
+
+    Parameters
+    ---
+    path (str)
+        Archive directory. Created if it doesn't exist.
+    images (List[str])
+        Image names, e.g. CLEVR_new_000000
+    image_cache (ImageCache)
+        Cache used to load the scenes and masks and their color mappings
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    labels = None
+    print("Building label maps...")
+    for row, image in enumerate(tqdm(images, total=len(images))):
+        mask_img, unique_colors, mapping = image_cache.get_mask(image)
+        if labels is None:
+            labels = np.lib.format.open_memmap(os.path.join(path, LABELS_FILE),
+                                               mode="w+",
+                                               dtype=np.uint8,
+                                               shape=(len(images),) +
+                                               mask_img.shape[0:2])
+        assert mask_img.shape[0:2] == labels.shape[1:], \
+            "All mask images need to have the same shape!"
+        labels[row] = util.mask_to_labels(mask_img, unique_colors, mapping)
+
+    if labels is not None:
+        labels.flush()
+    util.save_json(list(images), os.path.join(path, INDEX_FILE))
@@ -0,0 +1,388 @@
+"""
+metrics.py
+
+metrics.py contains the heatmap metrics which can be computed during evaluation.
+Metrics are registered by name and selected with the metrics option of the config:
+
+metrics:
+  - mass_accuracy
+  - rank_accuracy
+  - pointing_game
+  - name: top_k_mass
+    k: 10
+
+Like util.calc_overlap, all metrics are computed on the absolute relevance.
+
+The sweep option computes the relevance mass accuracy over the top k percent most
+relevant pixels for many thresholds k at once (see threshold_sweep):
+
+sweep:
+  steps: 20  # k = 5, 10, ..., 100. Or give the thresholds: [1, 5, 10, 50, 100]
+  output: "/data/results/sweep.npz"
+"""
+
+from typing import Callable, List, Union
+import numpy as np
+import util
+from profiling import Profiler
+
+# Metric name -> metric function, filled by register_metric
+METRICS = {}
+# Key of the threshold sweep curves in the results of MetricEngine.compute
+SWEEP_LABEL = "sweep"
+
+
+def register_metric(name: str) -> Callable:
+    """
+    Decorator to register a metric function under a name. A metric function takes a
+    MetricBatch and optional keyword parameters from the config and returns one value
+    per heatmap (NaN if undefined).
+    """
+
+    def decorator(func: Callable) -> Callable:
+        METRICS[name] = func
+        return func
+
+    return decorator
+
+
+class MetricBatch():
+    """
+    A stack of ground truths and heatmaps shared by all metrics. Derived arrays are
+    computed once, on first use, and reused by every metric.
+    """
+
+    def __init__(self, ground_truths: np.ndarray, heatmaps: np.ndarray):
+        """
+        Parameters
+        ---
+        ground_truths (np.ndarray)
+            Ground truth boolean masks with shape BxHxW
+        heatmaps (np.ndarray)
+            Relevance heatmaps with shape BxHxW
+        """
+        assert ground_truths.shape == heatmaps.shape
+        self.ground_truths = ground_truths
+        self.heatmaps = heatmaps
+        self._relevance = None
+        self._total_relevance = None
+
+    @property
+    def relevance(self) -> np.ndarray:
+        """
+        Absolute relevance, BxHxW
+        """
+        if self._relevance is None:
+            self._relevance = np.abs(self.heatmaps)
+        return self._relevance
+
+    @property
+    def total_relevance(self) -> np.ndarray:
+        """
+        Total absolute relevance per heatmap, B
+        """
+        if self._total_relevance is None:
+            self._total_relevance = self.relevance.sum(axis=(1, 2))
+        return self._total_relevance
+
+    def flat(self, array: np.ndarray) -> np.ndarray:
+        """
+        Flattens the pixels of a BxHxW array to Bx(H*W).
+        """
+        return array.reshape(len(array), -1)
+
+
+@register_metric("mass_accuracy")
+def mass_accuracy(batch: MetricBatch) -> np.ndarray:
+    """
+    Relevance mass accuracy: relevance inside the ground truth over all relevance.
+    Identical to util.calc_overlap_batch.
+    """
+    correct_relevance = np.where(batch.ground_truths, batch.relevance,
+                                 0).sum(axis=(1, 2))
+    return util.divide_or_nan(correct_relevance, batch.total_relevance)
+
+
+def top_pixel_mask(relevance: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Marks the counts[i] most relevant pixels of every row of a Bx(H*W) relevance
+    array. Pixels tied with the last selected one are taken in pixel order, like a
+    stable sort, so the selection is the same as in threshold_sweep.
+
+    Parameters
+    ---
+    relevance (np.ndarray)
+        Absolute relevance with shape Bx(H*W)
+    counts (np.ndarray)
+        Number of pixels to select per row, shape B
+
+    Result
+    ---
+    np.ndarray
+        Boolean mask with shape Bx(H*W)
+    """
+    rows = np.arange(len(relevance))
+    kth = np.maximum(counts - 1, 0)
+    # The count-th largest relevance of every row: one partition at the largest count
+    # moves the top pixels of all rows to the front, where they are sorted
+    max_kth = kth.max(initial=0)
+    top = -np.partition(-relevance, max_kth, axis=1)[:, :max_kth + 1]
+    top.sort(axis=1)
+    threshold = top[rows, max_kth - kth][:, np.newaxis]
+
+    above = relevance > threshold
+    ties = relevance == threshold
+    selected = above | ties
+    needed = counts - above.sum(axis=1)
+    # rows with more tied pixels than needed take the first ones
+    partial = np.nonzero(ties.sum(axis=1) > needed)[0]
+    if len(partial) > 0:
+        taken = ties[partial] & (np.cumsum(ties[partial], axis=1) <=
+                                 needed[partial, np.newaxis])
+        selected[partial] = above[partial] | taken
+    return selected
+
+
+@register_metric("rank_accuracy")
+def rank_accuracy(batch: MetricBatch) -> np.ndarray:
+    """
+    Relevance rank accuracy: fraction of the K most relevant pixels which lie inside
+    the ground truth, where K is the number of ground truth pixels. Ties are resolved
+    as in top_pixel_mask.
+    """
+    relevance = batch.flat(batch.relevance)
+    ground_truths = batch.flat(batch.ground_truths)
+    gt_sizes = ground_truths.sum(axis=1)
+    hits = (top_pixel_mask(relevance, gt_sizes) & ground_truths).sum(axis=1)
+
+    values = np.full(len(relevance), np.nan)
+    defined = (gt_sizes > 0) & (batch.total_relevance != 0)
+    values[defined] = hits[defined] / gt_sizes[defined]
+    return values
+
+
+@register_metric("pointing_game")
+def pointing_game(batch: MetricBatch) -> np.ndarray:
+    """
+    Pointing game: 1 if the most relevant pixel lies inside the ground truth, else 0.
+    """
+    relevance = batch.flat(batch.relevance)
+    top = np.argmax(relevance, axis=1)
+    hits = batch.flat(batch.ground_truths)[np.arange(len(top)), top]
+    values = hits.astype(np.float64)
+    values[batch.total_relevance == 0] = np.nan
+    return values
+
+
+def top_pixels(k: Union[float, np.ndarray], num_pixels: int) -> np.ndarray:
+    """
+    Number of pixels in the top k percent of num_pixels pixels (at least 1).
+    """
+    n = np.round(num_pixels * np.asarray(k, dtype=np.float64) / 100)
+    return np.clip(n, 1, num_pixels).astype(np.int64)
+
+
+@register_metric("top_k_mass")
+def top_k_mass(batch: MetricBatch, k: float = 10) -> np.ndarray:
+    """
+    Relevance mass accuracy restricted to the top k percent most relevant pixels.
+    The pixels are selected like in threshold_sweep and the masses are accumulated in
+    float64, so top_k_mass@k matches the sweep curve at k.
+    """
+    relevance = batch.flat(batch.relevance)
+    n = top_pixels(k, relevance.shape[1])
+    top = top_pixel_mask(relevance, np.full(len(relevance), n))
+    top_relevance = np.where(top, relevance, 0)
+    in_gt = batch.flat(batch.ground_truths)
+    correct = np.where(in_gt, top_relevance, 0).sum(axis=1, dtype=np.float64)
+    values = util.divide_or_nan(correct, top_relevance.sum(axis=1, dtype=np.float64))
+    return values.astype(np.result_type(relevance, np.float32))
+
+
+def threshold_sweep(batch: MetricBatch, thresholds: np.ndarray) -> np.ndarray:
+    """
+    Relevance mass accuracy over the top k percent most relevant pixels for every
+    threshold k. Each heatmap's relevance is sorted once. The cumulative sums of the
+    total mass and of the mass inside the ground truth then give every threshold
+    by a lookup.
+
+    Parameters
+    ---
+    batch (MetricBatch)
+        Ground truths and heatmaps
+    thresholds (np.ndarray)
+        Thresholds k in percent, shape T
+
+    Result
+    ---
+    np.ndarray
+        Curves with shape BxT (float32). NaN for heatmaps without relevance.
+    """
+    relevance = batch.flat(batch.relevance)
+    order = np.argsort(-relevance, axis=1, kind="stable")
+    sorted_relevance = np.take_along_axis(relevance, order, axis=1)
+    sorted_in_gt = np.take_along_axis(batch.flat(batch.ground_truths),
+                                      order,
+                                      axis=1)
+    # accumulate in float64, the curves themselves are stored as float32
+    cum_total = np.cumsum(sorted_relevance, axis=1, dtype=np.float64)
+    cum_correct = np.cumsum(np.where(sorted_in_gt, sorted_relevance, 0),
+                            axis=1,
+                            dtype=np.float64)
+    last = top_pixels(thresholds, relevance.shape[1]) - 1
+    curves = util.divide_or_nan(cum_correct[:, last], cum_total[:, last])
+    return curves.astype(np.float32)
+
+
+def get_sweep_thresholds(sweep: dict) -> np.ndarray:
+    """
+    Returns the thresholds (in percent) of the sweep option from the config.
+
+    Parameters
+    ---
+    sweep (dict)
+        sweep option. Either thresholds (list of percentages) or steps (number of
+        equally spaced thresholds up to 100 percent).
+
+    Result
+    ---
+    np.ndarray
+    """
+    if "thresholds" in sweep:
+        return np.asarray(sweep["thresholds"], dtype=np.float64)
+    steps = sweep.get("steps", 20)
+    return np.linspace(100 / steps, 100, steps)
+
+
+class MetricEngine():
+    """
+    Computes all configured metrics on a batch of ground truths and heatmaps.
+    mass_accuracy is always computed, since it's the evaluator's accuracy.
+    """
+
+    def __init__(self,
+                 metric_specs: List[Union[str, dict]] = None,
+                 sweep_thresholds: np.ndarray = None,
+                 profiler: Profiler = None):
+        """
+        Parameters
+        ---
+        metric_specs (List[Union[str, dict]])
+            metrics option from the config. Entries are either a metric name or a dict
+            with the name and the metric's parameters. The optional label key names the
+            result, by default it's the name followed by the parameter values,
+            e.g. top_k_mass@10.
+        sweep_thresholds (np.ndarray)
+            Optional thresholds (in percent) of a threshold sweep
+        profiler (Profiler)
+            Optional profiler recording every metric as the stage metric/<label>
+        """
+        self.sweep_thresholds = sweep_thresholds
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.metrics = {}
+        for spec in ["mass_accuracy"] + list(metric_specs or []):
+            if isinstance(spec, str):
+                spec = {"name": spec}
+            params = {
+                key: value
+                for key, value in spec.items() if key not in ("name", "label")
+            }
+            if spec["name"] not in METRICS:
+                exit("Unknown metric %s, available metrics: %s" %
+                     (spec["name"], ", ".join(METRICS)))
+            label = spec.get("label")
+            if label is None:
+                label = spec["name"] + "".join(
+                    "@%s" % value for value in params.values())
+            self.metrics[label] = (METRICS[spec["name"]], params)
+
+    @property
+    def labels(self) -> List[str]:
+        """
+        Names of the computed metrics, in config order.
+        """
+        return list(self.metrics)
+
+    def compute(self, ground_truths: np.ndarray, heatmaps: np.ndarray) -> dict:
+        """
+        Computes all metrics on a stack of ground truths and heatmaps.
+
+        Parameters
+        ---
+        ground_truths (np.ndarray)
+            Ground truth boolean masks with shape BxHxW
+        heatmaps (np.ndarray)
+            Relevance heatmaps with shape BxHxW
+
+        Result
+        ---
+        dict
+            metric label -> values with shape B. If a sweep is configured, SWEEP_LABEL
+            holds the sweep curves with shape BxT.
+        """
+        batch = MetricBatch(ground_truths, heatmaps)
+        values = {}
+        for label, (func, params) in self.metrics.items():
+            with self.profiler.stage("metric/" + label):
+                values[label] = func(batch, **params)
+        if self.sweep_thresholds is not None:
+            with self.profiler.stage("metric/" + SWEEP_LABEL):
+                values[SWEEP_LABEL] = threshold_sweep(batch, self.sweep_thresholds)
+        return values
+
+
+class RunningMeans():
+    """
+    Running means of the metric values of every attribution method, for heatmaps which
+    are scored as they are produced. Like in the evaluator, values of questions without
+    ground truth (-1) and undefined values (NaN) are skipped. Sweep curves are averaged
+    per threshold.
+    """
+
+    def __init__(self):
+        # attribution method -> metric label -> sum of the values
+        self.sums = {}
+        # attribution method -> metric label -> number of values
+        self.counts = {}
+        # number of scored predictions and of those with a correct answer
+        self.predictions = 0
+        self.correct = 0
+
+    def update(self, method: str, scores: List[dict]) -> None:
+        """
+        Adds the scores of questions.
+
+        Parameters
+        ---
+        method (str)
+            Attribution method
+        scores (List[dict])
+            Metric label -> value (or sweep curve) per question
+        """
+        sums = self.sums.setdefault(method, {})
+        counts = self.counts.setdefault(method, {})
+        for question_scores in scores:
+            for label, value in question_scores.items():
+                value = np.asarray(value, dtype=np.float64)
+                if value.ndim == 0 and not value >= 0:
+                    continue
+                if value.ndim > 0 and np.isnan(value).any():
+                    continue
+                sums[label] = sums.get(label, 0) + value
+                counts[label] = counts.get(label, 0) + 1
+
+    def means(self) -> dict:
+        """
+        Returns the current means.
+
+        Result
+        ---
+        dict
+            Attribution method -> metric label -> mean (or mean sweep curve)
+        """
+        return {
+            method: {
+                label: label_sum / self.counts[method][label]
+                for label, label_sum in method_sums.items()
+            } for method, method_sums in self.sums.items()
+        }
@@ -0,0 +1,156 @@
+"""
+objectmasks.py
+
+objectmasks.py contains the per-object mask archive. For every image it holds one
+boolean mask per scene object, already resized to the heatmap shape and bit-packed.
+The ground truth for any filters (or target_all) is the union of the masks of the
+target objects, a bitwise OR over a few packed rows, so no ground truth needs to be
+stored per filter variant.
+"""
+
+import os
+from typing import List, Tuple
+import numpy as np
+from tqdm import tqdm
+import util
+
+MASKS_FILE = "masks.npy"
+OFFSETS_FILE = "offsets.npy"
+INDEX_FILE = "index.json"
+
+
+class ObjectMaskArchive():
+    """
+    Read-only archive of per-object masks. All masks are stored bit-packed as rows of a
+    single (M,ceil(H*W/8)) uint8 npy file which is memory-mapped. offsets.npy holds the
+    first row of every image, the rows of an image follow the order of the scene
+    objects. index.json holds the mask shape and the image name of every image.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ---
+        path (str)
+            Archive directory
+        """
+        self.path = path
+        self.masks = np.load(os.path.join(path, MASKS_FILE), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        index = util.load_json(os.path.join(path, INDEX_FILE))
+        self.shape = tuple(index["shape"])
+        self.rows = {image: row for row, image in enumerate(index["images"])}
+
+    def __getstate__(self) -> dict:
+        # Reopen the memory map in worker processes instead of pickling the masks
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["path"])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, image: str) -> bool:
+        return image in self.rows
+
+    def ground_truth(self, image: str, object_indices: List[int]) -> np.ndarray:
+        """
+        Returns the union of the masks of the given objects of an image.
+
+        Parameters
+        ---
+        image (str)
+            Image name, e.g. CLEVR_new_000000
+        object_indices (List[int])
+            Indices of the target objects in the scene
+
+        Result
+        ---
+        np.ndarray
+            Boolean ground truth with the shape of the archive
+        """
+        row = self.rows[image]
+        rows = self.offsets[row] + np.asarray(object_indices, dtype=np.int64)
+        assert np.all(rows < self.offsets[row + 1]), \
+            "Object index out of range for image %s" % image
+        packed = np.bitwise_or.reduce(self.masks[rows], axis=0)
+        size = self.shape[0] * self.shape[1]
+        return np.unpackbits(packed, count=size).astype(bool).reshape(self.shape)
+
+
+def open_object_masks(path: str) -> ObjectMaskArchive:
+    """
+    Opens the object mask archive at path.
+
+    Parameters
+    ---
+    path (str)
+        Archive directory. May be None.
+
+    Result
+    ---
+    ObjectMaskArchive
+        None if path is None or there is no archive at path.
+    """
+    if path is None or not os.path.exists(os.path.join(path, MASKS_FILE)):
+        return None
+    return ObjectMaskArchive(path)
+
+
+def build_object_masks(path: str,
+                       images: List[str],
+                       image_cache,
+                       shape: Tuple[int, int],
+                       label_maps=None) -> None:
+    """
+    Splits the mask images of the given images into per-object masks, resizes them to
+    shape and saves them as an archive.
+
+    Parameters
+    ---
+    path (str)
+        Archive directory. Created if it doesn't exist.
+    images (List[str])
+        Image names, e.g. CLEVR_new_000000
+    image_cache (ImageCache)
+        Cache used to load the scenes and masks and their color mappings
+    shape (Tuple[int, int])
+        Shape of the stored masks, i.e. the heatmap shape (Height x Width)
+    label_maps (LabelMapArchive)
+        Optional label maps, used instead of the mask images if they contain the image
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    shape = tuple(shape)
+
+    # The number of rows is the total number of objects
+    offsets = np.zeros(len(images) + 1, dtype=np.int64)
+    for row, image in enumerate(images):
+        offsets[row + 1] = offsets[row] + len(
+            image_cache.get_scene(image)["objects"])
+
+    masks = np.lib.format.open_memmap(os.path.join(path, MASKS_FILE),
+                                      mode="w+",
+                                      dtype=np.uint8,
+                                      shape=(int(offsets[-1]),
+                                             (shape[0] * shape[1] + 7) // 8))
+    print("Building object masks...")
+    for row, image in enumerate(tqdm(images, total=len(images))):
+        if label_maps is not None and image in label_maps:
+            labels = label_maps[image]
+        else:
+            labels = util.mask_to_labels(*image_cache.get_mask(image))
+        num_objects = int(offsets[row + 1] - offsets[row])
+        object_ids = np.arange(num_objects)[:, np.newaxis, np.newaxis]
+        object_masks = util.resize_ground_truth_batch(
+            labels[np.newaxis] == object_ids, shape)
+        masks[offsets[row]:offsets[row + 1]] = np.packbits(
+            object_masks.reshape(num_objects, -1), axis=1)
+
+    masks.flush()
+    np.save(os.path.join(path, OFFSETS_FILE), offsets)
+    util.save_json({
+        "shape": list(shape),
+        "images": list(images)
+    }, os.path.join(path, INDEX_FILE))
@@ -0,0 +1,163 @@
+"""
+prefetch.py
+
+prefetch.py contains a bounded prefetcher which reads the data of upcoming questions
+(heatmaps, scenes and masks) in a small thread pool while the current batch is being
+scored. File reads, npy loading and PNG decoding release the GIL, so the reads overlap
+with the NumPy computations of the main thread.
+"""
+
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable
+
+
+class Prefetcher():
+    """
+    Runs a load function for submitted keys in a thread pool, at most depth keys ahead
+    of the consumer. Keys are consumed with take(), usually in submission order.
+    Keys submitted beyond the depth wait until earlier keys are taken, so the memory
+    held by loaded but unconsumed data is bounded.
+    The time take() has to wait for a load to finish is counted as stall time.
+    """
+
+    def __init__(self, load: Callable, depth: int = 128, threads: int = 4):
+        """
+        Parameters
+        ---
+        load (Callable)
+            Function called in a worker thread with the arguments given to submit().
+            It must not modify state shared with the consumer.
+        depth (int)
+            Maximum number of keys loaded or being loaded and not yet taken
+        threads (int)
+            Number of worker threads
+        """
+        self.load = load
+        self.depth = max(1, depth)
+        self.threads = max(1, threads)
+        self.executor = None
+        # key -> arguments of keys which aren't started yet, in submission order
+        self.waiting = OrderedDict()
+        # key -> future of started keys which aren't taken yet
+        self.started = {}
+        self.stats = _empty_stats()
+
+    def __getstate__(self) -> dict:
+        # Worker processes get an idle prefetcher with their own threads
+        return {"load": self.load, "depth": self.depth, "threads": self.threads}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["load"], depth=state["depth"], threads=state["threads"])
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.started or key in self.waiting
+
+    def submit(self, key: Hashable, *args) -> None:
+        """
+        Schedules load(*args) for key. Keys which are already submitted are ignored.
+
+        Parameters
+        ---
+        key (Hashable)
+            Key used to take the loaded data
+        args
+            Arguments of the load function
+        """
+        if key in self:
+            return
+        self.waiting[key] = args
+        self._fill()
+
+    def _fill(self) -> None:
+        """
+        Starts waiting keys until depth keys are started.
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        while self.waiting and len(self.started) < self.depth:
+            key, args = self.waiting.popitem(last=False)
+            self.started[key] = self.executor.submit(self.load, *args)
+
+    def take(self, key: Hashable):
+        """
+        Returns the loaded data of a submitted key, waiting for the load to finish.
+        Exceptions raised by the load function are raised here.
+
+        Parameters
+        ---
+        key (Hashable)
+            Submitted key
+
+        Result
+        ---
+        Return value of the load function
+        """
+        future = self.started.pop(key, None)
+        if future is None:
+            # taken out of order before it was started
+            future = self.executor.submit(self.load, *self.waiting.pop(key))
+        self.stats["items"] += 1
+        if not future.done():
+            start = time.perf_counter()
+            result = future.result()
+            self.stats["stalls"] += 1
+            self.stats["stall_seconds"] += time.perf_counter() - start
+        else:
+            result = future.result()
+        self._fill()
+        return result
+
+    def pop_stats(self) -> dict:
+        """
+        Returns the counters since the last call and resets them.
+
+        Result
+        ---
+        dict
+            items (number of taken keys), stalls (number of takes which had to wait)
+            and stall_seconds (total waiting time)
+        """
+        stats = self.stats
+        self.stats = _empty_stats()
+        return stats
+
+    def close(self) -> None:
+        """
+        Drops all pending keys and stops the worker threads.
+        """
+        self.waiting.clear()
+        for future in self.started.values():
+            future.cancel()
+        self.started.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+def _empty_stats() -> dict:
+    return {"items": 0, "stalls": 0, "stall_seconds": 0.0}
+
+
+def merge_stats(total: dict, stats: dict) -> dict:
+    """
+    Adds the counters of stats to total (e.g. the stats of several workers).
+
+    Parameters
+    ---
+    total (dict)
+        Counters as returned by Prefetcher.pop_stats. May be None.
+    stats (dict)
+        Counters to add
+
+    Result
+    ---
+    dict
+        The updated total
+    """
+    if total is None:
+        total = _empty_stats()
+    for key, value in stats.items():
+        total[key] += value
+    return total
@@ -0,0 +1,204 @@
+"""
+profiling.py
+
+profiling.py contains the instrumentation of the evaluator. Stages (scene loading, mask
+decoding, ground truth resizing, metrics, ...) are timed with
+
+with profiler.stage("scene_load") as stage:
+    ...
+    stage.add_bytes(nbytes)
+
+and events are counted with profiler.count(name). A disabled profiler hands out a
+shared stage which does nothing, so the instrumentation can stay in place.
+"""
+
+import time
+import threading
+
+
+class _Stage():
+    """
+    Times one call of a stage and records it when the with block is left.
+    """
+
+    __slots__ = ("profiler", "name", "nbytes", "start")
+
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.nbytes = 0
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.profiler.record(self.name,
+                             time.perf_counter() - self.start,
+                             nbytes=self.nbytes)
+
+    def add_bytes(self, nbytes: int) -> None:
+        """
+        Adds to the number of bytes read by this call.
+        """
+        self.nbytes += nbytes
+
+
+class _NullStage():
+    """
+    Stage of a disabled profiler.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def add_bytes(self, nbytes: int) -> None:
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Profiler():
+    """
+    Records the wall time, number of calls and bytes read per stage and named event
+    counters. Stages may be recorded from several threads (e.g. prefetch threads), so
+    the time of a stage can exceed the wall time of the run.
+    The records of worker processes are collected with pop() and added to the main
+    process' profiler with merge().
+    """
+
+    def __init__(self, enabled: bool = False):
+        """
+        Parameters
+        ---
+        enabled (bool)
+            If False, nothing is recorded
+        """
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        # stage name -> [calls, seconds, bytes]
+        self.stages = {}
+        # counter name -> count
+        self.counters = {}
+
+    def __getstate__(self) -> dict:
+        # Worker processes start with empty records
+        return {"enabled": self.enabled}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["enabled"])
+
+    def stage(self, name: str):
+        """
+        Returns a context manager which times a call of a stage.
+
+        Parameters
+        ---
+        name (str)
+            Stage name
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self,
+               name: str,
+               seconds: float,
+               nbytes: int = 0,
+               calls: int = 1) -> None:
+        """
+        Adds calls of a stage.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0])
+            stage[0] += calls
+            stage[1] += seconds
+            stage[2] += nbytes
+
+    def count(self, name: str, num: int = 1) -> None:
+        """
+        Adds num to the counter name.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + num
+
+    def pop(self) -> dict:
+        """
+        Returns the records since the last call and resets them.
+
+        Result
+        ---
+        dict
+            stages (name -> [calls, seconds, bytes]) and counters (name -> count).
+            None if the profiler is disabled.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            records = {"stages": self.stages, "counters": self.counters}
+            self.stages = {}
+            self.counters = {}
+        return records
+
+    def merge(self, records: dict) -> None:
+        """
+        Adds records returned by pop() (e.g. of a worker process).
+        """
+        if not self.enabled or records is None:
+            return
+        for name, (calls, seconds, nbytes) in records["stages"].items():
+            self.record(name, seconds, nbytes=nbytes, calls=calls)
+        for name, num in records["counters"].items():
+            self.count(name, num)
+
+    def report(self, **info) -> dict:
+        """
+        Returns the profile: the records of every stage, the counters and the hit rate
+        of every cache with <cache>_hits and <cache>_misses counters.
+
+        Parameters
+        ---
+        info
+            Further entries of the profile, e.g. the number of workers
+
+        Result
+        ---
+        dict
+        """
+        stages = {}
+        for name in sorted(self.stages):
+            calls, seconds, nbytes = self.stages[name]
+            stages[name] = {
+                "calls": calls,
+                "seconds": seconds,
+                "mean_ms": 1000 * seconds / calls if calls else 0.0,
+                "bytes": nbytes
+            }
+        hit_rates = {}
+        for name in sorted(self.counters):
+            if not name.endswith("_hits"):
+                continue
+            cache = name[:-len("_hits")]
+            hits = self.counters[name]
+            total = hits + self.counters.get(cache + "_misses", 0)
+            hit_rates[cache] = hits / total if total else 0.0
+        profile = dict(info)
+        profile.update({
+            "wall_seconds": time.perf_counter() - self.start,
+            "stages": stages,
+            "counters": dict(sorted(self.counters.items())),
+            "hit_rates": hit_rates
+        })
+        return profile
@@ -0,0 +1,184 @@
+"""
+results.py
+
+results.py contains the results log used to checkpoint evaluation runs. Every scored
+question is appended to a JSON Lines file, so an interrupted run can be resumed by
+skipping the questions which are already in the log.
+"""
+
+import os
+import json
+import numpy as np
+import util
+
+
+class ResultsLog():
+    """
+    Append-only JSON Lines log of per-question scores. The first line holds a header
+    describing the run (prediction file, attribution methods, metrics, ...). Resuming
+    with a different header is refused, since the logged scores wouldn't be comparable.
+    Every following line holds the position of the prediction in the prediction file,
+    its question_index, its scores (attribution method -> metric -> value) and the
+    NumPy dtypes of the scores, which are restored on loading. Aggregates of a resumed
+    run are therefore identical to those of an uninterrupted run.
+    """
+
+    def __init__(self, path: str, header: dict):
+        """
+        Opens the log and reads the results of previous runs.
+
+        Parameters
+        ---
+        path (str)
+            Log file path. Created if it doesn't exist.
+        header (dict)
+            Description of the run. Must be JSON serializable.
+        """
+        self.path = path
+        # compare the header the way it's read back from the log
+        self.header = json.loads(json.dumps(header))
+        # position -> scores and position -> question_index
+        self.results = {}
+        self.ques_ids = {}
+        # number of results appended since the last flush
+        self.pending = 0
+        self.file = None
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self) -> None:
+        """
+        Reads the results of previous runs. A truncated last line (e.g. the run was
+        killed while writing) is skipped.
+        """
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    print("Warning: skipping a truncated line in %s" % self.path)
+                    continue
+                if "header" in record:
+                    if record["header"] != self.header:
+                        exit("Results log %s was written by a run with a different "
+                             "configuration. Exiting..." % self.path)
+                    continue
+                dtypes = record.get("dtypes", {})
+                self.results[record["position"]] = {
+                    method: {
+                        label: _from_json(value,
+                                          dtypes.get(method, {}).get(label))
+                        for label, value in method_scores.items()
+                    } for method, method_scores in record["scores"].items()
+                }
+                self.ques_ids[record["position"]] = record["question_index"]
+
+    def scored(self) -> set:
+        """
+        Returns the question indices which are already in the log.
+
+        Result
+        ---
+        set
+        """
+        return set(self.ques_ids.values())
+
+    def append(self, position: int, ques_id: int, scores: dict) -> None:
+        """
+        Appends the scores of a question. They are written to disk by flush().
+
+        Parameters
+        ---
+        position (int)
+            Position of the prediction in the prediction file
+        ques_id (int)
+            question_index
+        scores (dict)
+            Attribution method -> metric -> value (or sweep curve)
+        """
+        if self.file is None:
+            self._open()
+        record = {
+            "position": position,
+            "question_index": ques_id,
+            "scores": {
+                method: {
+                    label: _to_json(value)
+                    for label, value in method_scores.items()
+                } for method, method_scores in scores.items()
+            },
+            "dtypes": {
+                method: {
+                    label: str(value.dtype)
+                    for label, value in method_scores.items()
+                    if isinstance(value, (np.ndarray, np.generic))
+                } for method, method_scores in scores.items()
+            }
+        }
+        self.file.write(json.dumps(record) + "\n")
+        self.results[position] = scores
+        self.ques_ids[position] = ques_id
+        self.pending += 1
+
+    def _open(self) -> None:
+        """
+        Opens the log for appending and writes the header to a new log.
+        """
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        util.ensure_parent_dir(self.path)
+        self.file = open(self.path, "a")
+        if not exists:
+            self.file.write(json.dumps({"header": self.header}) + "\n")
+        elif not _ends_with_newline(self.path):
+            # start a new line after a truncated last line
+            self.file.write("\n")
+
+    def flush(self) -> None:
+        """
+        Writes the appended results to disk.
+        """
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self) -> None:
+        """
+        Flushes and closes the log.
+        """
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def _to_json(value):
+    """
+    Converts a score (number or numpy array) to a JSON serializable value.
+    """
+    if np.ndim(value) > 0:
+        return np.asarray(value).tolist()
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    return float(value)
+
+
+def _from_json(value, dtype: str = None):
+    """
+    Converts a logged score back to its NumPy dtype. Values without dtype (Python
+    numbers and logs written without dtypes) are returned as they are.
+    """
+    if dtype is None:
+        return value
+    if isinstance(value, list):
+        return np.array(value, dtype=dtype)
+    return np.dtype(dtype).type(value)
+
+
+def _ends_with_newline(filepath: str) -> bool:
+    """
+    Returns True if the last byte of a (non-empty) file is a newline.
+    """
+    with open(filepath, "rb") as file:
+        file.seek(-1, os.SEEK_END)
+        return file.read(1) == b"\n"
@@ -0,0 +1,303 @@
+"""
+server.py
+
+server.py contains the scoring server. It keeps an evaluator with its question catalog
+and ground truth store loaded and scores heatmaps sent over a local Unix socket or
+localhost HTTP, so repeated evaluations (e.g. the trials of a hyperparameter sweep)
+don't pay the startup cost. Requests are handled one at a time.
+
+POST /score    Scores heatmaps. Either a JSON body
+               {"question_index": [...], "answer": [...], "heatmap_path": [...],
+                "method": "lrp"}
+               with heatmap npy files, or an npz body (Content-Type application/x-npz)
+               holding the BxHxW array heatmaps and the JSON request (without
+               heatmap_path) as the string request. Returns {"scores": [...]}, see
+               UniqueCLEVREvaluator.score_batch.
+GET  /running  Returns the running means of all scored heatmaps.
+POST /reset    Resets the running means.
+GET  /health   Returns {"status": "ok"}.
+"""
+
+import os
+import io
+import json
+import signal
+import socket
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Tuple, Union
+import numpy as np
+import util
+
+NPZ_CONTENT_TYPE = "application/x-npz"
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of a scoring server. The evaluator is server.evaluator.
+    """
+
+    def do_GET(self) -> None:
+        if self.path == "/health":
+            self._send_json({"status": "ok"})
+        elif self.path == "/running":
+            evaluator = self.server.evaluator
+            self._send_json({
+                "means": evaluator.get_running_means(),
+                "predictions": evaluator.running.predictions,
+                "correct": evaluator.running.correct
+            })
+        else:
+            self._send_json({"error": "Unknown path %s" % self.path}, status=404)
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/reset":
+            self.server.evaluator.reset_running_means()
+            self._send_json({"status": "ok"})
+            return
+        if self.path != "/score":
+            self._send_json({"error": "Unknown path %s" % self.path}, status=404)
+            return
+        try:
+            if self.headers.get("Content-Type") == NPZ_CONTENT_TYPE:
+                with np.load(io.BytesIO(body), allow_pickle=False) as payload:
+                    request = json.loads(str(payload["request"]))
+                    heatmap_list = payload["heatmaps"]
+                if heatmap_list.ndim == 2:
+                    heatmap_list = heatmap_list[np.newaxis]
+            else:
+                request = json.loads(body)
+                heatmap_list = [
+                    util.load_heatmap(path) for path in request["heatmap_path"]
+                ]
+            scores = self.server.evaluator.score_batch(request["question_index"],
+                                                       request["answer"],
+                                                       heatmap_list,
+                                                       method=request.get("method"))
+        except (KeyError, TypeError, ValueError, AssertionError, OSError) as error:
+            self._send_json({"error": "%s: %s" % (type(error).__name__, error)},
+                            status=400)
+            return
+        self._send_json({"scores": scores})
+
+    def _send_json(self, data, status: int = 200) -> None:
+        payload = json.dumps(_to_json(data)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format: str, *args) -> None:
+        # Don't log every request
+        pass
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """
+    HTTP server listening on a Unix socket.
+    """
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ""
+
+
+def parse_address(address: str) -> Union[str, Tuple[str, int]]:
+    """
+    Parses a server address: a port or host:port for HTTP, anything else is the path of
+    a Unix socket.
+
+    Result
+    ---
+    Union[str, Tuple[str, int]]
+        Socket path or (host, port). The host defaults to 127.0.0.1.
+    """
+    host, _, port = address.rpartition(":")
+    if port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+def _interrupt(signum, frame) -> None:
+    raise KeyboardInterrupt
+
+
+def serve(evaluator, address: str) -> None:
+    """
+    Serves scoring requests until interrupted (Ctrl+C or SIGTERM).
+
+    Parameters
+    ---
+    evaluator (UniqueCLEVREvaluator)
+        Evaluator scoring the heatmaps
+    address (str)
+        Port, host:port or Unix socket path, see parse_address
+    """
+    address = parse_address(address)
+    if isinstance(address, str):
+        if os.path.exists(address):
+            # left behind by a server which didn't shut down
+            os.remove(address)
+        server = UnixHTTPServer(address, ScoringRequestHandler)
+    else:
+        server = HTTPServer(address, ScoringRequestHandler)
+    server.evaluator = evaluator
+    print("Serving scoring requests on %s" % (address,))
+    # stop like on Ctrl+C, so the caller still saves the warm ground truths
+    previous_handler = signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        server.server_close()
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix socket.
+    """
+
+    def __init__(self, socket_path: str, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ScoringClient():
+    """
+    Client of a scoring server.
+    """
+
+    def __init__(self, address: str, timeout: float = None):
+        """
+        Parameters
+        ---
+        address (str)
+            Address of the server, see parse_address
+        timeout (float)
+            Socket timeout in seconds
+        """
+        self.address = parse_address(address)
+        self.timeout = timeout
+
+    def _request(self,
+                 method: str,
+                 path: str,
+                 body: bytes = None,
+                 headers: dict = None) -> dict:
+        if isinstance(self.address, str):
+            connection = _UnixHTTPConnection(self.address, timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(*self.address,
+                                                    timeout=self.timeout)
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            data = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError(data.get("error", "HTTP %d" % response.status))
+        return data
+
+    def score(self,
+              question_indices: list,
+              answers: list,
+              heatmap_list: Union[list, np.ndarray],
+              method: str = None) -> list:
+        """
+        Scores in-memory heatmaps. They are sent with the request as a single npz
+        buffer.
+
+        Parameters
+        ---
+        question_indices (list)
+            question_index of every heatmap
+        answers (list)
+            Predicted answer of every heatmap
+        heatmap_list (Union[list, np.ndarray])
+            Heatmaps of the same shape or a BxHxW array
+        method (str)
+            Attribution method the server keeps the running means for
+
+        Result
+        ---
+        list
+            Metric label -> value per heatmap (null for undefined values), None if the
+            answer is wrong
+        """
+        request = {
+            "question_index": [int(ques_id) for ques_id in question_indices],
+            "answer": list(answers),
+            "method": method
+        }
+        buffer = io.BytesIO()
+        np.savez(buffer,
+                 heatmaps=np.asarray(heatmap_list),
+                 request=np.array(json.dumps(request)))
+        return self._request("POST", "/score", buffer.getvalue(),
+                             {"Content-Type": NPZ_CONTENT_TYPE})["scores"]
+
+    def score_files(self,
+                    question_indices: list,
+                    answers: list,
+                    heatmap_paths: list,
+                    method: str = None) -> list:
+        """
+        Scores heatmap npy files, which are read by the server. See score.
+        """
+        request = {
+            "question_index": [int(ques_id) for ques_id in question_indices],
+            "answer": list(answers),
+            "heatmap_path": list(heatmap_paths),
+            "method": method
+        }
+        return self._request("POST", "/score",
+                             json.dumps(request).encode(),
+                             {"Content-Type": "application/json"})["scores"]
+
+    def running(self) -> dict:
+        """
+        Returns the running means, the number of scored predictions and of those with
+        a correct answer.
+        """
+        return self._request("GET", "/running")
+
+    def reset(self) -> None:
+        """
+        Resets the running means.
+        """
+        self._request("POST", "/reset")
+
+
+def _to_json(value):
+    """
+    Converts numpy values in a response to JSON serializable values. NaN becomes null.
+    """
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return [_to_json(item) for item in value.tolist()]
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
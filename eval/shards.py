@@ -0,0 +1,203 @@
+"""
+shards.py
+
+shards.py contains the partitioning of an evaluation into shards and the partial
+results files of the shards. Every shard evaluates the predictions whose question
+(or image) falls into it and saves its per-question values together with their sums
+and counts. Merging the partial results of all shards gives exactly the results of a
+single run, since the per-question values keep their dtype and their position in the
+prediction file.
+"""
+
+import os
+import json
+import zlib
+from typing import List, Tuple
+import numpy as np
+import metrics
+import util
+
+# Partitioning keys of the shard_by option
+SHARD_KEYS = ("image", "question_index")
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Parses a shard given as i/n (0 <= i < n).
+
+    Result
+    ---
+    Tuple[int, int]
+        Shard index and number of shards
+    """
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        exit("Invalid shard %s, expected i/n. Exiting..." % shard)
+    if count < 1 or not 0 <= index < count:
+        exit("Invalid shard %s, expected 0 <= i < n. Exiting..." % shard)
+    return index, count
+
+
+def shard_of(question: dict, num_shards: int, shard_by: str = "image") -> int:
+    """
+    Returns the shard of a question. Questions are partitioned by a checksum of their
+    image name, so all questions about an image are in the same shard and share its
+    cached scene and mask, or by their question_index.
+
+    Parameters
+    ---
+    question (dict)
+        Question dictionary
+    num_shards (int)
+        Number of shards
+    shard_by (str)
+        image or question_index
+
+    Result
+    ---
+    int
+    """
+    if shard_by == "question_index":
+        return question["question_index"] % num_shards
+    # crc32 doesn't depend on the process like hash() does
+    return zlib.crc32(question["image"].encode()) % num_shards
+
+
+def get_partial_path(partial_dir: str, shard: Tuple[int, int]) -> str:
+    """
+    Returns the path of the partial results file of a shard.
+    """
+    return os.path.join(partial_dir, "shard_%d_of_%d.npz" % shard)
+
+
+def save_partial(path: str, header: dict, results: dict, ques_ids: dict,
+                 labels: List[str]) -> None:
+    """
+    Saves the results of a shard. For every attribution method and metric the
+    per-question values (in the dtype of the scores, -1 for questions without ground
+    truth) are saved along with their sum and count. Sweep curves are saved per method
+    with a flag marking the questions which have one.
+
+    Parameters
+    ---
+    path (str)
+        Partial results file (npz)
+    header (dict)
+        Description of the run, including the shard
+    results (dict)
+        Position in the prediction file -> attribution method -> metric -> value
+    ques_ids (dict)
+        Position in the prediction file -> question_index
+    labels (List[str])
+        Metric labels
+    """
+    positions = sorted(results)
+    arrays = {
+        "position": np.array(positions, dtype=np.int64),
+        "question_index": np.array([ques_ids[position] for position in positions],
+                                   dtype=np.int64)
+    }
+    columns = []
+    sums = {}
+    counts = {}
+    for method in header["methods"]:
+        sums[method] = {}
+        counts[method] = {}
+        for label in labels:
+            values = [results[position][method][label] for position in positions]
+            valid = [value for value in values if value >= 0]
+            dtypes = {np.asarray(value).dtype for value in valid}
+            dtype = np.result_type(*dtypes) if dtypes else np.float64
+            arrays["values_%d" % len(columns)] = np.array(values, dtype=dtype)
+            columns.append([method, label])
+            sums[method][label] = float(np.sum(np.array(valid, dtype=np.float64)))
+            counts[method][label] = len(valid)
+        if "sweep" in header:
+            curves = np.full((len(positions), len(header["sweep"])),
+                             np.nan,
+                             dtype=np.float32)
+            has_curve = np.zeros(len(positions), dtype=bool)
+            for row, position in enumerate(positions):
+                curve = results[position][method][metrics.SWEEP_LABEL]
+                if np.ndim(curve) > 0:
+                    curves[row] = curve
+                    has_curve[row] = True
+            arrays["curves_%s" % method] = curves
+            arrays["has_curve_%s" % method] = has_curve
+
+    summary = dict(header, columns=columns, sums=sums, counts=counts)
+    arrays["header"] = np.array(json.dumps(summary))
+    util.ensure_parent_dir(path)
+    # write to a temporary file first, so an interrupted shard leaves no partial file
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_partials(paths: List[str]) -> Tuple[dict, dict, dict]:
+    """
+    Loads and combines the partial results of all shards of a run. Exits if the files
+    were written by different runs or shards are missing or duplicated.
+
+    Parameters
+    ---
+    paths (List[str])
+        Partial results files
+
+    Result
+    ---
+    dict
+        Header of the run (without the shard)
+    dict
+        Position in the prediction file -> attribution method -> metric -> value
+    dict
+        Position in the prediction file -> question_index
+    """
+    run_header = None
+    shards = set()
+    results = {}
+    ques_ids = {}
+    for path in paths:
+        with np.load(path) as partial:
+            header = json.loads(str(partial["header"]))
+            shard = tuple(header.pop("shard"))
+            columns = header.pop("columns")
+            sums = header.pop("sums")
+            counts = header.pop("counts")
+            if run_header is None:
+                run_header = header
+            elif header != run_header:
+                exit("Partial results %s were written by a different run. Exiting..." %
+                     path)
+            if shard in shards:
+                exit("Shard %d/%d was given twice. Exiting..." % shard)
+            shards.add(shard)
+
+            positions = partial["position"].tolist()
+            for position, ques_id in zip(positions, partial["question_index"].tolist()):
+                ques_ids[position] = ques_id
+                results[position] = {method: {} for method in header["methods"]}
+            for column, (method, label) in enumerate(columns):
+                values = partial["values_%d" % column]
+                for row, position in enumerate(positions):
+                    results[position][method][label] = values[row]
+                valid = values[values >= 0]
+                assert len(valid) == counts[method][label] and np.isclose(
+                    valid.sum(dtype=np.float64), sums[method][label]), \
+                    "Partial results %s are inconsistent!" % path
+            if "sweep" in header:
+                for method in header["methods"]:
+                    curves = partial["curves_%s" % method]
+                    has_curve = partial["has_curve_%s" % method]
+                    for row, position in enumerate(positions):
+                        results[position][method][metrics.SWEEP_LABEL] = (
+                            curves[row] if has_curve[row] else -1)
+
+    if run_header is None:
+        exit("No partial results given. Exiting...")
+    missing = sorted(
+        set(range(run_header["num_shards"])) - {index for index, _ in shards})
+    if missing:
+        exit("Missing partial results of shards %s. Exiting..." % missing)
+    return run_header, results, ques_ids
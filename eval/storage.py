@@ -0,0 +1,571 @@
+"""
+storage.py
+
+storage.py contains the on-disk stores for precomputed Unique CLEVR ground truths.
+"""
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+import numpy as np
+import util
+
+# Files of a packed ground truth store
+PACKED_DATA_FILE = "data.bin"
+PACKED_INDEX_FILE = "index.npy"
+# One index row per ground truth: byte offset of the packed mask in the data file and
+# the shape of the mask
+PACKED_INDEX_DTYPE = np.dtype([("question_index", np.int64), ("offset", np.int64),
+                               ("height", np.int32), ("width", np.int32)])
+# Fingerprint of the inputs of every ground truth and whether the question has one
+# (questions without target objects don't). The fingerprint is stored as raw bytes,
+# since fixed size byte strings would drop trailing zero bytes.
+FINGERPRINT_DTYPE = np.dtype([("question_index", np.int64),
+                              ("fingerprint", np.uint8, (16,)),
+                              ("has_ground_truth", bool)])
+
+
+class DirectoryGroundTruthWriter():
+    """
+    Writes every ground truth to its own file <question_index>.npy inside a directory.
+    Ground truths are written as soon as they are passed to write().
+    """
+
+    def __init__(self, path: str, append: bool = False):
+        """
+        Parameters
+        ---
+        path (str)
+            Ground truth directory. Created if it doesn't exist.
+        append (bool)
+            Unused, existing ground truths are always kept.
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def write(self, ques_id: int, ground_truth: np.ndarray) -> None:
+        """
+        Write a single ground truth.
+
+        Parameters
+        ---
+        ques_id (int)
+            question_index of the ground truth
+        ground_truth (np.ndarray)
+            Boolean ground truth mask
+        """
+        np.save(os.path.join(self.path, str(ques_id) + ".npy"), ground_truth)
+
+    def remove(self, ques_id: int) -> None:
+        """
+        Remove the ground truth of a question if it exists.
+
+        Parameters
+        ---
+        ques_id (int)
+            question_index of the ground truth
+        """
+        path = os.path.join(self.path, str(ques_id) + ".npy")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def flush(self) -> None:
+        """
+        Nothing to flush, all ground truths are already on disk.
+        """
+
+    def close(self) -> None:
+        """
+        Nothing to flush, all ground truths are already on disk.
+        """
+
+
+class SingleFileGroundTruthWriter():
+    """
+    Writes all ground truths as a single pickled dict to a npy file.
+    The file can only be written as a whole, so ground truths are kept in memory
+    until close() is called.
+    """
+
+    def __init__(self, path: str, append: bool = False):
+        """
+        Parameters
+        ---
+        path (str)
+            Ground truth npy file path
+        append (bool)
+            Keep the ground truths of an existing file
+        """
+        self.path = path
+        self.ground_truth = {}
+        if append and os.path.exists(path):
+            self.ground_truth = np.load(path, allow_pickle=True)[()]
+
+    def write(self, ques_id: int, ground_truth: np.ndarray) -> None:
+        """
+        Add a single ground truth.
+
+        Parameters
+        ---
+        ques_id (int)
+            question_index of the ground truth
+        ground_truth (np.ndarray)
+            Boolean ground truth mask
+        """
+        self.ground_truth[ques_id] = ground_truth
+
+    def remove(self, ques_id: int) -> None:
+        """
+        Remove the ground truth of a question if it exists.
+
+        Parameters
+        ---
+        ques_id (int)
+            question_index of the ground truth
+        """
+        self.ground_truth.pop(ques_id, None)
+
+    def flush(self) -> None:
+        """
+        Save all collected ground truths. The whole file is rewritten.
+        """
+        np.save(self.path, self.ground_truth)
+
+    def close(self) -> None:
+        """
+        Save all collected ground truths.
+        """
+        self.flush()
+
+
+class PackedGroundTruthWriter():
+    """
+    Writes all ground truths bit-packed (np.packbits) into a single data file inside a
+    <name>.packed directory. Ground truths are appended as soon as they are passed to
+    write(), the offset index is written by flush() and close().
+    """
+
+    def __init__(self, path: str, append: bool = False):
+        """
+        Parameters
+        ---
+        path (str)
+            Packed store directory. Created if it doesn't exist.
+        append (bool)
+            Append to an existing store instead of replacing it
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        data_path = os.path.join(path, PACKED_DATA_FILE)
+        index_path = os.path.join(path, PACKED_INDEX_FILE)
+        self.index = []
+        # question indices whose index rows are dropped by the next flush()
+        self.removed = set()
+        if append and os.path.exists(index_path) and os.path.exists(data_path):
+            self.index = np.load(index_path).tolist()
+            # Bytes written after the last index update aren't referenced, new ground
+            # truths are appended after them
+            self.data_file = open(data_path, "ab")
+            self.offset = os.path.getsize(data_path)
+        else:
+            self.data_file = open(data_path, "wb")
+            self.offset = 0
+
+    def write(self, ques_id: int, ground_truth: np.ndarray) -> None:
+        """
+        Append a single ground truth.
+
+        Parameters
+        ---
+        ques_id (int)
+            question_index of the ground truth
+        ground_truth (np.ndarray)
+            Boolean ground truth mask
+        """
+        packed = np.packbits(ground_truth.ravel())
+        self.data_file.write(packed.tobytes())
+        self.index.append(
+            (ques_id, self.offset, ground_truth.shape[0], ground_truth.shape[1]))
+        self.offset += packed.nbytes
+        self.removed.discard(ques_id)
+
+    def remove(self, ques_id: int) -> None:
+        """
+        Remove the ground truth of a question if it exists. Its index row is dropped by
+        the next flush(), the packed data stays unreferenced in the data file.
+
+        Parameters
+        ---
+        ques_id (int)
+            question_index of the ground truth
+        """
+        self.removed.add(ques_id)
+
+    def flush(self) -> None:
+        """
+        Flush the data file and save the index sorted by question_index. The index is
+        replaced atomically, so the store stays readable if the process is killed.
+        A question written more than once is looked up at its last entry, removed
+        questions are dropped.
+        """
+        self.data_file.flush()
+        os.fsync(self.data_file.fileno())
+        if self.removed:
+            self.index = [row for row in self.index if row[0] not in self.removed]
+            self.removed = set()
+        index = np.array(self.index, dtype=PACKED_INDEX_DTYPE)
+        # keep the last entry of every question_index
+        _, last = np.unique(index["question_index"][::-1], return_index=True)
+        index = index[len(index) - 1 - last]
+        index.sort(order="question_index")
+        index_path = os.path.join(self.path, PACKED_INDEX_FILE)
+        tmp_path = os.path.join(self.path, "tmp_" + PACKED_INDEX_FILE)
+        np.save(tmp_path, index)
+        os.replace(tmp_path, index_path)
+
+    def close(self) -> None:
+        """
+        Save the index and close the data file.
+        """
+        self.flush()
+        self.data_file.close()
+
+
+class PackedGroundTruthStore():
+    """
+    Read access to a packed ground truth store with the dict interface used by the
+    evaluator. Opening the store only loads the index, the data file is memory-mapped
+    and a ground truth is unpacked when it is accessed.
+    Ground truths added with store[question_index] = ground_truth are kept in memory.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ---
+        path (str)
+            Packed store directory
+        """
+        self.path = path
+        self.index = np.load(os.path.join(path, PACKED_INDEX_FILE))
+        data_path = os.path.join(path, PACKED_DATA_FILE)
+        if os.path.getsize(data_path) > 0:
+            self.data = np.memmap(data_path, dtype=np.uint8, mode="r")
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+        self.added = {}
+
+    def __getstate__(self) -> dict:
+        # Reopen the memory map in worker processes instead of pickling the data
+        return {"path": self.path, "added": self.added}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["path"])
+        self.added = state["added"]
+
+    def _find(self, ques_id: int) -> int:
+        """
+        Returns the index row of a question or -1 if it's not in the store.
+        """
+        row = np.searchsorted(self.index["question_index"], ques_id)
+        if row < len(self.index) and self.index["question_index"][row] == ques_id:
+            return row
+        return -1
+
+    def __len__(self) -> int:
+        return len(self.index) + len(self.added)
+
+    def __contains__(self, ques_id: int) -> bool:
+        return ques_id in self.added or self._find(ques_id) >= 0
+
+    def __getitem__(self, ques_id: int) -> np.ndarray:
+        if ques_id in self.added:
+            return self.added[ques_id]
+        row = self._find(ques_id)
+        if row < 0:
+            raise KeyError(ques_id)
+        entry = self.index[row]
+        size = int(entry["height"]) * int(entry["width"])
+        start = int(entry["offset"])
+        packed = self.data[start:start + (size + 7) // 8]
+        ground_truth = np.unpackbits(packed, count=size).astype(bool)
+        return ground_truth.reshape(int(entry["height"]), int(entry["width"]))
+
+    def __setitem__(self, ques_id: int, ground_truth: np.ndarray) -> None:
+        self.added[ques_id] = ground_truth
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, ques_id: int, default: np.ndarray = None) -> np.ndarray:
+        if ques_id in self:
+            return self[ques_id]
+        return default
+
+    def keys(self) -> list:
+        return [int(i) for i in self.index["question_index"]] + list(self.added)
+
+
+class LazyGroundTruthDirectory():
+    """
+    Read access to a ground truth directory (one <question_index>.npy file per question)
+    with the dict interface used by the evaluator. Opening the directory only lists the
+    files, a ground truth is loaded when it is first accessed.
+    Loaded ground truths are kept in a bounded least recently used cache. prefetch()
+    loads the ground truths of upcoming questions in background threads.
+    Ground truths added with store[question_index] = ground_truth are kept in memory.
+    """
+
+    def __init__(self,
+                 path: str,
+                 cache_size: int = 1024,
+                 prefetch_threads: int = 2):
+        """
+        Parameters
+        ---
+        path (str)
+            Ground truth directory
+        cache_size (int)
+            Maximum number of loaded ground truths kept in memory. None for no limit.
+        prefetch_threads (int)
+            Number of threads loading prefetched ground truths
+        """
+        self.path = path
+        self.cache_size = cache_size
+        self.prefetch_threads = prefetch_threads
+        self.ques_ids = set()
+        for name in os.listdir(path):
+            idx, ext = os.path.splitext(name)
+            if ext == ".npy":
+                self.ques_ids.add(int(idx))
+        self.added = {}
+        self.cache = OrderedDict()
+        # question_index -> future of a prefetched ground truth
+        self.pending = {}
+        self.executor = None
+
+    def __getstate__(self) -> dict:
+        # Threads can't be pickled, worker processes start with an empty cache
+        return {
+            "path": self.path,
+            "cache_size": self.cache_size,
+            "prefetch_threads": self.prefetch_threads,
+            "added": self.added
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["path"], state["cache_size"],
+                      state["prefetch_threads"])
+        self.added = state["added"]
+
+    def _file(self, ques_id: int) -> str:
+        return os.path.join(self.path, str(ques_id) + ".npy")
+
+    def prefetch(self, ques_ids: Iterable[int]) -> None:
+        """
+        Starts loading the ground truths of questions which will be accessed soon.
+        Questions which are cached, already prefetched or not stored are ignored.
+
+        Parameters
+        ---
+        ques_ids (Iterable[int])
+            question indices
+        """
+        for ques_id in ques_ids:
+            if (ques_id in self.cache or ques_id in self.pending
+                    or ques_id in self.added or ques_id not in self.ques_ids):
+                continue
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.prefetch_threads)
+            self.pending[ques_id] = self.executor.submit(np.load,
+                                                         self._file(ques_id))
+
+    def __len__(self) -> int:
+        return len(self.ques_ids | set(self.added))
+
+    def __contains__(self, ques_id: int) -> bool:
+        return ques_id in self.added or ques_id in self.ques_ids
+
+    def __getitem__(self, ques_id: int) -> np.ndarray:
+        if ques_id in self.added:
+            return self.added[ques_id]
+        if ques_id in self.cache:
+            self.cache.move_to_end(ques_id)
+            return self.cache[ques_id]
+        if ques_id not in self.ques_ids:
+            raise KeyError(ques_id)
+        if ques_id in self.pending:
+            ground_truth = self.pending.pop(ques_id).result()
+        else:
+            ground_truth = np.load(self._file(ques_id))
+        if self.cache_size is None or self.cache_size > 0:
+            self.cache[ques_id] = ground_truth
+            if self.cache_size is not None and len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return ground_truth
+
+    def __setitem__(self, ques_id: int, ground_truth: np.ndarray) -> None:
+        self.added[ques_id] = ground_truth
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, ques_id: int, default: np.ndarray = None) -> np.ndarray:
+        if ques_id in self:
+            return self[ques_id]
+        return default
+
+    def keys(self) -> list:
+        return sorted(self.ques_ids | set(self.added))
+
+
+def open_ground_truth(gt_path: str, cache_size: int = 1024):
+    """
+    Opens the precomputed ground truths at gt_path.
+
+    Parameters
+    ---
+    gt_path (str)
+        ground_truth_path from the config
+    cache_size (int)
+        Maximum number of ground truths cached by a ground truth directory
+
+    Result
+    ---
+    dict, PackedGroundTruthStore or LazyGroundTruthDirectory
+        question_index -> ground truth. None if no ground truth exists at gt_path.
+    """
+    if util.is_packed_store(gt_path):
+        if not os.path.exists(os.path.join(gt_path, PACKED_INDEX_FILE)):
+            return None
+        return PackedGroundTruthStore(gt_path)
+
+    if util.is_numpy_file(gt_path):
+        try:
+            return np.load(gt_path, allow_pickle=True)[()]
+        except FileNotFoundError:
+            return None
+
+    if not os.path.isdir(gt_path):
+        return None
+    ground_truth = LazyGroundTruthDirectory(gt_path, cache_size=cache_size)
+    if len(ground_truth) == 0:
+        return None
+    return ground_truth
+
+
+def open_ground_truth_writer(gt_path: str, append: bool = False):
+    """
+    Returns the ground truth writer matching the ground truth path. If the path has a
+    npy extension all ground truths are saved in a single file. If it has a packed
+    extension they are saved bit-packed in a single memory-mappable file. Otherwise,
+    they are saved in a directory with one file per question.
+
+    Parameters
+    ---
+    gt_path (str)
+        ground_truth_path from the config
+    append (bool)
+        Keep the existing ground truths at gt_path and add to them
+
+    Result
+    ---
+    DirectoryGroundTruthWriter, SingleFileGroundTruthWriter or PackedGroundTruthWriter
+    """
+    if util.is_packed_store(gt_path):
+        return PackedGroundTruthWriter(gt_path, append=append)
+    if util.is_numpy_file(gt_path):
+        return SingleFileGroundTruthWriter(gt_path, append=append)
+    return DirectoryGroundTruthWriter(gt_path, append=append)
+
+
+def get_fingerprint_path(gt_path: str) -> str:
+    """
+    Returns the path of the fingerprint file of a ground truth store: inside the ground
+    truth directory (or packed store), or next to the single ground truth file.
+
+    Parameters
+    ---
+    gt_path (str)
+        ground_truth_path from the config
+
+    Result
+    ---
+    str
+    """
+    if util.is_numpy_file(gt_path):
+        return gt_path[:-len(".npy")] + ".fingerprints"
+    return os.path.join(gt_path, "ground_truth.fingerprints")
+
+
+def load_fingerprints(gt_path: str) -> dict:
+    """
+    Loads the fingerprints of a ground truth store.
+
+    Parameters
+    ---
+    gt_path (str)
+        ground_truth_path from the config
+
+    Result
+    ---
+    dict
+        question_index -> (fingerprint, has_ground_truth). Empty if there are none.
+    """
+    path = get_fingerprint_path(gt_path)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "rb") as file:
+        entries = np.load(file)
+    return {
+        int(entry["question_index"]):
+        (entry["fingerprint"].tobytes(), bool(entry["has_ground_truth"]))
+        for entry in entries
+    }
+
+
+def save_fingerprints(gt_path: str, fingerprints: dict) -> None:
+    """
+    Saves the fingerprints of a ground truth store. The file is replaced atomically.
+
+    Parameters
+    ---
+    gt_path (str)
+        ground_truth_path from the config
+    fingerprints (dict)
+        question_index -> (fingerprint, has_ground_truth)
+    """
+    entries = np.array([(ques_id, np.frombuffer(fingerprint, dtype=np.uint8),
+                         has_ground_truth)
+                        for ques_id, (fingerprint,
+                                      has_ground_truth) in fingerprints.items()],
+                       dtype=FINGERPRINT_DTYPE)
+    entries.sort(order="question_index")
+    path = get_fingerprint_path(gt_path)
+    util.ensure_parent_dir(path)
+    # np.save would append .npy to the path, so it's written through a file object
+    with open(path + ".tmp", "wb") as file:
+        np.save(file, entries)
+    os.replace(path + ".tmp", path)
+
+
+def get_stats_dir(gt_path: str) -> str:
+    """
+    Returns the directory the ground truth statistics are saved to, i.e. the ground
+    truth directory itself or the directory containing the single ground truth file.
+
+    Parameters
+    ---
+    gt_path (str)
+        ground_truth_path from the config
+
+    Result
+    ---
+    str
+    """
+    if util.is_numpy_file(gt_path):
+        return os.path.dirname(gt_path)
+    return gt_path
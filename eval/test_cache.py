@@ -0,0 +1,42 @@
+"""
+Tests of cache.py. Run with python -m pytest from the eval directory.
+"""
+
+import benchmark
+from cache import ImageCache
+from profiling import Profiler
+
+
+def _cache(tmp_path, profiler: Profiler = None) -> ImageCache:
+    config = benchmark.make_dataset(str(tmp_path), 2 * benchmark.QUESTIONS_PER_IMAGE)
+    return ImageCache(config["scenes_path"],
+                      config["masks_path"],
+                      config["background_color"],
+                      profiler=profiler)
+
+
+def _read(cache: ImageCache) -> None:
+    for image in ("CLEVR_new_000000", "CLEVR_new_000001", "CLEVR_new_000000"):
+        cache.get_scene(image)
+        cache.get_mask(image)
+    cache.get_scene("CLEVR_new_000001")
+
+
+def test_counts_without_profiler(tmp_path):
+    cache = _cache(tmp_path)
+    _read(cache)
+    stats = cache.stats()
+    assert stats["scene"] == {"hits": 2, "misses": 2, "hit_rate": 0.5}
+    assert stats["mask"] == {"hits": 1, "misses": 2, "hit_rate": 1 / 3}
+    assert stats["entries"] == 2
+
+
+def test_counts_are_forwarded_to_profiler(tmp_path):
+    profiler = Profiler(enabled=True)
+    cache = _cache(tmp_path, profiler)
+    _read(cache)
+    counters = profiler.report()["counters"]
+    assert counters["scene_cache_hits"] == cache.hits["scene"] == 2
+    assert counters["scene_cache_misses"] == cache.misses["scene"] == 2
+    assert counters["mask_cache_hits"] == cache.hits["mask"] == 1
+    assert counters["mask_cache_misses"] == cache.misses["mask"] == 2
@@ -0,0 +1,42 @@
+"""
+Tests of the evaluator on a small synthetic dataset (see benchmark.make_dataset).
+Run with python -m pytest from the eval directory.
+"""
+
+import pytest
+import benchmark
+from eval import UniqueCLEVREvaluator
+
+NUM_QUESTIONS = 60
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory) -> dict:
+    return benchmark.make_dataset(str(tmp_path_factory.mktemp("dataset")),
+                                  NUM_QUESTIONS)
+
+
+def _evaluator(dataset: dict, gt_path: str, filters: list) -> UniqueCLEVREvaluator:
+    return UniqueCLEVREvaluator(
+        dict(dataset, ground_truth_path=gt_path, filters=filters))
+
+
+@pytest.mark.parametrize("gt_name", ["gt", "gt.npy", "gt.packed"])
+def test_filter_switch_removes_stale_ground_truths(dataset, tmp_path, gt_name):
+    # The count questions have target objects with the union filter but not with the
+    # unique filter, so their ground truths have to be removed when switching
+    gt_path = str(tmp_path / gt_name)
+    _evaluator(dataset, gt_path, ["union"]).calculate_all_ground_truths()
+    union_ids = set(_evaluator(dataset, gt_path, ["union"]).ground_truth.keys())
+    _evaluator(dataset, gt_path, ["unique"]).calculate_all_ground_truths()
+
+    fresh_path = str(tmp_path / ("fresh_" + gt_name))
+    _evaluator(dataset, fresh_path, ["unique"]).calculate_all_ground_truths()
+    switched = _evaluator(dataset, gt_path, ["unique"])
+    fresh = _evaluator(dataset, fresh_path, ["unique"])
+    assert set(switched.ground_truth.keys()) == set(fresh.ground_truth.keys())
+    assert set(fresh.ground_truth.keys()) < union_ids
+
+    switched.evaluate()
+    fresh.evaluate()
+    assert switched.get_overall_accuracy() == fresh.get_overall_accuracy()
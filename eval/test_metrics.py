@@ -0,0 +1,55 @@
+"""
+Tests of metrics.py. Run with python -m pytest from the eval directory.
+"""
+
+import numpy as np
+import pytest
+import metrics
+
+
+def _reference_rank_accuracy(ground_truth: np.ndarray, heatmap: np.ndarray) -> float:
+    relevance = np.abs(heatmap).ravel()
+    gt_size = int(ground_truth.sum())
+    if gt_size == 0 or relevance.sum() == 0:
+        return np.nan
+    top = np.argsort(-relevance, kind="stable")[:gt_size]
+    return ground_truth.ravel()[top].sum() / gt_size
+
+
+def test_rank_accuracy_matches_per_heatmap_reference():
+    rng = np.random.default_rng(0)
+    ground_truths = rng.random((6, 24, 32)) < 0.1
+    heatmaps = rng.normal(size=(6, 24, 32))
+    # rows without ground truth or without relevance are undefined
+    ground_truths[1] = False
+    heatmaps[2] = 0
+    # ties and a ground truth covering the whole heatmap
+    heatmaps[3] = np.round(heatmaps[3])
+    ground_truths[4] = True
+
+    values = metrics.rank_accuracy(metrics.MetricBatch(ground_truths, heatmaps))
+    expected = [
+        _reference_rank_accuracy(ground_truth, heatmap)
+        for ground_truth, heatmap in zip(ground_truths, heatmaps)
+    ]
+    np.testing.assert_array_equal(values, expected)
+    assert np.isnan(values[1]) and np.isnan(values[2])
+    assert values[4] == 1.0
+
+
+@pytest.mark.parametrize("k", [1, 5, 10, 50, 100])
+def test_top_k_mass_matches_sweep_with_ties(k):
+    rng = np.random.default_rng(1)
+    ground_truths = rng.random((5, 20, 30)) < 0.2
+    heatmaps = rng.normal(size=(5, 20, 30)).astype(np.float32)
+    # flat regions and many zeros tie at the top k boundary
+    heatmaps[0] = np.round(heatmaps[0])
+    heatmaps[1, :, :20] = 0
+    heatmaps[2] = 0.5
+    heatmaps[3, :10] = heatmaps[3, 0, 0]
+    batch = metrics.MetricBatch(ground_truths, heatmaps)
+
+    values = metrics.top_k_mass(batch, k=k)
+    sweep = metrics.threshold_sweep(batch, np.array([k], dtype=np.float64))[:, 0]
+    assert values.dtype == sweep.dtype
+    np.testing.assert_array_equal(values, sweep)
@@ -0,0 +1,35 @@
+"""
+Tests of results.py. Run with python -m pytest from the eval directory.
+"""
+
+import numpy as np
+from results import ResultsLog
+
+
+def test_resumed_log_restores_dtypes(tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    header = {"methods": ["lrp"]}
+    scores = [{
+        "lrp": {
+            "mass_accuracy": np.float32(0.1) * (i + 1),
+            "pointing_game": float(i % 2),
+            "curve": np.linspace(0, 1, 4, dtype=np.float32) * i
+        }
+    } for i in range(3)]
+    scores.append({"lrp": {"mass_accuracy": -1, "pointing_game": -1, "curve": -1}})
+    log = ResultsLog(path, header)
+    for position, question_scores in enumerate(scores):
+        log.append(position, 10 + position, question_scores)
+    log.close()
+
+    resumed = ResultsLog(path, header)
+    assert resumed.ques_ids == {position: 10 + position for position in range(4)}
+    for position, question_scores in enumerate(scores):
+        for label, value in question_scores["lrp"].items():
+            restored = resumed.results[position]["lrp"][label]
+            assert type(restored) == type(value)
+            np.testing.assert_array_equal(restored, value)
+    mass_accuracy = [resumed.results[position]["lrp"]["mass_accuracy"]
+                     for position in range(3)]
+    assert np.mean(mass_accuracy) == np.mean(
+        [question_scores["lrp"]["mass_accuracy"] for question_scores in scores[:3]])
@@ -0,0 +1,94 @@
+"""
+Tests of util.py. Run with python -m pytest from the eval directory.
+"""
+
+import json
+import numpy as np
+import pytest
+import util
+
+# (input shape, output shape): integer and non-integer factors, downsampling,
+# upsampling, both at once and non-square shapes
+RESIZE_SHAPES = [
+    ((320, 480), (160, 240)),
+    ((320, 480), (128, 128)),
+    ((320, 480), (224, 224)),
+    ((320, 480), (100, 300)),
+    ((64, 96), (128, 192)),
+    ((50, 70), (128, 128)),
+    ((37, 53), (111, 106)),
+    ((100, 60), (50, 120)),
+    ((90, 130), (90, 130)),
+]
+
+
+@pytest.mark.parametrize("in_shape, out_shape", RESIZE_SHAPES)
+@pytest.mark.parametrize("density", [0.001, 0.05, 0.5])
+def test_resize_ground_truth_batch_matches_pil(in_shape, out_shape, density):
+    rng = np.random.default_rng(0)
+    ground_truths = rng.random((4,) + in_shape) < density
+    # single pixels at the borders are the hardest cases for the windows
+    ground_truths[0] = False
+    ground_truths[0, 0, 0] = ground_truths[0, -1, -1] = True
+    ground_truths[0, in_shape[0] // 2, -1] = True
+    ground_truths[0, -1, in_shape[1] // 3] = True
+
+    resized = util.resize_ground_truth_batch(ground_truths, out_shape)
+    assert resized.shape == (len(ground_truths),) + out_shape
+    assert resized.dtype == bool
+    for ground_truth, result in zip(ground_truths, resized):
+        np.testing.assert_array_equal(
+            result, util._resize_ground_truth_pil(ground_truth, out_shape))
+
+
+def test_resize_ground_truth_non_boolean_uses_pil():
+    ground_truth = np.zeros((320, 480), dtype=np.uint8)
+    ground_truth[100:120, 200:260] = 1
+    np.testing.assert_array_equal(
+        util.resize_ground_truth(ground_truth, (128, 128)),
+        util.resize_ground_truth(ground_truth.astype(bool), (128, 128)))
+
+
+@pytest.mark.parametrize("dtype", [np.int8, np.int32, np.int64, np.uint8, np.float32])
+def test_calc_overlap_batch_nan_for_integer_heatmaps(dtype):
+    ground_truths = np.zeros((3, 4, 5), dtype=bool)
+    ground_truths[:, :2] = True
+    heatmaps = np.ones((3, 4, 5), dtype=dtype)
+    heatmaps[1] = 0
+    heatmaps[2, 2:] = 3
+
+    overlaps = util.calc_overlap_batch(ground_truths, heatmaps)
+    assert np.issubdtype(overlaps.dtype, np.floating)
+    assert overlaps[0] == 0.5
+    assert np.isnan(overlaps[1])
+    assert overlaps[2] == pytest.approx(10 / 40)
+
+
+@pytest.mark.parametrize("jsonl", [False, True])
+def test_iter_json_records_non_ascii(tmp_path, jsonl):
+    records = [{
+        "question_index": 0,
+        "answer": "w\u00fcrfel"
+    }, {
+        "question_index": 1,
+        "question": "Wie viele gr\u00fc\u00dfe \u7acb\u65b9\u4f53?",
+        "answer": 2
+    }, {
+        "question_index": 2,
+        "answer": "cube"
+    }]
+    if jsonl:
+        path = tmp_path / "questions.jsonl"
+        text = "".join(json.dumps(record, ensure_ascii=False) + "\n"
+                       for record in records)
+    else:
+        path = tmp_path / "questions.json"
+        text = json.dumps({"info": {}, "questions": records}, ensure_ascii=False)
+    path.write_bytes(text.encode("utf-8"))
+
+    read = list(util.iter_json_records(str(path), key="questions"))
+    assert [record for _, _, record in read] == records
+    # the offsets are byte offsets of the records in the file
+    data = path.read_bytes()
+    for start, end, record in read:
+        assert json.loads(data[start:end].decode("utf-8")) == record
@@ -6,8 +6,10 @@ util.py contains utility functions used for Unique CLEVR  dataset evaluation.
 
 # Add support for types within collections
 # Python doesn't enforce types anyway but I think they help readability of function headers
-from typing import List, Union, Tuple
+from typing import Callable, Iterable, Iterator, List, Union, Tuple
+import os
 import json
+import hashlib
 from PIL import Image
 import numpy as np
 import re
@@ -30,6 +32,40 @@ def is_numpy_file(filepath: str) -> bool:
     return filepath.endswith(".npy")
 
 
+def is_packed_store(path: str) -> bool:
+    """
+    Helper function to check if the path is a packed ground truth store
+
+    Parameters
+    ---
+    path (str)
+        Directory path
+
+    Result
+    ---
+    bool
+        Returns True if the path ends with the packed extension.
+    """
+    return path.rstrip("/").endswith(".packed")
+
+
+def is_heatmap_stack(path: str) -> bool:
+    """
+    Helper function to check if the path is a stacked heatmap container
+
+    Parameters
+    ---
+    path (str)
+        Directory path
+
+    Result
+    ---
+    bool
+        Returns True if the path ends with the stack extension.
+    """
+    return path.rstrip("/").endswith(".stack")
+
+
 def srgb2lin(img_arr: np.ndarray) -> np.ndarray:
     """
     Convert from sRGB to Linear RGB.
@@ -105,6 +141,63 @@ def load_json(filepath: str):
         return None
 
 
+def ensure_parent_dir(filepath: str) -> None:
+    """
+    Creates the directory containing a file if it doesn't exist yet.
+
+    Parameters
+    ---
+    filepath (str)
+        File path
+    """
+    directory = os.path.dirname(filepath)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+
+def load_questions(filepath: str) -> List[dict]:
+    """
+    Load all questions of a question file: a Unique CLEVR question file with a
+    "questions" list, or a JSON Lines file (jsonl extension) with one question per line.
+
+    Parameters
+    ---
+    filepath (str)
+        Question file path
+
+    Result
+    ---
+    List[dict]
+    """
+    if is_json_lines(filepath):
+        return [question for _, _, question in iter_json_records(filepath)]
+    return load_json(filepath)["questions"]
+
+
+def file_digest(filepath: str) -> bytes:
+    """
+    Content hash of a file
+
+    Parameters
+    ---
+    filepath (str)
+        File path
+
+    Result
+    ---
+    bytes
+        16 byte BLAKE2 digest. The digest of no content if the file doesn't exist.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(filepath, "rb") as file:
+            for block in iter(lambda: file.read(2**20), b""):
+                digest.update(block)
+    except FileNotFoundError:
+        pass
+    return digest.digest()
+
+
 def save_json(data: dict, filepath: str):
     """
     Save data as JSON file
@@ -120,6 +213,245 @@ def save_json(data: dict, filepath: str):
         json.dump(data, file)
 
 
+def is_json_lines(filepath: str) -> bool:
+    """
+    Helper function to check if the file extension is for JSON Lines
+
+    Parameters
+    ---
+    filepath (str)
+        File path
+
+    Result
+    ---
+    bool
+        Returns True if file path ends with the jsonl extension.
+    """
+    return filepath.endswith(".jsonl")
+
+
+class _JSONStream():
+    """
+    Incremental reader for a JSON file which is decoded one value at a time from a
+    buffer of fixed sized blocks. The file is decoded as latin-1, so positions in the
+    buffer are byte offsets into the file.
+    """
+
+    def __init__(self, file, block_size: int = 2**20):
+        self.file = file
+        self.block_size = block_size
+        self.buffer = ""
+        # byte offset of buffer[0] and read position inside the buffer
+        self.base = 0
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        """
+        Reads the next block, dropping the consumed part of the buffer.
+        Returns False at the end of the file.
+        """
+        if self.eof:
+            return False
+        block = self.file.read(self.block_size)
+        if not block:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + block.decode("latin-1")
+        self.base += self.pos
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns the next character ("" at the end of the file).
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, chars: str) -> str:
+        """
+        Consumes the next character, which has to be one of chars.
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r at byte %d of %s" %
+                             (chars, self.base + self.pos, self.file.name))
+        self.pos += 1
+        return char
+
+    def decode(self) -> Tuple[int, int, object]:
+        """
+        Decodes the next JSON value.
+
+        Result
+        ---
+        Tuple[int, int, object]
+            Start and end byte offset of the value and the value itself
+        """
+        self.peek()
+        decoder = json.JSONDecoder()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # A value ending at the end of the buffer may be cut off (e.g. a number)
+                if end < len(self.buffer) or self.eof:
+                    break
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+        text = self.buffer[self.pos:end]
+        # The buffer holds the raw bytes as latin-1, so non-ASCII (UTF-8) text has to be
+        # decoded again. str.isascii needs Python 3.7.
+        try:
+            text.encode("ascii")
+        except UnicodeEncodeError:
+            value = json.loads(text.encode("latin-1").decode("utf-8"))
+        start = self.base + self.pos
+        self.pos = end
+        return start, self.base + end, value
+
+
+def iter_json_records(filepath: str,
+                      key: str = None) -> Iterator[Tuple[int, int, dict]]:
+    """
+    Streams the records of a JSON Lines file (one record per line) or of a JSON array
+    without loading the whole file. The array is either the top level value of the file
+    or, if key is given, the value of key in the top level object, e.g. the questions
+    of a question file.
+
+    Parameters
+    ---
+    filepath (str)
+        JSON or JSON Lines file path
+    key (str)
+        Key of the array in the top level object. Ignored for JSON Lines files.
+
+    Result
+    ---
+    Iterator[Tuple[int, int, dict]]
+        Start and end byte offset of every record and the record itself
+    """
+    with open(filepath, "rb") as file:
+        if is_json_lines(filepath):
+            offset = 0
+            for line in file:
+                if line.strip():
+                    yield offset, offset + len(line), json.loads(line)
+                offset += len(line)
+            return
+
+        stream = _JSONStream(file)
+        if key is not None and stream.peek() == "{":
+            stream.expect("{")
+            while stream.peek() != "}":
+                _, _, name = stream.decode()
+                stream.expect(":")
+                if name == key:
+                    break
+                stream.decode()
+                if stream.expect(",}") == "}":
+                    return
+            else:
+                return
+
+        stream.expect("[")
+        if stream.peek() == "]":
+            return
+        while True:
+            yield stream.decode()
+            if stream.expect(",]") == "]":
+                return
+
+
+def iter_chunks(items: Iterable,
+                chunk_size: int,
+                key: Callable = None,
+                window: int = None) -> Iterator[list]:
+    """
+    Lazily split an iterable into work units of at most chunk_size items. If a key is
+    given, the items are (stably) sorted by it within windows of window items so that
+    items sharing a key end up in the same chunk without reading all items first.
+
+    Parameters
+    ---
+    items (Iterable)
+        Items to split
+    chunk_size (int)
+        Maximum number of items per chunk
+    key (Callable)
+        Optional sort key
+    window (int)
+        Number of items sorted at once. None sorts all items.
+
+    Result
+    ---
+    Iterator[list]
+    """
+    chunk_size = max(1, chunk_size)
+    items = iter(items)
+    while True:
+        if window is None:
+            block = list(items)
+        else:
+            block = [item for _, item in zip(range(max(window, chunk_size)), items)]
+        if not block:
+            return
+        yield from make_chunks(block, chunk_size, key=key)
+        if window is None:
+            return
+
+
+def report_ids(message: str, ids: List[int], limit: int = 10) -> None:
+    """
+    Print a single warning for a whole list of question ids instead of one line per id.
+
+    Parameters
+    ---
+    message (str)
+        Description of the problem, e.g. "predictions without a question"
+    ids (List[int])
+        Offending question ids. Nothing is printed if the list is empty.
+    limit (int)
+        Maximum number of ids to print
+    """
+    if not ids:
+        return
+    shown = ", ".join(str(i) for i in ids[:limit])
+    if len(ids) > limit:
+        shown += ", ..."
+    print("Warning: %d %s (qids: %s)" % (len(ids), message, shown))
+
+
+def make_chunks(items: list, chunk_size: int, key: Callable = None) -> List[list]:
+    """
+    Split items into work units of at most chunk_size items. If a key is given, items
+    are (stably) sorted by it first so that items sharing a key, e.g. questions about
+    the same image, end up in the same chunk.
+
+    Parameters
+    ---
+    items (list)
+        Items to split
+    chunk_size (int)
+        Maximum number of items per chunk
+    key (Callable)
+        Optional sort key
+
+    Result
+    ---
+    List[list]
+    """
+    if key is not None:
+        items = sorted(items, key=key)
+    chunk_size = max(1, chunk_size)
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
 def strip_special_chars(string: str) -> str:
     """
     Strip special characters from string
@@ -155,16 +487,117 @@ def get_mask_colors(scene: dict) -> List[List[float]]:
     return masks
 
 
+def pack_rgb(img: np.ndarray) -> np.ndarray:
+    """
+    Pack uint8 RGB values into a single uint32 key (R << 16 | G << 8 | B), so colors can
+    be compared and sorted as scalars. Sorting the keys sorts the colors
+    lexicographically by (R, G, B).
+
+    Parameters
+    ---
+    img (np.ndarray)
+        Array of RGB values with shape ...x3
+
+    Result
+    ---
+    np.ndarray
+        uint32 array with shape ...
+    """
+    img = img.astype(np.uint32)
+    return (img[..., 0] << 16) | (img[..., 1] << 8) | img[..., 2]
+
+
+def unpack_rgb(keys: np.ndarray) -> np.ndarray:
+    """
+    Inverse of pack_rgb.
+
+    Parameters
+    ---
+    keys (np.ndarray)
+        uint32 keys with shape ...
+
+    Result
+    ---
+    np.ndarray
+        uint8 RGB values with shape ...x3
+    """
+    keys = np.asarray(keys, dtype=np.uint32)
+    return np.stack([(keys >> 16) & 255, (keys >> 8) & 255, keys & 255],
+                    axis=-1).astype(np.uint8)
+
+
+# sRGB -> linear RGB lookup table for all 256 uint8 values
+SRGB2LIN_LUT = srgb2lin(np.arange(256))
+
+
+def linear_sum_assignment(cost: np.ndarray) -> np.ndarray:
+    """
+    Solve the linear assignment problem for a cost matrix with at least as many
+    columns as rows (Hungarian method with potentials, O(rows^2 * cols)).
+
+    Parameters
+    ---
+    cost (np.ndarray)
+        Cost matrix with shape rows x cols, rows <= cols
+
+    Result
+    ---
+    np.ndarray
+        Column assigned to each row. The columns are distinct and the total cost
+        is minimal.
+    """
+    rows, cols = cost.shape
+    assert rows <= cols
+    # 1-based indexing as in the classic formulation, column 0 is a dummy column
+    u = np.zeros(rows + 1)
+    v = np.zeros(cols + 1)
+    row_of_col = np.zeros(cols + 1, dtype=np.int64)
+    for row in range(1, rows + 1):
+        row_of_col[0] = row
+        col = 0
+        min_slack = np.full(cols + 1, np.inf)
+        prev_col = np.zeros(cols + 1, dtype=np.int64)
+        used = np.zeros(cols + 1, dtype=bool)
+        while row_of_col[col] != 0:
+            used[col] = True
+            cur_row = row_of_col[col]
+            free = ~used[1:]
+            slack = cost[cur_row - 1] - u[cur_row] - v[1:]
+            improve = free & (slack < min_slack[1:])
+            min_slack[1:][improve] = slack[improve]
+            prev_col[1:][improve] = col
+            candidates = np.where(free, min_slack[1:], np.inf)
+            next_col = int(np.argmin(candidates)) + 1
+            delta = candidates[next_col - 1]
+            u[row_of_col[used]] += delta
+            v[used] -= delta
+            min_slack[1:][free] -= delta
+            col = next_col
+        # augment along the alternating path
+        while col != 0:
+            prev = prev_col[col]
+            row_of_col[col] = row_of_col[prev]
+            col = prev
+
+    assignment = np.empty(rows, dtype=np.int64)
+    for col in range(1, cols + 1):
+        if row_of_col[col] != 0:
+            assignment[row_of_col[col] - 1] = col - 1
+    return assignment
+
+
 def preprocess_mask_img(img: np.ndarray, mask_colors: np.ndarray,
                         bg_color: np.ndarray) -> Union[np.ndarray, np.ndarray]:
     """
     Prepocessing step for a mask image to map the mask colors in the scene file to the
     actual pixel values in the mask image.
 
-    1. Get unique colors
-    2. Convert colors from sRGB to RGB
+    1. Get unique colors (as packed uint32 keys)
+    2. Convert colors from sRGB to RGB (lookup table)
     3. Load mask colors from scene file
-    4. Map the mask colors to the unique pixel values in the mask image
+    4. Map the mask colors to the unique pixel values in the mask image. Each mask color
+       is mapped to its nearest unique color. If two mask colors share the same nearest
+       color, the one-to-one mapping with the smallest total distance is used instead.
 
     Parameters
     ---
@@ -181,58 +614,72 @@ def preprocess_mask_img(img: np.ndarray, mask_colors: np.ndarray,
         return 2 arrays: unique_colors, mapping
     """
 
-    def find_nearest_index(array: np.ndarray, value: np.ndarray) -> int:
-        """
-        Returns index of nearest RGB value in an array compared to the given RGB value.
-        We are dealing with a 2d array (num_unique x RGB) and the value
-        is a 1d array (RGB values).
-        Comparison done with euclidean distance.
-
-        Parameters
-        ---
-        array (np.ndarray)
-            2D array containing multiple unique colors (#num_unique x RGB)
-        value (np.ndarray)
-            1D array containg RGB values
-
-        Result
-        ---
-        int
-            Index of the closest value
-        """
-
-        distances = np.sqrt(np.sum((array - value)**2, axis=1))
-        smallest_idx = np.where(distances == np.amin(distances))[0][0]
-        return smallest_idx
-
-    # get unique values
-    unique_colors = np.unique(img.reshape(-1, img.shape[2]), axis=0)
+    # get unique values. Sorting the packed keys gives the same (lexicographic)
+    # order as np.unique over the RGB rows.
+    unique_keys = np.unique(pack_rgb(img[..., :3]).ravel())
 
     # remove background color
-    bg_index = np.all(unique_colors == bg_color, axis=-1)
+    bg_index = unique_keys == pack_rgb(np.asarray(bg_color))
     # assert that there's only one row equivalent to the background
     assert np.count_nonzero(bg_index) == 1
-    bg_index = bg_index.nonzero()[0][0]
-    # remove from array
-    unique_colors = np.delete(unique_colors, bg_index, axis=0)
+    unique_keys = unique_keys[~bg_index]
+    unique_colors = unpack_rgb(unique_keys)
 
     # convert from sRGB to linear RGB
     # The colors in the rendered images are in the sRGB space, thus when we load
     # and compare it with the mask_colors from the scenes files they would not match
     # So we need to convert the results to linear space
 
-    unique_colors_rgb = srgb2lin(unique_colors)
+    unique_colors_rgb = SRGB2LIN_LUT[unique_colors]
+
+    # Euclidean distance between every mask color and every unique color
+    mask_colors = np.asarray(mask_colors, dtype=np.float64).reshape(-1, 3)
+    distances = np.sqrt(
+        np.sum((mask_colors[:, None, :] - unique_colors_rgb[None, :, :])**2,
+               axis=-1))
 
     # Get mapping
-    mapping = np.empty(len(mask_colors), dtype=np.uint64)
-    for i, mask_color in enumerate(mask_colors):
-        mapping[i] = find_nearest_index(unique_colors_rgb,
-                                        np.asarray(mask_color))
+    mapping = np.argmin(distances, axis=1)
+    if len(np.unique(mapping)) != len(mapping):
+        assert len(mask_colors) <= len(unique_colors), \
+            "Mask image has fewer colors than the scene has objects!"
+        mapping = linear_sum_assignment(distances)
 
-    # Assert that each mapping is unique
-    assert len(np.unique(mapping)) == len(mapping)
+    return unique_colors, mapping.astype(np.uint64)
+
+
+def mask_to_labels(img: np.ndarray, unique_colors: np.ndarray,
+                   mapping: np.ndarray) -> np.ndarray:
+    """
+    Convert a mask image to a label map where each pixel holds the index of the scene
+    object it belongs to. Pixels which don't belong to any object are set to 255.
 
-    return unique_colors, mapping
+    Parameters
+    ---
+    img (np.ndarray)
+        2D mask image (HxWxRGB)
+    unique_colors (np.ndarray)
+        unique colors as returned by preprocess_mask_img
+    mapping (np.ndarray)
+        object index -> unique color index as returned by preprocess_mask_img
+
+    Result
+    ---
+    np.ndarray
+        uint8 label map with shape HxW
+    """
+    assert len(mapping) < 255, "Label maps support at most 254 objects!"
+    if len(mapping) == 0:
+        return np.full(img.shape[0:2], 255, dtype=np.uint8)
+    packed = pack_rgb(img[..., :3])
+    object_keys = pack_rgb(unique_colors[mapping.astype(np.int64)])
+    # look up every pixel in the (sorted) object colors
+    order = np.argsort(object_keys)
+    sorted_keys = object_keys[order]
+    pos = np.minimum(np.searchsorted(sorted_keys, packed), len(order) - 1)
+    is_object = sorted_keys[pos] == packed
+    labels = np.where(is_object, order[pos], 255).astype(np.uint8)
+    return labels
 
 
 def build_branches(program: List[dict],
@@ -370,6 +817,27 @@ def get_target_objects(objects: List[dict], program: List[dict],
     return target_objects, list(target_objects_indices)
 
 
+def get_heatmap_paths(heatmap_path: Union[str, dict]) -> dict:
+    """
+    Normalizes the heatmap_path config value to a mapping of attribution method name ->
+    heatmap path. A single path is returned as the method "default".
+
+    Parameters
+    ---
+    heatmap_path (Union[str, dict])
+        heatmap_path from the config. Either a single path or method -> path.
+
+    Result
+    ---
+    dict
+    """
+    if heatmap_path is None:
+        return {}
+    if isinstance(heatmap_path, dict):
+        return dict(heatmap_path)
+    return {"default": heatmap_path}
+
+
 def load_heatmap(filename: str) -> np.ndarray:
     """
     Loads heatmap from disk. Currently just loads a numpy array.
@@ -392,6 +860,8 @@ def resize_ground_truth(ground_truth: np.ndarray,
     """
     Resize the ground truth to match the heatmap size. This is necessary because the
     heatmap shape is dependent on the the model's input preprocessing.
+    Boolean ground truths are resized with resize_ground_truth_batch, anything else
+    with PIL. Both give the same result for boolean ground truths.
 
     Parameters
     ---
@@ -405,10 +875,19 @@ def resize_ground_truth(ground_truth: np.ndarray,
     np.ndarray
         Boolean ground truth with shape == np_shape
     """
+    if ground_truth.dtype == bool:
+        return resize_ground_truth_batch(ground_truth[np.newaxis], np_shape)[0]
+    return _resize_ground_truth_pil(ground_truth, np_shape)
+
 
+def _resize_ground_truth_pil(ground_truth: np.ndarray,
+                             np_shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Resize the ground truth with PIL's bilinear filter, see resize_ground_truth.
+    """
     # No resizing needed
-    if ground_truth.shape == np_shape:
-        return ground_truth
+    if ground_truth.shape == tuple(np_shape):
+        return ground_truth > 0
     # heatmap.shape is reversed because PIL uses WxH while numpy uses HxW
     ground_truth_resized = np.array(
         Image.fromarray(ground_truth.astype(np.float64)).resize(
@@ -421,6 +900,76 @@ def resize_ground_truth(ground_truth: np.ndarray,
     return ground_truth_resized
 
 
+def _bilinear_windows(in_size: int,
+                      out_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the input pixels with a non-zero weight for every output pixel of PIL's
+    bilinear resampling along one axis, as half-open ranges [start, end). Mirrors
+    precompute_coeffs in PIL's Resample.c, including the floating point operations,
+    for downsampling (with antialiasing) as well as upsampling.
+    """
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    # the support of the bilinear filter is 1
+    support = filterscale
+    center = (np.arange(out_size) + 0.5) * scale
+    xmin = np.maximum((center - support + 0.5).astype(np.int64), 0)
+    xmax = np.minimum((center + support + 0.5).astype(np.int64), in_size)
+    width = int((xmax - xmin).max())
+    offsets = np.arange(width)
+    # The filter 1 - |x| is positive for |x| < 1, which is a contiguous range
+    x = ((offsets + xmin[:, np.newaxis]) - center[:, np.newaxis] + 0.5) * (1.0 /
+                                                                          filterscale)
+    positive = (np.abs(x) < 1) & (offsets < (xmax - xmin)[:, np.newaxis])
+    start = xmin + np.argmax(positive, axis=1)
+    end = xmin + width - np.argmax(positive[:, ::-1], axis=1)
+    return start, end
+
+
+def _any_resize_rows(ground_truths: np.ndarray, out_size: int) -> np.ndarray:
+    """
+    Resizes the rows (axis 1) of a BxHxW boolean stack: an output row is the OR of the
+    input rows in its bilinear window. The window ranges are covered by a few shifted
+    row gathers, which operate on whole contiguous rows.
+    """
+    start, end = _bilinear_windows(ground_truths.shape[1], out_size)
+    resized = np.take(ground_truths, start, axis=1)
+    for shift in range(1, int((end - start).max())):
+        resized |= np.take(ground_truths, np.minimum(start + shift, end - 1), axis=1)
+    return resized
+
+
+def resize_ground_truth_batch(ground_truths: np.ndarray,
+                              np_shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Resize a stack of boolean ground truths at once. An output pixel is True if any
+    input pixel with a non-zero bilinear weight is True, which is exactly what
+    thresholding PIL's bilinear resize at > 0 gives. Integer and non-integer factors,
+    downsampling and upsampling all take the same vectorized path.
+
+    Parameters
+    ---
+    ground_truths (np.ndarray)
+        Boolean ground truths with shape BxHxW
+    np_shape (Tuple[int,int])
+        The target shape using numpy dimension ordering (Height x Width)
+
+    Result
+    ---
+    np.ndarray
+        Boolean ground truths with shape Bxnp_shape
+    """
+    resized = ground_truths.astype(bool, copy=False)
+    if resized.shape[1] != np_shape[0]:
+        resized = _any_resize_rows(resized, np_shape[0])
+    if resized.shape[2] != np_shape[1]:
+        # resize the columns as rows of the transposed stack
+        columns = np.ascontiguousarray(resized.transpose(0, 2, 1))
+        resized = np.ascontiguousarray(
+            _any_resize_rows(columns, np_shape[1]).transpose(0, 2, 1))
+    return resized
+
+
 def calc_overlap(ground_truth: np.ndarray, heatmap: np.ndarray) -> float:
     """
     Calculate overlap between the heatmap and the object masks in the mask image.
@@ -435,19 +984,68 @@ def calc_overlap(ground_truth: np.ndarray, heatmap: np.ndarray) -> float:
     Result
     ---
     float
-        overlap ratio
+        overlap ratio. NaN if the heatmap has no relevance.
     """
 
     assert ground_truth.shape == heatmap.shape
 
+    return calc_overlap_batch(ground_truth[None], heatmap[None])[0]
+
+
+def calc_overlap_batch(ground_truths: np.ndarray,
+                       heatmaps: np.ndarray) -> np.ndarray:
+    """
+    Calculate the overlap between a stack of heatmaps and their ground truths at once.
+
+    Parameters
+    ---
+    ground_truths (np.ndarray)
+        Ground truth boolean masks with shape BxHxW
+    heatmaps (np.ndarray)
+        Relevance heatmaps with shape BxHxW
+
+    Result
+    ---
+    np.ndarray
+        overlap ratio per heatmap with shape B. NaN for heatmaps without relevance.
+    """
+
+    assert ground_truths.shape == heatmaps.shape
+
+    relevance = np.abs(heatmaps)
     # Calculate correct relevance of heatmap where GT(x,y)==True
-    correct_relevance = np.abs(heatmap[ground_truth]).sum()
+    correct_relevance = np.where(ground_truths, relevance,
+                                 0).sum(axis=(1, 2))
 
-    total_relevance = np.abs(heatmap).sum()
+    total_relevance = relevance.sum(axis=(1, 2))
 
     # Return overlap of correct relevance over total relevance
-    overlap = correct_relevance / total_relevance
-    return overlap
+    return divide_or_nan(correct_relevance, total_relevance)
+
+
+def divide_or_nan(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """
+    Element-wise division which returns NaN where the denominator is 0, without
+    emitting division warnings.
+
+    Parameters
+    ---
+    numerator (np.ndarray)
+    denominator (np.ndarray)
+
+    Result
+    ---
+    np.ndarray
+    """
+    # The NaN sentinel needs a floating point result, also for integer inputs. Float32
+    # inputs keep a float32 result.
+    dtype = np.result_type(numerator, denominator, np.float32)
+    if not np.issubdtype(dtype, np.floating):
+        dtype = np.float64
+    result = np.full(np.shape(denominator), np.nan, dtype=dtype)
+    np.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
+
 
 def _stat_ground_truth_pixels(ground_truth: np.ndarray) -> int:
     """